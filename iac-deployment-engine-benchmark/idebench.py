@@ -0,0 +1,973 @@
+# idebench.py
+"""IaC Deployment Engine Benchmark (IDEB)
+
+Runs IDEL (`IdelIaC.process`, round after round) and IDES (`ides.main`) against synthetic IaC repositories
+and an in-process stand-in of CodePipeline, CloudFormation, S3 and Secrets Manager.
+
+Time is virtual: a stack completes `latency` seconds after its API call, waiters make the clock jump to the completion
+(bounded by their config) and CodePipeline re-invokes the Lambda `round interval` seconds after a continuation.
+The real compute time of the engines is added on top, so a regression in the engines shows up in the wall time.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import getopt
+import random
+import shutil
+import logging
+import zipfile
+import tempfile
+import threading
+import types
+import itertools
+import tracemalloc
+from collections import Counter
+
+import botocore
+from botocore.exceptions import ClientError, WaiterError
+from botocore.response import StreamingBody
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT_DIR, 'iac-deployment-engine-lambda', 'function')
+STANDALONE_DIR = os.path.join(ROOT_DIR, 'iac-deployment-engine-standalone')
+CORE_DIR = os.path.join(ROOT_DIR, 'iac-deployment-engine-core')
+
+NAME = 'IaC Deployment Engine Benchmark'
+VERSION = '0.2.0'
+
+# Constants
+ENGINE_IDEL = 'idel'
+ENGINE_IDES = 'ides'
+ARTIFACT_BUCKET = 'idebench-artifacts'
+ARTIFACT_KEY = 'pipeline/SourceArtifact/repository.zip'
+SECRET_NAME = 'idebench'
+TEMPLATE_DIR = 'cfn-templates'
+DEFAULT_REGION = 'eu-west-1'
+WAITER_TARGETS = {
+    'stack_create_complete': 'CREATE_COMPLETE',
+    'stack_update_complete': 'UPDATE_COMPLETE',
+    'stack_delete_complete': 'DELETE_COMPLETE',
+    'stack_exists': None
+}
+
+command_help = '''
+  idebench.py
+--engine <value>         : idel|ides|all (default: all)
+--blocks <value>         : comma-separated numbers of blocks (default: 10,100,1000)
+--mode <value>           : provision|destroy|change (default: provision)
+--template-kb <value>    : size of each template in KB (default: 4)
+--templates <value>      : number of distinct templates (default: 10)
+--wave-width <value>     : consecutive blocks sharing the same `Wave` (default: 1, sequential)
+--targets <value>        : regions each block is deployed to (`Targets`), 0 for none (default: 0)
+--object <value>         : cfn|aws, kind of the blocks. `aws` blocks stop EC2 instances (default: cfn)
+--api-latency <value>    : seconds of each call of `aws` blocks (default: 0)
+--refs                   : `cfn` blocks refer to the output of the stack of the previous block/wave (`${StackName.OutputKey}`)
+--latency <value>        : seconds for a stack to complete (default: 60)
+--jitter <value>         : +/- ratio of the latency (default: 0.2)
+--wait-mode <value>      : IDEL `CFN_WAIT_MODE`, block|poll (default: block)
+--plan-store <value>     : IDEL `PLAN_STORE`, local|s3 (in the AWS stand-in). State across rounds is only kept on s3 (default: local)
+--unchanged <value>      : ratio of the stacks already deployed with the same content, no-op deployments (default: 0)
+--missing <value>        : ratio of the stacks (the last ones) not seeded with `--unchanged`, created by the run (default: 0)
+--jobs <value>           : IDES `-j` and IDEL `MAX_PARALLEL_BLOCKS` (default: 10)
+--round-interval <value> : seconds between CodePipeline rounds (default: 30)
+--timeout <value>        : Lambda timeout in seconds (default: 900)
+--memory <value>         : Lambda memory in MB (default: 512)
+--cold                   : drop the warm caches before every round (cold starts)
+--warm-history           : run IDEL once before measuring, so that stack durations are known (adaptive polling)
+--no-tracemalloc         : do not trace memory (less overhead, no peak memory)
+--json <value>           : also write the results to this file
+--seed <value>           : random seed (default: 1)
+-h                       : print this help
+'''
+
+class VirtualClock:
+    """Shared virtual time in seconds
+
+    A waiter does not move the clock by itself: it registers the moment it waits for, then the clock jumps to
+    the earliest registered moment once the backend has been quiet for `quiet` real seconds (every worker is waiting).
+    So concurrent waits overlap the same way they do against AWS.
+    """
+    now_ = None
+    condition = None
+    waiting = None
+    quiet = None
+    idle = None
+    idle_mark = None
+
+    def __init__(self, quiet=0.01):
+        self.now_ = 0.0
+        self.condition = threading.Condition()
+        self.waiting = {}
+        self.quiet = quiet
+        self.idle = 0.0
+        self.idle_mark = 0.0
+        return
+
+    #
+    def now(self):
+        return self.now_
+
+    #
+    def advance(self, seconds):
+        with self.condition:
+            self.now_ += seconds
+            self.condition.notify_all()
+        return self.now_
+
+    #
+    def wait_until(self, moment, activity):
+        """Block until the virtual time reaches `moment`
+
+        Args:
+            activity: callable returning a counter of backend calls
+        """
+        key = object()
+        with self.condition:
+            self.waiting[key] = moment
+            try:
+                while (self.now_<moment):
+                    seen = activity()
+                    start = time.perf_counter()
+                    self.condition.wait(self.quiet)
+                    if (self.now_>=moment):
+                        break
+                    if (activity()==seen):
+                        # Real time spent while every worker was waiting is not compute time (overlapping waits counted once)
+                        end = time.perf_counter()
+                        self.idle += end-max(start, self.idle_mark)
+                        self.idle_mark = end
+                        self.now_ = max(self.now_, min(self.waiting.values()))
+                        self.condition.notify_all()
+            finally:
+                del self.waiting[key]
+        return self.now_
+
+class Backend:
+    """In-process AWS stand-in shared by all the fake clients
+    """
+    clock = None
+    latency = None
+    api_latency = None
+    jitter = None
+    random = None
+    calls = None
+    activity = None
+    stacks = None
+    regions = None
+    change_sets = None
+    drift_detections = None
+    objects = None
+    results = None
+    ids = None
+    lock = None
+
+    def __init__(self, clock, latency=60, jitter=0.2, seed=1, api_latency=0):
+        self.clock = clock
+        self.latency = latency
+        self.api_latency = api_latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.activity = 0
+        self.stacks = {}
+        self.regions = {}
+        self.change_sets = {}
+        self.drift_detections = {}
+        self.objects = {}
+        self.results = []
+        self.ids = itertools.count()
+        self.lock = threading.RLock()
+        return
+
+    #
+    def count(self, service, operation):
+        with self.lock:
+            self.calls['{}.{}'.format(service, operation)] += 1
+            self.activity += 1
+        return
+
+    #
+    def duration(self):
+        with self.lock:
+            return self.latency*(1+self.random.uniform(-self.jitter, self.jitter))
+
+    #
+    def stacks_of(self, region):
+        """Stacks of a region, `stacks` for the default one
+        """
+        if (not region) or (region==DEFAULT_REGION):
+            return self.stacks
+        with self.lock:
+            return self.regions.setdefault(region, {})
+
+    #
+    def all_stacks(self):
+        with self.lock:
+            return list(self.stacks.values())+[stack for stacks in self.regions.values() for stack in stacks.values()]
+
+    #
+    def client(self, service, *args):
+        """Client factory of the engines: IDEL (service, region), IDES (service, profile, region)
+        """
+        fakes = {
+            'cloudformation': FakeCloudFormation,
+            'codepipeline': FakeCodePipeline,
+            'secretsmanager': FakeSecretsManager,
+            's3': FakeS3
+        }
+        return fakes.get(service, FakeClient)(self, service, args[-1] if (args) else None)
+
+class FakeClient:
+    """Any other service (`aws` blocks): every operation succeeds immediately
+    """
+    backend = None
+    service = None
+    region = None
+    meta = None
+
+    def __init__(self, backend, service, region=None):
+        self.backend = backend
+        self.service = service
+        self.region = region or DEFAULT_REGION
+        self.meta = types.SimpleNamespace(region_name=self.region)
+        return
+
+    #
+    def __getattr__(self, operation):
+        if (operation.startswith('__')):
+            raise AttributeError(operation)
+        def call(**kwargs):
+            self.backend.count(self.service, operation)
+            if (self.backend.api_latency):
+                self.backend.clock.wait_until(self.backend.clock.now()+self.backend.api_latency, lambda: self.backend.activity)
+            return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        return call
+
+    #
+    def can_paginate(self, operation):
+        return True
+
+    #
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+class FakePaginator:
+    client = None
+    operation = None
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+        return
+
+    #
+    def paginate(self, **kwargs):
+        yield getattr(self.client, self.operation)(**kwargs)
+
+class FakeCloudFormation(FakeClient):
+    #
+    @property
+    def stacks(self):
+        return self.backend.stacks_of(self.region)
+
+    #
+    def refresh(self, stack):
+        if (stack['StackStatus'].endswith('_IN_PROGRESS')) and (self.backend.clock.now()>=stack['ReadyAt']):
+            stack['StackStatus'] = stack['FinalStatus']
+        return stack
+
+    #
+    def find(self, name, operation):
+        with self.backend.lock:
+            stack = self.stacks.get(name)
+            if (stack is None):
+                for candidate in self.stacks.values():
+                    if (candidate['StackId']==name):
+                        stack = candidate
+                        break
+            if (stack is None) or ((stack['StackStatus']=='DELETE_COMPLETE') and (stack['StackId']!=name)):
+                raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Stack with id {} does not exist'.format(name)}}, operation)
+            return self.refresh(stack)
+
+    #
+    def describe(self, stack):
+        described = {key: value for key, value in stack.items() if (key not in ['ReadyAt', 'FinalStatus', 'Content'])}
+        # Output `Name` of the benchmark templates
+        if (stack['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']):
+            described['Outputs'] = [
+                {'OutputKey': 'Name', 'OutputValue': parameter['ParameterValue']}
+                for parameter in stack.get('Parameters', []) if (parameter['ParameterKey']=='Name')
+            ]
+        return described
+
+    #
+    def describe_stacks(self, StackName=None, NextToken=None):
+        self.backend.count(self.service, 'describe_stacks')
+        if (StackName):
+            return {'Stacks': [self.describe(self.find(StackName, 'DescribeStacks'))]}
+        with self.backend.lock:
+            stacks = [self.describe(self.refresh(stack)) for stack in self.stacks.values() if (stack['StackStatus']!='DELETE_COMPLETE')]
+        return {'Stacks': stacks}
+
+    #
+    def start(self, stack, status):
+        stack['StackStatus'] = status
+        stack['FinalStatus'] = status.replace('_IN_PROGRESS', '_COMPLETE')
+        stack['ReadyAt'] = self.backend.clock.now()+self.backend.duration()
+        return stack
+
+    #
+    def content(self, kwargs):
+        return json.dumps([kwargs.get('TemplateBody'), kwargs.get('TemplateURL'), kwargs.get('Parameters'), kwargs.get('Tags')], sort_keys=True, default=str)
+
+    #
+    def create_stack(self, **kwargs):
+        self.backend.count(self.service, 'create_stack')
+        with self.backend.lock:
+            existing = self.stacks.get(kwargs['StackName'])
+            if (existing) and (existing['StackStatus']!='DELETE_COMPLETE'):
+                raise ClientError({'Error': {'Code': 'AlreadyExistsException', 'Message': 'Stack [{}] already exists'.format(kwargs['StackName'])}}, 'CreateStack')
+            stack = {
+                'StackName': kwargs['StackName'],
+                'StackId': 'arn:aws:cloudformation:{}:111111111111:stack/{}/{}'.format(self.region, kwargs['StackName'], next(self.backend.ids)),
+                'Parameters': kwargs.get('Parameters', []),
+                'Tags': kwargs.get('Tags', []),
+                'Outputs': [{'OutputKey': 'Name', 'OutputValue': kwargs['StackName']}],
+                'Content': self.content(kwargs)
+            }
+            self.stacks[kwargs['StackName']] = self.start(stack, 'CREATE_IN_PROGRESS')
+        return {'StackId': stack['StackId']}
+
+    #
+    def update_stack(self, **kwargs):
+        self.backend.count(self.service, 'update_stack')
+        stack = self.find(kwargs['StackName'], 'UpdateStack')
+        with self.backend.lock:
+            if (stack['Content']==self.content(kwargs)):
+                raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'No updates are to be performed.'}}, 'UpdateStack')
+            stack['Content'] = self.content(kwargs)
+            stack['Parameters'] = kwargs.get('Parameters', [])
+            stack['Tags'] = kwargs.get('Tags', [])
+            self.start(stack, 'UPDATE_IN_PROGRESS')
+        return {'StackId': stack['StackId']}
+
+    #
+    def delete_stack(self, StackName, **kwargs):
+        self.backend.count(self.service, 'delete_stack')
+        try:
+            stack = self.find(StackName, 'DeleteStack')
+        except ClientError:
+            return {}
+        with self.backend.lock:
+            if (stack['StackStatus']!='DELETE_COMPLETE'):
+                self.start(stack, 'DELETE_IN_PROGRESS')
+        return {}
+
+    #
+    def create_change_set(self, **kwargs):
+        self.backend.count(self.service, 'create_change_set')
+        with self.backend.lock:
+            stack = self.stacks.get(kwargs['StackName'])
+            if (kwargs.get('ChangeSetType', 'UPDATE')=='CREATE') or (stack is None) or (stack['StackStatus']=='DELETE_COMPLETE'):
+                stack = {
+                    'StackName': kwargs['StackName'],
+                    'StackId': 'arn:aws:cloudformation:{}:111111111111:stack/{}/{}'.format(self.region, kwargs['StackName'], next(self.backend.ids)),
+                    'StackStatus': 'REVIEW_IN_PROGRESS',
+                    'Parameters': [],
+                    'Tags': [],
+                    'Outputs': [{'OutputKey': 'Name', 'OutputValue': kwargs['StackName']}],
+                    'Content': None,
+                    'ReadyAt': 0,
+                    'FinalStatus': 'REVIEW_IN_PROGRESS'
+                }
+                self.stacks[kwargs['StackName']] = stack
+            change_set_id = 'arn:aws:cloudformation:{}:111111111111:changeSet/{}/{}'.format(self.region, kwargs['ChangeSetName'], next(self.backend.ids))
+            empty = (stack['Content']==self.content(kwargs))
+            self.backend.change_sets[change_set_id] = {
+                'ChangeSetId': change_set_id,
+                'ChangeSetName': kwargs['ChangeSetName'],
+                'StackName': kwargs['StackName'],
+                'StackId': stack['StackId'],
+                'ChangeSetType': kwargs.get('ChangeSetType', 'UPDATE'),
+                'Status': 'FAILED' if (empty) else 'CREATE_COMPLETE',
+                'ExecutionStatus': 'UNAVAILABLE' if (empty) else 'AVAILABLE',
+                'StatusReason': 'The submitted information didn\'t contain changes. Submit different information to create a change set.' if (empty) else '',
+                'Changes': [] if (empty) else [{'Type': 'Resource', 'ResourceChange': {'Action': 'Modify' if (stack['Content']) else 'Add', 'ResourceType': 'AWS::SSM::Parameter', 'LogicalResourceId': 'Resource'}}],
+                'Request': kwargs
+            }
+        return {'Id': change_set_id, 'StackId': stack['StackId']}
+
+    #
+    def describe_change_set(self, ChangeSetName, StackName=None, **kwargs):
+        self.backend.count(self.service, 'describe_change_set')
+        with self.backend.lock:
+            change_set = self.backend.change_sets.get(ChangeSetName)
+            if (change_set is None):
+                for candidate in self.backend.change_sets.values():
+                    if (candidate['ChangeSetName']==ChangeSetName) and (candidate['StackName']==StackName):
+                        change_set = candidate
+            if (change_set is None):
+                raise ClientError({'Error': {'Code': 'ChangeSetNotFound', 'Message': 'ChangeSet [{}] does not exist'.format(ChangeSetName)}}, 'DescribeChangeSet')
+            return {key: value for key, value in change_set.items() if (key!='Request')}
+
+    #
+    def execute_change_set(self, ChangeSetName, StackName=None, **kwargs):
+        self.backend.count(self.service, 'execute_change_set')
+        change_set = self.describe_change_set(ChangeSetName, StackName)
+        with self.backend.lock:
+            request = self.backend.change_sets.pop(change_set['ChangeSetId'])['Request']
+            stack = self.stacks[change_set['StackName']]
+            stack['Content'] = self.content(request)
+            stack['Parameters'] = request.get('Parameters', [])
+            stack['Tags'] = request.get('Tags', [])
+            self.start(stack, 'CREATE_IN_PROGRESS' if (change_set['ChangeSetType']=='CREATE') else 'UPDATE_IN_PROGRESS')
+        return {}
+
+    #
+    def delete_change_set(self, ChangeSetName, StackName=None, **kwargs):
+        self.backend.count(self.service, 'delete_change_set')
+        with self.backend.lock:
+            self.backend.change_sets.pop(ChangeSetName, None)
+        return {}
+
+    #
+    def detect_stack_drift(self, StackName, **kwargs):
+        """Detections take a quarter of the stack latency. Stacks are always in sync.
+        """
+        self.backend.count(self.service, 'detect_stack_drift')
+        stack = self.find(StackName, 'DetectStackDrift')
+        with self.backend.lock:
+            detection_id = 'drift-{}'.format(next(self.backend.ids))
+            self.backend.drift_detections[detection_id] = {'StackId': stack['StackId'], 'ReadyAt': self.backend.clock.now()+self.backend.latency/4}
+        return {'StackDriftDetectionId': detection_id}
+
+    #
+    def describe_stack_drift_detection_status(self, StackDriftDetectionId):
+        self.backend.count(self.service, 'describe_stack_drift_detection_status')
+        with self.backend.lock:
+            detection = self.backend.drift_detections[StackDriftDetectionId]
+        if (self.backend.clock.now()<detection['ReadyAt']):
+            return {'StackId': detection['StackId'], 'StackDriftDetectionId': StackDriftDetectionId, 'DetectionStatus': 'DETECTION_IN_PROGRESS'}
+        return {'StackId': detection['StackId'], 'StackDriftDetectionId': StackDriftDetectionId, 'DetectionStatus': 'DETECTION_COMPLETE', 'StackDriftStatus': 'IN_SYNC', 'DriftedStackResourceCount': 0}
+
+    #
+    def get_waiter(self, name):
+        return FakeWaiter(self, name)
+
+class FakeWaiter:
+    client = None
+    name = None
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        return
+
+    #
+    def wait(self, StackName=None, ChangeSetName=None, WaiterConfig=None, **kwargs):
+        self.client.backend.count(self.client.service, 'waiter.{}'.format(self.name))
+        if (ChangeSetName):
+            change_set = self.client.describe_change_set(ChangeSetName, StackName)
+            if (change_set['Status']!='CREATE_COMPLETE'):
+                raise WaiterError(self.name, 'Waiter encountered a terminal failure state', change_set)
+            return
+
+        config = WaiterConfig or {}
+        timeout = config.get('Delay', 30)*config.get('MaxAttempts', 120)
+        try:
+            stack = self.client.find(StackName, 'DescribeStacks')
+        except ClientError as e:
+            if (self.name=='stack_delete_complete'):
+                return
+            raise WaiterError(self.name, 'Waiter encountered a terminal failure state', e.response)
+
+        clock = self.client.backend.clock
+        if (stack['StackStatus'].endswith('_IN_PROGRESS')):
+            clock.wait_until(min(stack['ReadyAt'], clock.now()+timeout), lambda: self.client.backend.activity)
+            self.client.refresh(stack)
+        desired = WAITER_TARGETS.get(self.name)
+        if (desired) and (stack['StackStatus']!=desired):
+            raise WaiterError(self.name, 'Max attempts exceeded', {'Stacks': [self.client.describe(stack)]})
+        return
+
+class FakeCodePipeline(FakeClient):
+    #
+    def put_job_success_result(self, jobId, continuationToken=None, **kwargs):
+        self.backend.count(self.service, 'put_job_success_result')
+        self.backend.results.append(('success', continuationToken))
+        return {}
+
+    #
+    def put_job_failure_result(self, jobId, failureDetails, **kwargs):
+        self.backend.count(self.service, 'put_job_failure_result')
+        self.backend.results.append(('failure', failureDetails))
+        return {}
+
+class FakeSecretsManager(FakeClient):
+    #
+    def get_secret_value(self, SecretId, **kwargs):
+        self.backend.count(self.service, 'get_secret_value')
+        return {'SecretString': json.dumps({
+            'ACCOUNT_NUMBER': '111111111111',
+            'ACCESS_KEY_ID': 'AKIABENCHMARK',
+            'SECRET_ACCESS_KEY': 'benchmark',
+            'REGION': DEFAULT_REGION
+        })}
+
+class FakeS3(FakeClient):
+    #
+    def get_data(self, Bucket, Key, operation):
+        with self.backend.lock:
+            if ((Bucket, Key) not in self.backend.objects):
+                raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, operation)
+            return self.backend.objects[(Bucket, Key)]
+
+    #
+    def head_object(self, Bucket, Key, **kwargs):
+        self.backend.count(self.service, 'head_object')
+        data = self.get_data(Bucket, Key, 'HeadObject')
+        return {'ETag': '"{}"'.format(hash_bytes(data)), 'ContentLength': len(data)}
+
+    #
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.backend.count(self.service, 'get_object')
+        data = self.get_data(Bucket, Key, 'GetObject')
+        if (Range):
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end)+1]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ETag': '"{}"'.format(hash_bytes(data)), 'ContentLength': len(data)}
+
+    #
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self.backend.count(self.service, 'put_object')
+        data = Body.read() if (hasattr(Body, 'read')) else Body
+        if (isinstance(data, str)):
+            data = data.encode('utf-8')
+        with self.backend.lock:
+            self.backend.objects[(Bucket, Key)] = data
+        return {'ETag': '"{}"'.format(hash_bytes(data))}
+
+    #
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.backend.count(self.service, 'delete_object')
+        with self.backend.lock:
+            self.backend.objects.pop((Bucket, Key), None)
+        return {}
+
+    #
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.backend.count(self.service, 'download_file')
+        with open(Filename, 'wb') as file:
+            file.write(self.get_data(Bucket, Key, 'GetObject'))
+        return
+
+class FakeLambdaContext:
+    """Remaining time = timeout - virtual time spent waiting - real compute time
+    """
+    clock = None
+    timeout = None
+    virtual_start = None
+    real_start = None
+    idle_start = None
+
+    def __init__(self, clock, timeout):
+        self.clock = clock
+        self.timeout = timeout
+        self.virtual_start = clock.now()
+        self.real_start = time.perf_counter()
+        self.idle_start = clock.idle
+        return
+
+    #
+    def compute(self):
+        return (time.perf_counter()-self.real_start)-(self.clock.idle-self.idle_start)
+
+    #
+    def get_remaining_time_in_millis(self):
+        elapsed = (self.clock.now()-self.virtual_start)+self.compute()
+        return int(max(0, self.timeout-elapsed)*1000)
+
+def hash_bytes(data):
+    import hashlib
+    return hashlib.md5(data).hexdigest()
+
+# Library: synthetic IaC repositories
+def generate_template(index, size_kb):
+    """A CloudFormation template of about `size_kb` KB
+    """
+    lines = [
+        'AWSTemplateFormatVersion: \'2010-09-09\'',
+        'Description: Benchmark template #{}'.format(index),
+        'Parameters:',
+        '  Name:',
+        '    Type: String',
+        '  Upstream:',
+        '    Type: String',
+        '    Default: \'\'',
+        'Resources:'
+    ]
+    size = sum(len(line)+1 for line in lines)
+    resource = 0
+    while (size<size_kb*1024) or (0==resource):
+        block = [
+            '  Topic{}:'.format(resource),
+            '    Type: AWS::SNS::Topic',
+            '    Properties:',
+            '      TopicName: !Sub \'${{Name}}-{}-{}\''.format(index, resource),
+            '      Tags:',
+            '        - Key: Benchmark',
+            '          Value: \'{}\''.format('x'*64)
+        ]
+        lines.extend(block)
+        size += sum(len(line)+1 for line in block)
+        resource += 1
+    lines.extend([
+        'Outputs:',
+        '  Name:',
+        '    Value: !Ref Name'
+    ])
+    return '\n'.join(lines)+'\n'
+
+def target_regions(targets):
+    """Regions of the `--targets` option, the default region first
+    """
+    return [DEFAULT_REGION]+['bench-{:02d}'.format(i) for i in range(1, targets)] if (targets) else []
+
+def generate_repository(blocks, mode='provision', template_kb=4, templates=10, wave_width=1, targets=0, object='cfn', refs=False):
+    """Files of a synthetic IaC repository: name -> content
+    """
+    files = {}
+    for index in range(templates):
+        files['{}/T{:03d}.tpl.yaml'.format(TEMPLATE_DIR, index)] = generate_template(index, template_kb)
+
+    lines = []
+    for i in range(blocks):
+        if (object=='aws'):
+            lines.extend([
+                '  - Object: \'aws\'',
+                '    Conditions: [\'provision\',\'destroy\',\'on\',\'off\']',
+                '    Service: \'ec2\'',
+                '    Action: \'stop_instances\'',
+                '    Params:',
+                '      InstanceIds: [\'i-{:017x}\']'.format(i)
+            ])
+            continue
+        lines.extend([
+            '  - Object: \'cfn\'',
+            '    Stack: \'Bench-{:05d}\''.format(i),
+            '    Template: \'{}/T{:03d}.tpl.yaml\''.format(TEMPLATE_DIR, i%templates),
+            '    Params:',
+            '      Name: \'bench-{:05d}\''.format(i)
+        ])
+        if (refs) and (i>=wave_width):
+            lines.append('      Upstream: \'${{Bench-{:05d}.Name}}\''.format((i//wave_width-1)*wave_width))
+        if (wave_width>1):
+            lines.append('    Wave: {}'.format(i//wave_width))
+        if (targets):
+            lines.append('    Targets:')
+            lines.extend('      - Region: \'{}\''.format(region) for region in target_regions(targets))
+        if (mode=='change'):
+            lines.append('    Action: \'deploy\'')
+
+    if (mode=='change'):
+        files['.changes.yaml'] = 'Description: Benchmark\nMode: \'change\'\nChanges:\n'+'\n'.join(lines)+'\n'
+    else:
+        files['.changes.yaml'] = 'Description: Benchmark\nMode: \'{}\'\n'.format(mode)
+        files['.inventory.yaml'] = 'Description: Benchmark\nInventory:\n'+'\n'.join(lines)+'\n'
+    return files
+
+def zip_repository(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+def write_repository(files, path):
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+        with open(os.path.join(path, name), 'w', encoding='utf-8') as file:
+            file.write(content)
+    return path
+
+def seed_stacks(backend, blocks, files=None, unchanged=0.0, templates=10, targets=0, missing=0.0):
+    """Existing stacks, so that `destroy` has something to delete
+
+    The first `unchanged` ratio of the stacks are deployed from `files` already (no-op deployments).
+    The last `missing` ratio of the stacks do not exist yet.
+    """
+    for region in target_regions(targets) or [None]:
+        client = FakeCloudFormation(backend, 'cloudformation', region)
+        for i in range(blocks):
+            if (i>=blocks-int(blocks*missing)):
+                continue
+            if (files) and (i<int(blocks*unchanged)):
+                client.create_stack(
+                    StackName='Bench-{:05d}'.format(i),
+                    TemplateBody=files['{}/T{:03d}.tpl.yaml'.format(TEMPLATE_DIR, i%templates)],
+                    Parameters=[{'ParameterKey': 'Name', 'ParameterValue': 'bench-{:05d}'.format(i)}],
+                    Tags=[]
+                )
+            else:
+                client.create_stack(StackName='Bench-{:05d}'.format(i), TemplateBody='seed')
+    for stack in backend.all_stacks():
+        stack['StackStatus'] = 'CREATE_COMPLETE'
+    backend.calls.clear()
+    return
+
+# Library: engines
+def setup_environment(options, work_dir):
+    """IDEL reads its configuration from environment variables at import. Values already set are kept.
+    """
+    defaults = {
+        'LOGGING_LEVEL': 'WARNING',
+        'CHANGES_FILE': '.changes.yaml',
+        'SECRET_NAME': SECRET_NAME,
+        'WAITING_OCCURRENCE': '1000000',
+        'CFN_WAITER_CONFIG': '{"Delay": 5, "MaxAttempts": 120}',
+        'CFN_WAIT_MODE': options['wait_mode'],
+        'MAX_PARALLEL_BLOCKS': str(options['jobs']),
+        'PLAN_STORE': 's3://idebench-plans/{}'.format(os.path.basename(work_dir)) if (options['plan_store']=='s3') else os.path.join(work_dir, 'plans', ''),
+        'STARTUP_PROFILE': 'false'
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    for path in [CORE_DIR, LAMBDA_DIR, STANDALONE_DIR]:
+        if (path not in sys.path):
+            sys.path.insert(0, path)
+    return
+
+def run_idel(options, backend, files, execution_id):
+    """Invoke IdelIaC.process() round after round until CodePipeline gets a final result
+    """
+    import idel_main
+    import idel_cache
+    import idel_clients
+    import idel_polling
+    idel_clients.set_client_factory(backend.client)
+    clock = backend.clock
+    idel_polling.clock = clock.now
+    idel_polling.sleep = lambda seconds: clock.wait_until(clock.now()+seconds, lambda: backend.activity)
+
+    backend.objects[(ARTIFACT_BUCKET, ARTIFACT_KEY)] = zip_repository(files)
+    token = None
+    rounds = 0
+    gb_seconds = 0.0
+    compute = 0.0
+    token_size = 0
+    status = 'timeout'
+    while (rounds<options['max_rounds']):
+        rounds += 1
+        if (options['cold']):
+            for cache in vars(idel_cache).values():
+                if (isinstance(cache, idel_cache.IdelWarmCache)):
+                    cache.clear()
+            idel_clients.set_client_factory(backend.client)
+
+        context = FakeLambdaContext(clock, options['timeout'])
+        idel_main.IdelIaC(lambda_event(execution_id, token), context).process()
+        real = context.compute()
+        duration = (clock.now()-context.virtual_start)+real
+        clock.advance(real)
+        compute += real
+        gb_seconds += duration*options['memory']/1024
+
+        kind, token = backend.results[-1]
+        if ('failure'==kind):
+            status = 'failure: {}'.format(token.get('message') if (isinstance(token, dict)) else token)
+            break
+        if (token is None):
+            status = 'success'
+            break
+        token_size = max(token_size, len(token))
+        clock.advance(options['round_interval'])
+
+    idel_clients.set_client_factory(None)
+    idel_polling.clock = time.time
+    idel_polling.sleep = time.sleep
+    return {'Rounds': rounds, 'Status': status, 'ComputeSeconds': compute, 'GBSeconds': gb_seconds, 'MaxTokenSize': token_size}
+
+def lambda_event(execution_id, token=None):
+    data = {
+        'actionConfiguration': {'configuration': {'UserParameters': json.dumps({'Pipeline': {'ExecutionId': execution_id}})}},
+        'inputArtifacts': [{'location': {'s3Location': {'bucketName': ARTIFACT_BUCKET, 'objectKey': ARTIFACT_KEY}}}],
+        'artifactCredentials': {'accessKeyId': 'AKIABENCHMARK', 'secretAccessKey': 'benchmark', 'sessionToken': 'benchmark'}
+    }
+    if (token):
+        data['continuationToken'] = token
+    return {'CodePipeline.job': {'id': 'job-{}'.format(execution_id), 'data': data}}
+
+def run_ides(options, backend, files, work_dir):
+    """Run ides.main() on a local copy of the repository
+    """
+    import ides
+    ides.LOGGING_LEVEL = os.environ['LOGGING_LEVEL']
+    logging.getLogger().setLevel(os.environ['LOGGING_LEVEL'])
+    ides.client_factory = backend.client
+    ides.clients.clear()
+    ides.stagings.clear()
+
+    repo_path = write_repository(files, os.path.join(work_dir, 'repository'))
+    argv = sys.argv
+    sys.argv = ['ides.py', '-p', repo_path, '-j', str(options['jobs'])]
+    real_start = time.perf_counter()
+    idle_start = backend.clock.idle
+    status = 'success'
+    try:
+        ides.main()
+    except SystemExit as e:
+        if (e.code):
+            status = 'failure: exit code {}'.format(e.code)
+    finally:
+        sys.argv = argv
+    real = (time.perf_counter()-real_start)-(backend.clock.idle-idle_start)
+    backend.clock.advance(real)
+
+    ides.client_factory = None
+    ides.clients.clear()
+    ides.stagings.clear()
+    return {'Rounds': None, 'Status': status, 'ComputeSeconds': real, 'GBSeconds': None, 'MaxTokenSize': None}
+
+def run_scenario(options, engine, blocks, sequence):
+    work_dir = tempfile.mkdtemp(prefix='idebench-')
+    try:
+        setup_environment(options, work_dir)
+        files = generate_repository(blocks, options['mode'], options['template_kb'], options['templates'], options['wave_width'], options['targets'], options['object'], options['refs'])
+        if (engine==ENGINE_IDEL):
+            # Duration history of this scenario only
+            import idel_polling
+            idel_polling.DURATION_HISTORY_STORE = os.path.join(work_dir, 'history', '')
+            if (options['warm_history']):
+                backend = Backend(VirtualClock(), options['latency'], options['jitter'], options['seed']+1, options['api_latency'])
+                if (options['mode']=='destroy') or (options['unchanged']):
+                    seed_stacks(backend, blocks, files, options['unchanged'], options['templates'], options['targets'], options['missing'])
+                run_idel(options, backend, files, 'idebench-{}-{}-{}-warmup'.format(os.getpid(), sequence, blocks))
+
+        backend = Backend(VirtualClock(), options['latency'], options['jitter'], options['seed'], options['api_latency'])
+        if (options['mode']=='destroy') or (options['unchanged']):
+            seed_stacks(backend, blocks, files, options['unchanged'], options['templates'], options['targets'], options['missing'])
+
+        if (options['tracemalloc']):
+            tracemalloc.start()
+        if (engine==ENGINE_IDEL):
+            result = run_idel(options, backend, files, 'idebench-{}-{}-{}'.format(os.getpid(), sequence, blocks))
+        else:
+            result = run_ides(options, backend, files, work_dir)
+        peak = None
+        if (options['tracemalloc']):
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        result.update({
+            'Engine': engine,
+            'Blocks': blocks,
+            'WallSeconds': backend.clock.now(),
+            'ApiCalls': sum(backend.calls.values()),
+            'ApiCallsByOperation': dict(backend.calls.most_common()),
+            'PeakMemoryMB': None if (peak is None) else peak/1024/1024
+        })
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Library: Get parameters
+def get_params(argv):
+    params = {
+        'engines': [ENGINE_IDEL, ENGINE_IDES],
+        'blocks': [10, 100, 1000],
+        'mode': 'provision',
+        'template_kb': 4,
+        'templates': 10,
+        'wave_width': 1,
+        'targets': 0,
+        'object': 'cfn',
+        'api_latency': 0.0,
+        'refs': False,
+        'latency': 60.0,
+        'jitter': 0.2,
+        'wait_mode': 'block',
+        'plan_store': 'local',
+        'jobs': 10,
+        'round_interval': 30.0,
+        'timeout': 900.0,
+        'memory': 512,
+        'cold': False,
+        'warm_history': False,
+        'unchanged': 0.0,
+        'missing': 0.0,
+        'tracemalloc': True,
+        'json': None,
+        'seed': 1,
+        'max_rounds': 100000
+    }
+    long_options = ['engine=', 'blocks=', 'mode=', 'template-kb=', 'templates=', 'wave-width=', 'targets=', 'object=', 'api-latency=', 'refs', 'latency=', 'jitter=',
+        'wait-mode=', 'plan-store=', 'unchanged=', 'missing=', 'jobs=', 'round-interval=', 'timeout=', 'memory=', 'cold', 'warm-history', 'no-tracemalloc', 'json=', 'seed=']
+    try:
+        opts, args = getopt.getopt(argv, 'h', long_options)
+        for opt, arg in opts:
+            if (opt=='-h'):
+                print(command_help)
+                sys.exit()
+            elif (opt=='--engine'):
+                params['engines'] = [ENGINE_IDEL, ENGINE_IDES] if (arg=='all') else [arg]
+            elif (opt=='--blocks'):
+                params['blocks'] = [int(value) for value in arg.split(',')]
+            elif (opt in ['--mode', '--wait-mode', '--plan-store', '--object', '--json']):
+                params[opt[2:].replace('-', '_')] = arg
+            elif (opt in ['--template-kb', '--templates', '--wave-width', '--targets', '--jobs', '--memory', '--seed']):
+                params[opt[2:].replace('-', '_')] = int(arg)
+            elif (opt in ['--latency', '--api-latency', '--jitter', '--round-interval', '--timeout', '--unchanged', '--missing']):
+                params[opt[2:].replace('-', '_')] = float(arg)
+            elif (opt=='--refs'):
+                params['refs'] = True
+            elif (opt=='--cold'):
+                params['cold'] = True
+            elif (opt=='--warm-history'):
+                params['warm_history'] = True
+            elif (opt=='--no-tracemalloc'):
+                params['tracemalloc'] = False
+    except (getopt.GetoptError, ValueError):
+        print(command_help)
+        sys.exit(2)
+    return params
+
+def format_results(results):
+    header = ['Engine', 'Blocks', 'Status', 'Rounds', 'Wall (s)', 'Compute (s)', 'API calls', 'Peak (MB)', 'GB-s', 'Token']
+    rows = [header]
+    for result in results:
+        rows.append([
+            result['Engine'],
+            str(result['Blocks']),
+            result['Status'],
+            '-' if (result['Rounds'] is None) else str(result['Rounds']),
+            '{:.0f}'.format(result['WallSeconds']),
+            '{:.2f}'.format(result['ComputeSeconds']),
+            str(result['ApiCalls']),
+            '-' if (result['PeakMemoryMB'] is None) else '{:.1f}'.format(result['PeakMemoryMB']),
+            '-' if (result['GBSeconds'] is None) else '{:.1f}'.format(result['GBSeconds']),
+            '-' if (result['MaxTokenSize'] is None) else str(result['MaxTokenSize'])
+        ])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(value.ljust(widths[i]) for i, value in enumerate(row)) for row in rows)
+
+def main():
+    params = get_params(sys.argv[1:])
+    print('{} version {}'.format(NAME, VERSION))
+
+    results = []
+    sequence = itertools.count()
+    for blocks in params['blocks']:
+        for engine in params['engines']:
+            results.append(run_scenario(params, engine, blocks, next(sequence)))
+            print('{} {} blocks: {}'.format(engine, blocks, results[-1]['Status']), file=sys.stderr)
+
+    print(format_results(results))
+    if (params['json']):
+        with open(params['json'], 'w', encoding='utf-8') as file:
+            json.dump({'Parameters': params, 'Results': results}, file, indent=2, default=str)
+
+if __name__ == "__main__":
+    main()
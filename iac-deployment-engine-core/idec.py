@@ -0,0 +1,711 @@
+# idec.py
+"""IaC Deployment Engine Core (IDEC)
+
+Shared by IDEL (Lambda) and IDES (standalone):
+    - Change pipeline: load -> validate -> filter -> override -> resolve templates -> expand targets
+    - Planner: dependencies between decorated changes
+    - Template staging: templates uploaded to S3 once, for `TemplateURL`
+
+Steps of the change pipeline are generators, so a change flows through all of them
+before the next one is read, and a front end only pays for what it consumes.
+"""
+
+import os
+import re
+import hashlib
+import threading
+
+from idec_metrics import metrics
+
+# Constants
+STR_CFN = 'cfn'
+STR_AWS = 'aws'
+STR_DEPLOY = 'deploy'
+STR_DELETE = 'delete'
+# Consecutive `aws` blocks without `DependsOn`/`Wave` run concurrently (see IdecPlanner)
+AWS_BLOCK_BATCH = os.environ.get('AWS_BLOCK_BATCH', 'false').lower()=='true'
+# Implicit `Wave` of batched `aws` blocks. Not a YAML value, so it never matches a declared one.
+AWS_BATCH_WAVE = ('aws-batch',)
+# Values passed to each call of the `Then` action of an `aws` block
+AWS_CHAIN_BATCH_SIZE = 50
+# `${StackName.OutputKey}` in `Params` of `cfn` blocks: an output of another stack
+OUTPUT_REF_PATTERN = re.compile(r'\$\{([A-Za-z][A-Za-z0-9-]*)\.([A-Za-z0-9]+)\}')
+CHANGE_MODE_CHANGE = 'change'
+CHANGE_MODE_PROVISION = 'provision'
+CHANGE_MODE_DESTROY = 'destroy'
+CHANGE_MODE_ON = 'on'
+CHANGE_MODE_OFF = 'off'
+CHANGES_FILE = '.changes.yaml'
+INVENTORY_FILE = '.inventory.yaml'
+# Bigger templates can only be passed by `TemplateURL`
+CFN_TEMPLATE_BODY_MAX_SIZE = 51200
+S3_NOT_FOUND_CODES = ['404', 'NoSuchKey', 'NotFound']
+# Status reasons of FAILED change sets that only mean "nothing to deploy"
+CFN_EMPTY_CHANGE_SET_REASONS = ['The submitted information didn\'t contain changes', 'No updates are to be performed']
+
+class IdecDirectory:
+    """IaC repository on a local directory
+
+    Any object with the same methods can be a source of the change pipeline (Eg: IdelArtifact).
+    """
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        return
+
+    #
+    def exists(self, name):
+        return os.path.isfile(os.path.join(self.path, name))
+
+    #
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as file:
+            return file.read()
+
+    #
+    def read_text(self, name):
+        return self.read(name).decode('utf-8')
+
+class IdecTemplateStaging:
+    """Templates staged to S3, named by their content hash, for `TemplateURL`
+
+    A template is uploaded once: the object is not uploaded again if it exists already (HEAD),
+    and objects known to exist are not checked again for the life of this instance.
+    """
+    s3_client = None
+    bucket = None
+    prefix = None
+    region = None
+    known = None
+    locks = None
+    lock = None
+
+    def __init__(self, s3_client, location, region):
+        """
+        Args:
+            s3_client: boto3 S3 client of the account that deploys the stacks
+            location: `s3://<bucket>/<prefix>`
+            region: region of the bucket
+        """
+        self.s3_client = s3_client
+        self.bucket, _, self.prefix = location[len('s3://'):].partition('/') if (location.startswith('s3://')) else (location, None, '')
+        self.prefix = self.prefix.strip('/')
+        self.region = region
+        self.known = set()
+        self.locks = {}
+        self.lock = threading.Lock()
+        return
+
+    #
+    def key(self, digest):
+        return '/'.join([part for part in [self.prefix, '{}.template'.format(digest)] if (part)])
+
+    #
+    def url(self, key):
+        return 'https://{}.s3.{}.amazonaws.com/{}'.format(self.bucket, self.region, key)
+
+    #
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception as e:
+            if (getattr(e, 'response', {}).get('Error', {}).get('Code') in S3_NOT_FOUND_CODES):
+                return False
+            raise e
+
+    #
+    def stage(self, digest, read_template):
+        """Upload a template if needed
+
+        Args:
+            digest: SHA-256 of the template (Eg: `TemplateDigest`)
+            read_template: callable returning the template (str or bytes). Only called if the template is uploaded.
+
+        Returns:
+            URL of the template
+        """
+        key = self.key(digest)
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        # Blocks sharing a template upload it once
+        with key_lock:
+            if (key not in self.known):
+                if (not self.exists(key)):
+                    template = read_template()
+                    if (isinstance(template, str)):
+                        template = template.encode('utf-8')
+                    with metrics.timer('TemplateUpload', Key=key, Size=len(template)):
+                        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=template)
+                self.known.add(key)
+
+        return self.url(key)
+
+class IdecPlanner:
+    """Execution planner for decorated changes
+
+    Builds a DAG (Directed Acyclic Graph) of change blocks then answers which blocks are
+    ready to run given the blocks that are already completed or in-flight.
+
+    Dependency rules:
+        - Block declares `DependsOn`: depends on listed blocks only (matched against `Id` or `Stack`).
+          It leaves the sequential chain: the blocks after it do not wait for it either.
+        - Block declares `Wave`: consecutive blocks sharing the same `Wave` value form a group;
+          they run concurrently and depend on everything before the group.
+        - Otherwise: depends on the previous block/group. (Original design. Sequential.)
+        - With `batch_aws`, consecutive `aws` blocks of the latter kind form a group, as if they shared a `Wave`.
+        - A block referring to the outputs of a stack (`${StackName.OutputKey}`) also depends on the blocks of that stack.
+
+    In `destroy`/`off` modes, changes are reversed, so `DependsOn` edges are reversed as well:
+    a block must be deleted before the blocks it depends on.
+    """
+    changes = None
+    dependencies = None
+    dependents = None
+
+    def __init__(self, changes, reverse=False, batch_aws=AWS_BLOCK_BATCH):
+        self.changes = changes
+        self.build(reverse, batch_aws)
+        return
+
+    #
+    def build(self, reverse=False, batch_aws=False):
+        """Build dependencies (block -> set of blocks) and dependents (the reverse mapping)
+        """
+        self.dependencies = [set() for _ in self.changes]
+        self.dependents = [set() for _ in self.changes]
+
+        # Index blocks by reference name, and `cfn` blocks by target and stack name (for output references)
+        names = {}
+        stacks = {}
+        for i, change in enumerate(self.changes):
+            name = block_name(change)
+            if (name is not None):
+                names.setdefault(name, []).append(i)
+            if (change['Object']==STR_CFN) and (change.get('Stack')):
+                stacks.setdefault((target_key(change.get('Target')), str(change['Stack'])), []).append(i)
+
+        frontier = set()        # blocks that the next sequential block/group depends on
+        group = set()           # current `Wave` group
+        group_wave = None
+        group_frontier = set()  # frontier before the current `Wave` group
+        for i, change in enumerate(self.changes):
+            if ('DependsOn' in change):
+                for ref in as_list(change['DependsOn']):
+                    if (str(ref) not in names):
+                        raise Exception('Broken changes: block #{} depends on unknown block \'{}\'.'.format(i, ref))
+                    for j in names[str(ref)]:
+                        if (j==i):
+                            continue
+                        if (reverse):
+                            self.add_edge(j, i)
+                        else:
+                            self.add_edge(i, j)
+
+            # Outputs are read after their stacks are deployed. Deleted stacks have no outputs to wait for.
+            if (not reverse):
+                target = target_key(change.get('Target'))
+                for stack_name in sorted(set(stack for stack, _ in output_refs(change))):
+                    for j in stacks.get((target, stack_name), []):
+                        if (j!=i):
+                            self.add_edge(i, j)
+
+            if ('DependsOn' in change):
+                # Explicit blocks do not join the sequential chain
+                continue
+
+            wave = change.get('Wave')
+            grouped = ('Wave' in change)
+            if (not grouped) and (batch_aws) and (change['Object']==STR_AWS):
+                wave, grouped = AWS_BATCH_WAVE, True
+            if (grouped):
+                if (group) and (group_wave==wave):
+                    group.add(i)
+                else:
+                    if (group):
+                        frontier = set(group)
+                    group_wave = wave
+                    group_frontier = set(frontier)
+                    group = {i}
+                for j in group_frontier:
+                    self.add_edge(i, j)
+                continue
+
+            if (group):
+                frontier = set(group)
+                group = set()
+                group_wave = None
+            for j in frontier:
+                self.add_edge(i, j)
+            frontier = {i}
+
+        self.check_cycles()
+
+        return
+
+    #
+    def add_edge(self, block, depends_on):
+        """`block` can only run after `depends_on` is completed
+        """
+        self.dependencies[block].add(depends_on)
+        self.dependents[depends_on].add(block)
+        return
+
+    #
+    def check_cycles(self):
+        """Kahn's algorithm. Raise exception if the graph is not a DAG
+        """
+        in_degrees = [len(deps) for deps in self.dependencies]
+        queue = [i for i, degree in enumerate(in_degrees) if (0==degree)]
+        visited = 0
+        while (queue):
+            i = queue.pop()
+            visited += 1
+            for j in self.dependents[i]:
+                in_degrees[j] -= 1
+                if (0==in_degrees[j]):
+                    queue.append(j)
+
+        if (visited!=len(self.dependencies)):
+            cyclic = [i for i, degree in enumerate(in_degrees) if (degree>0)]
+            raise Exception('Broken changes: circular dependencies between blocks {}.'.format(cyclic))
+
+        return True
+
+    #
+    def ready_blocks(self, completed, in_flight):
+        """Blocks that are neither completed nor in-flight and whose dependencies are all completed
+
+        Args:
+            completed: set of completed block orders
+            in_flight: set of in-flight block orders
+
+        Returns:
+            Sorted list of block orders
+        """
+        ready = []
+        for i, deps in enumerate(self.dependencies):
+            if (i in completed) or (i in in_flight):
+                continue
+            if (deps.issubset(completed)):
+                ready.append(i)
+        return ready
+
+    #
+    def is_complete(self, completed):
+        return len(completed)>=len(self.dependencies)
+
+    #
+    def all_dependents(self, block):
+        """Blocks which depend on `block`, directly or not
+        """
+        found = set()
+        stack = [block]
+        while (stack):
+            for j in self.dependents[stack.pop()]:
+                if (j not in found):
+                    found.add(j)
+                    stack.append(j)
+        return found
+
+def block_name(change):
+    """Reference name of a block which is used by `DependsOn`
+    """
+    if ('Id' in change):
+        return str(change['Id'])
+    if ('Stack' in change):
+        return str(change['Stack'])
+    return None
+
+def as_list(value):
+    if (value is None):
+        return []
+    if (isinstance(value, (list, tuple, set))):
+        return list(value)
+    return [value]
+
+def load_yaml(raw_data):
+    """PyYAML is imported on first use (libyaml based loader if available)
+    """
+    import yaml
+    return yaml.load(raw_data, Loader=getattr(yaml, 'CLoader', yaml.Loader))
+
+def load_changes(source, changes_file=CHANGES_FILE):
+    """Load and validate the changes file, and the inventory if the mode requires it
+
+    Returns:
+        (data_changes, changes): the changes file and its blocks in execution order (not decorated yet)
+    """
+    raw_data_changes = source.read_text(changes_file)
+    with metrics.timer('YamlParse', File=changes_file):
+        data_changes = load_yaml(raw_data_changes)
+    validate_changes(data_changes)
+
+    change_mode = data_changes['Mode']
+    if (change_mode not in [CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
+        return data_changes, data_changes['Changes']
+
+    raw_data_inventory = source.read_text(INVENTORY_FILE)
+    with metrics.timer('YamlParse', File=INVENTORY_FILE):
+        data_inventory = load_yaml(raw_data_inventory)
+    validate_inventory(data_inventory)
+    changes = data_inventory['Inventory']
+    if (is_reverse_mode(change_mode)):
+        changes.reverse()
+    return data_changes, changes
+
+def filter_changes(change_mode, changes):
+    """Eliminate inappropriate objects
+    """
+    for change in changes:
+        if (not skip_object(change_mode, change)):
+            yield change
+
+def override_actions(change_mode, changes):
+    """`cfn` blocks: force `Action` property
+    """
+    for change in changes:
+        if (change['Object']==STR_CFN):
+            if ('Action' not in change):
+                change['Action'] = ''
+            change['Action'] = override_cfn_action(change_mode, change['Action'])
+        yield change
+
+def resolve_templates(source, changes, template_body=False):
+    """`cfn` blocks in modes: provision/change/on
+    The referred relative path template must exist. Its digest is kept, so a later read can be verified (get_template_body).
+    With `template_body`, the template is also loaded as string (Body).
+    """
+    for change in changes:
+        if (change['Object']==STR_CFN) and (change['Action']==STR_DEPLOY):
+            if (not source.exists(change['Template'])):
+                raise Exception('Template not found: {}'.format(change['Template']))
+            template = source.read(change['Template'])
+            change['TemplateDigest'] = sha256(template)
+            if (template_body):
+                change['TemplateBody'] = template.decode('utf-8')
+        yield change
+
+def expand_targets(changes):
+    """A block with `Targets` becomes one block per target (`Target`: {'Account', 'Region'}), Eg: a baseline for many accounts
+
+    Targets run concurrently: they form a `Wave` (the one of the block, if any).
+    With `TargetConcurrency: N`, they run N at a time: one `Wave` per N targets, each one after the other.
+    Blocks with `DependsOn` are not grouped in waves, so all of their targets run concurrently.
+    Expanded blocks keep the `Id`/`Stack` of the block, so `DependsOn` on it waits for all targets.
+    """
+    for position, change in enumerate(changes):
+        if ('Targets' not in change):
+            yield change
+            continue
+
+        targets = [normalize_target(target) for target in as_list(change['Targets'])]
+        if (not targets):
+            raise Exception('Broken changes: \'Targets\' of block \'{}\' is empty.'.format(block_name(change)))
+        size = int(change.get('TargetConcurrency') or 0) or len(targets)
+        for i, target in enumerate(targets):
+            expanded = {key: value for key, value in change.items() if (key not in ['Targets', 'TargetConcurrency'])}
+            expanded['Target'] = target
+            if ('DependsOn' not in change):
+                if (i<size) and ('Wave' in change):
+                    expanded['Wave'] = change['Wave']
+                else:
+                    expanded['Wave'] = 'targets-{}-{}'.format(position, i//size)
+            yield expanded
+
+def check_aws_chains(changes):
+    """`aws` blocks: `Then` needs the `Query` of the values to pass, and its `Action`/`Key`
+    """
+    for change in changes:
+        if (change['Object']==STR_AWS) and (change.get('Then')):
+            then = change['Then']
+            if (not change.get('Query')):
+                raise Exception('Broken changes: \'Then\' of block \'{}\' needs a \'Query\'.'.format(block_name(change) or change['Action']))
+            if (not isinstance(then, dict)) or (not then.get('Action')) or (not then.get('Key')):
+                raise Exception('Broken changes: \'Then\' of block \'{}\' needs \'Action\' and \'Key\'.'.format(block_name(change) or change['Action']))
+        yield change
+
+def normalize_target(target):
+    """Item of `Targets` -> {'Account': <12 digits>, 'Region': <region>}. Each one is optional: default is the one of the credential.
+    """
+    if (not isinstance(target, dict)) or (not set(target)) or (set(target)-set(['Account', 'Region'])):
+        raise Exception('Broken changes: invalid target {}. Expect a mapping of Account and/or Region.'.format(target))
+    normalized = {}
+    if (target.get('Account')):
+        normalized['Account'] = str(target['Account']).zfill(12)
+    if (target.get('Region')):
+        normalized['Region'] = str(target['Region'])
+    return normalized
+
+def target_key(target):
+    """Eg: `111111111111/eu-west-1`, `/us-east-1` (account of the credential). None without target.
+    """
+    if (not target):
+        return None
+    return '{}/{}'.format(target.get('Account', ''), target.get('Region', ''))
+
+def parse_target_key(key):
+    """Reverse of target_key()
+    """
+    account, _, region = key.partition('/')
+    target = {}
+    if (account):
+        target['Account'] = account
+    if (region):
+        target['Region'] = region
+    return target
+
+def decorate_changes(source, change_mode, changes, template_body=False):
+    """The whole decorator pipeline
+    """
+    return expand_targets(check_aws_chains(resolve_templates(source, override_actions(change_mode, filter_changes(change_mode, changes)), template_body)))
+
+def get_template_body(source, change):
+    """Convert the referred relative path template to string (Body) once
+    """
+    if ('TemplateBody' not in change):
+        template = source.read(change['Template'])
+        if ('TemplateDigest' in change) and (change['TemplateDigest']!=sha256(template)):
+            raise Exception('Template changed since the plan was compiled: {}'.format(change['Template']))
+        change['TemplateBody'] = template.decode('utf-8')
+    return change['TemplateBody']
+
+def is_reverse_mode(change_mode):
+    return change_mode in [CHANGE_MODE_DESTROY, CHANGE_MODE_OFF]
+
+def build_cfn_parameters(params):
+    """Convert `Params` of a `cfn` block (Mapping or Sequence format) to CloudFormation Parameters
+
+    Returns:
+        List of {'ParameterKey': ..., 'ParameterValue': ...} or None if the format is invalid
+    """
+    parameters = []
+    if (isinstance(params, dict)):
+        for key in params:
+            parameters.append({
+                'ParameterKey': str(key),
+                'ParameterValue': str(params[key])
+            })
+    elif (isinstance(params, list)):
+        for param in params:
+            parameters.append({
+                'ParameterKey': str(param['Name']),
+                'ParameterValue': str(param['Value'])
+            })
+    else:
+        return None
+    return parameters
+
+def find_output_refs(value):
+    """
+    Returns:
+        Set of (stack name, output key) referred to by `${StackName.OutputKey}` in a value (lists and mappings included)
+    """
+    refs = set()
+    if (isinstance(value, str)):
+        refs.update(OUTPUT_REF_PATTERN.findall(value))
+    elif (isinstance(value, dict)):
+        for item in value.values():
+            refs.update(find_output_refs(item))
+    elif (isinstance(value, list)):
+        for item in value:
+            refs.update(find_output_refs(item))
+    return refs
+
+def output_refs(change):
+    """Outputs referred to by the `Params` of a `cfn` block
+    """
+    if (change['Object']!=STR_CFN):
+        return set()
+    return find_output_refs(change.get('Params'))
+
+def resolve_output_refs(value, get_outputs):
+    """Replace `${StackName.OutputKey}` by the value of the output
+
+    Args:
+        get_outputs: function(stack name) -> {OutputKey: OutputValue}
+    """
+    if (isinstance(value, str)):
+        def replace(match):
+            outputs = get_outputs(match.group(1))
+            if (match.group(2) not in outputs):
+                raise Exception('Output \'{}\' of stack \'{}\' not found.'.format(match.group(2), match.group(1)))
+            return str(outputs[match.group(2)])
+        return OUTPUT_REF_PATTERN.sub(replace, value)
+    if (isinstance(value, dict)):
+        return {key: resolve_output_refs(item, get_outputs) for key, item in value.items()}
+    if (isinstance(value, list)):
+        return [resolve_output_refs(item, get_outputs) for item in value]
+    return value
+
+def stack_outputs(stack):
+    """Outputs of a stack (DescribeStacks) -> {OutputKey: OutputValue}. Empty for a missing stack.
+    """
+    return {output['OutputKey']: output['OutputValue'] for output in (stack or {}).get('Outputs', [])}
+
+def stream_aws_call(client, action, params, paginate=False, query=None):
+    """Results of an `aws` block as a generator, so pages are not held in memory together
+
+    Args:
+        paginate: go through all pages of the action (boto3 paginator) instead of the first one
+        query: JMESPath expression applied to each page/response. Its values are yielded one by one (lists are flattened).
+            Without query, pages/responses are yielded as they are.
+    """
+    expression = None
+    if (query):
+        # Bundled with botocore
+        import jmespath
+        expression = jmespath.compile(query)
+
+    if (paginate):
+        pages = client.get_paginator(action).paginate(**(params or {}))
+    else:
+        pages = [getattr(client, action)(**(params or {}))]
+
+    for page in pages:
+        if (expression is None):
+            yield page
+            continue
+        value = expression.search(page)
+        if (isinstance(value, list)):
+            yield from value
+        elif (value is not None):
+            yield value
+
+def iter_batches(values, size):
+    batch = []
+    for value in values:
+        batch.append(value)
+        if (len(batch)>=size):
+            yield batch
+            batch = []
+    if (batch):
+        yield batch
+
+def run_aws_chain(call, then, values):
+    """Pass the values of an `aws` block to its `Then` action in batches, Eg: stop the instances found by `describe_instances`
+
+    Args:
+        call: function(action, params) on the client of the block
+        then: {'Action', 'Key': parameter receiving a batch, 'Params': other parameters, 'BatchSize'}
+
+    Returns:
+        {'Count': <values passed>, 'Calls': <calls of the action>}
+    """
+    size = int(then.get('BatchSize') or AWS_CHAIN_BATCH_SIZE)
+    count = 0
+    calls = 0
+    for batch in iter_batches(values, size):
+        params = dict(then.get('Params') or {})
+        params[then['Key']] = batch
+        call(then['Action'], params)
+        count += len(batch)
+        calls += 1
+    return {
+        'Count': count,
+        'Calls': calls
+    }
+
+def is_empty_change_set(change_set):
+    """True if a change set (DescribeChangeSet) failed because there is nothing to deploy
+    """
+    reason = change_set.get('StatusReason') or ''
+    return (change_set.get('Status')=='FAILED') and any(empty_reason in reason for empty_reason in CFN_EMPTY_CHANGE_SET_REASONS)
+
+def summarize_resource_changes(changes):
+    """Compact `Changes` of a change set: [{'Action': 'Modify', 'Type': 'AWS::EC2::Subnet', 'Id': 'SubnetA', 'Replacement': 'True'}, ...]
+    """
+    summary = []
+    for change in changes:
+        resource_change = change.get('ResourceChange', {})
+        item = {
+            'Action': resource_change.get('Action'),
+            'Type': resource_change.get('ResourceType'),
+            'Id': resource_change.get('LogicalResourceId'),
+            'Replacement': resource_change.get('Replacement')
+        }
+        summary.append({key: value for key, value in item.items() if (value)})
+    return summary
+
+def sha256(data):
+    if (isinstance(data, str)):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def validate_changes(data_changes):
+    """
+    """
+    # Mode
+    if ('Mode' not in data_changes):
+        raise Exception('Broken changes file: Missing \'Mode\' item.')
+    elif (data_changes['Mode'] not in [CHANGE_MODE_CHANGE, CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
+        raise Exception('Broken changes file: \'Mode: {}\' not supported.'.format(data_changes['Mode']))
+    elif (data_changes['Mode']==CHANGE_MODE_CHANGE):
+        if ('Changes' not in data_changes):
+            raise Exception('Broken changes file: Missing \'Changes\' item.')
+        elif (0==len(data_changes['Changes'])):
+            raise Exception('Broken changes file: \'Changes\' item is empty.')
+    else:
+        pass
+
+    return True
+
+def validate_inventory(data_inventory):
+    """
+    """
+    # Inventory
+    if ('Inventory' not in data_inventory):
+        raise Exception('Broken inventory file: Missing \'Inventory\' item.')
+    elif (0==len(data_inventory['Inventory'])):
+        raise Exception('Broken inventory file: \'Inventory\' item is empty.')
+
+    return True
+
+def skip_object(change_mode, change):
+    """
+    If `Mode` is `change`: we do not care about the `Conditions`
+    Else:
+        If `cfn` objects:
+            - We can omit the `Conditions`, objects will be involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
+            - In case `Conditions` is declared, objects will be involed when `Mode` matches with `Conditions`.
+        If `aws` objects: we must declare `Conditions` and match with `Mode`, or else the engine will skip that Object/Block.
+
+    OR
+
+    If `Mode` is `change`: we do not care about the `Conditions`
+    Else:
+        If we omit the `Conditions`:
+            - Only `cfn` objects are involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
+            - Others will be skipped.
+        Else:
+            Objects will be involed when `Mode` matches with `Conditions`.
+
+    Return:
+        - `True` means skipped
+        - `False` means involved
+    """
+    if (change_mode!=CHANGE_MODE_CHANGE):
+        if ('Conditions' not in change):
+            if (change['Object']==STR_CFN) and (change_mode in [CHANGE_MODE_PROVISION,CHANGE_MODE_DESTROY]):
+                return False
+            return True
+        elif (change_mode not in change['Conditions']):
+            return True
+    return False
+
+def override_cfn_action(change_mode, original_action):
+    """
+    """
+    mappings = {
+        CHANGE_MODE_PROVISION: STR_DEPLOY,
+        CHANGE_MODE_DESTROY: STR_DELETE,
+        CHANGE_MODE_ON: STR_DEPLOY,
+        CHANGE_MODE_OFF: STR_DELETE
+    }
+
+    if (change_mode not in mappings):
+        return original_action
+
+    return mappings[change_mode]
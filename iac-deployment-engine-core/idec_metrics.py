@@ -0,0 +1,107 @@
+# idec_metrics.py
+"""Timing metrics of the engines as CloudWatch Embedded Metric Format (EMF) JSON lines
+
+Sinks (`METRICS_SINK`):
+    - `off`: nothing is emitted (default)
+    - `emf`: stdout. In Lambda, CloudWatch Logs extracts the metrics from the log lines.
+    - `file:<path>`: appended to a local file. Eg: IDES, benchmarks
+
+Metric names are the operations (Eg: `StackCreate`), dimensioned by `Engine` only.
+Stack names, block orders and the like are properties: they are searchable with Logs Insights
+without creating a metric per stack.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+METRICS_SINK = os.environ.get('METRICS_SINK', 'off')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'IaCDeploymentEngine')
+UNIT_MILLISECONDS = 'Milliseconds'
+UNIT_SECONDS = 'Seconds'
+UNIT_COUNT = 'Count'
+UNIT_BYTES = 'Bytes'
+SINK_OFF = 'off'
+SINK_EMF = 'emf'
+SINK_FILE = 'file:'
+
+class IdecMetrics:
+    sink = None
+    namespace = None
+    dimensions = None
+    properties = None
+    lock = None
+
+    def __init__(self, sink=METRICS_SINK, namespace=METRICS_NAMESPACE):
+        self.sink = sink
+        self.namespace = namespace
+        self.dimensions = {}
+        self.properties = {}
+        self.lock = threading.Lock()
+        return
+
+    #
+    def is_enabled(self):
+        return (self.sink) and (self.sink!=SINK_OFF)
+
+    #
+    def set_dimensions(self, **dimensions):
+        self.dimensions = dimensions
+        return
+
+    #
+    def set_properties(self, **properties):
+        """Properties added to every record. Eg: pipeline execution ID
+        """
+        self.properties = properties
+        return
+
+    #
+    @contextmanager
+    def timer(self, name, **properties):
+        """Record the duration of the block in milliseconds. Failed blocks are recorded with `Failed: true`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            properties['Failed'] = True
+            raise
+        finally:
+            self.record(name, (time.perf_counter()-start)*1000, UNIT_MILLISECONDS, **properties)
+
+    #
+    def record(self, name, value, unit=UNIT_MILLISECONDS, **properties):
+        if (not self.is_enabled()):
+            return
+
+        document = dict(self.properties)
+        document.update(properties)
+        document.update(self.dimensions)
+        document[name] = round(value, 3) if (isinstance(value, float)) else value
+        document['_aws'] = {
+            'Timestamp': int(time.time()*1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit}]
+            }]
+        }
+        self.write(json.dumps(document, separators=(',', ':'), default=str))
+        return
+
+    #
+    def write(self, line):
+        with self.lock:
+            if (self.sink.startswith(SINK_FILE)):
+                with open(self.sink[len(SINK_FILE):], 'a', encoding='utf-8') as file:
+                    file.write(line+'\n')
+            else:
+                sys.stdout.write(line+'\n')
+                sys.stdout.flush()
+        return
+
+metrics = IdecMetrics()
@@ -0,0 +1,210 @@
+# idec_throttle.py
+"""Rate-limit-aware scheduling of the AWS API calls of the engines
+
+The boto3 clients of the engines are attached to the scheduler (`scheduler.attach`) through the botocore events
+of the client, so direct calls, paginators and waiters all go through it:
+    - `before-call`: a token is taken from the bucket of (service, region, credential). Calls wait for their turn
+      instead of being throttled by AWS.
+    - `needs-retry`: a throttled call is retried after an exponential backoff with full jitter, up to
+      `API_THROTTLE_RETRIES` times. The bucket slows down (`API_RATE_BACKOFF`), then grows back on successful calls
+      up to its limit (`API_RATE_LIMIT`), so the engines settle near the API limits of the account.
+Buckets are opt-in (`API_RATE_LIMIT` is 0 by default) and never limit S3 and STS calls (plan store, artifacts,
+staging, credentials) unless `API_RATE_LIMITS` says so. Throttled calls are retried either way.
+Other errors are left to the retry handler of botocore.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+
+# Requests per second per bucket (service, region, credential). 0 for no limit.
+API_RATE_LIMIT = float(os.environ.get('API_RATE_LIMIT', '0'))
+# Limits of some services, over API_RATE_LIMIT. Eg: {"cloudformation": 5}. S3 and STS are not limited unless set.
+API_RATE_LIMITS = dict({'s3': 0, 'sts': 0}, **json.loads(os.environ.get('API_RATE_LIMITS') or '{}'))
+# Burst of a bucket, in seconds of its rate
+API_RATE_BURST = 2
+# Floor of the rate after throttles (requests per second)
+API_RATE_MIN = 0.2
+# Rate kept after a throttle
+API_RATE_BACKOFF = 0.7
+# Rate regained per successful call, as a ratio of the limit
+API_RATE_RECOVERY = 0.05
+# Retries of a throttled call (the first attempt excluded)
+API_THROTTLE_RETRIES = int(os.environ.get('API_THROTTLE_RETRIES', '8'))
+API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 20
+# Error codes of throttled calls. `LimitExceededException` is left out: CloudFormation uses it for quotas.
+THROTTLING_ERRORS = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException'
+]
+
+class IdecTokenBucket:
+    """Token bucket with an adaptive rate: reduced on throttles, regained on successful calls
+    """
+    limit = None
+    rate = None
+    capacity = None
+    tokens = None
+    updated = None
+    lock = None
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.rate = limit
+        self.capacity = max(1.0, limit*API_RATE_BURST)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        return
+
+    #
+    def reserve(self):
+        """Take a token, in advance if the bucket is empty
+
+        Returns:
+            Seconds to wait before using the token
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens+(now-self.updated)*self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if (self.tokens>=0):
+                return 0
+            return -self.tokens/self.rate
+
+    #
+    def throttled(self):
+        with self.lock:
+            self.rate = max(API_RATE_MIN, self.rate*API_RATE_BACKOFF)
+            self.tokens = min(self.tokens, 0)
+        return
+
+    #
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.limit, self.rate+self.limit*API_RATE_RECOVERY)
+        return
+
+class IdecRequestScheduler:
+    """Buckets shared by all clients of the process, and counters of the throttles absorbed
+    """
+    buckets = None
+    throttles = None
+    waited = None
+    lock = None
+
+    def __init__(self):
+        self.buckets = {}
+        self.throttles = Counter()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+        return
+
+    #
+    def bucket(self, service, key):
+        """
+        Returns:
+            Bucket of a key, None if the service is not limited
+        """
+        limit = float(API_RATE_LIMITS.get(service, API_RATE_LIMIT))
+        if (limit<=0):
+            return None
+        with self.lock:
+            if (key not in self.buckets):
+                self.buckets[key] = IdecTokenBucket(limit)
+            return self.buckets[key]
+
+    #
+    def attach(self, client, key):
+        """Schedule the calls of a boto3 client
+
+        Args:
+            key: (service, region, credential) of the bucket. Clients of the same key share it.
+
+        Returns:
+            The client. Clients without botocore events (Eg: stand-ins of the benchmark suite) are left as they are.
+        """
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if (events is None):
+            return client
+        service = key[0]
+        bucket = self.bucket(service, key)
+        # Before the retry handler of botocore, which is registered for the service
+        event_name = client.meta.service_model.service_id.hyphenize()
+        events.register_first('needs-retry.{}'.format(event_name), lambda **kwargs: self.on_needs_retry(service, bucket, **kwargs))
+        if (bucket):
+            events.register('before-call.{}'.format(event_name), lambda **kwargs: self.on_before_call(bucket, **kwargs))
+            events.register('after-call.{}'.format(event_name), lambda **kwargs: self.on_after_call(bucket, **kwargs))
+        return client
+
+    #
+    def on_before_call(self, bucket, **kwargs):
+        wait = bucket.reserve()
+        if (wait>0):
+            with self.lock:
+                self.waited += wait
+            time.sleep(wait)
+        # Any other value would replace the response of the call
+        return None
+
+    #
+    def on_after_call(self, bucket, http_response=None, **kwargs):
+        if (http_response is not None) and (http_response.status_code<300):
+            bucket.succeeded()
+        return None
+
+    #
+    def on_needs_retry(self, service, bucket, response=None, attempts=None, operation=None, **kwargs):
+        """
+        Returns:
+            Seconds before the next attempt of a throttled call, None to let botocore decide
+        """
+        if (response is None) or (response[1].get('Error', {}).get('Code') not in THROTTLING_ERRORS):
+            return None
+
+        with self.lock:
+            self.throttles[service] += 1
+        if (bucket):
+            bucket.throttled()
+        if (attempts>API_THROTTLE_RETRIES):
+            logging.warning('{}.{} is still throttled after {} attempts.'.format(service, getattr(operation, 'name', operation), attempts))
+            return None
+
+        delay = random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY*2**attempts))
+        if (bucket):
+            delay = max(delay, bucket.reserve())
+        logging.info('{}.{} is throttled (attempt {}). Retry in {:.2f}s.'.format(service, getattr(operation, 'name', operation), attempts, delay))
+        with self.lock:
+            self.waited += delay
+        return delay
+
+    #
+    def drain(self):
+        """Throttles absorbed and seconds waited since the last drain
+
+        Returns:
+            (Counter of throttles by service, seconds)
+        """
+        with self.lock:
+            throttles, waited = self.throttles, self.waited
+            self.throttles = Counter()
+            self.waited = 0.0
+        return throttles, waited
+
+# Shared by the engines, across warm invocations
+scheduler = IdecRequestScheduler()
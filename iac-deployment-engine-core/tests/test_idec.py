@@ -0,0 +1,287 @@
+# test_idec.py
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import idec
+from idec import IdecPlanner
+
+def cfn(stack, **properties):
+    return dict({'Object': 'cfn', 'Stack': stack, 'Action': 'deploy'}, **properties)
+
+def aws(action='stop_instances', **properties):
+    return dict({'Object': 'aws', 'Service': 'ec2', 'Action': action}, **properties)
+
+class TestPlanner(unittest.TestCase):
+    #
+    def test_sequential_by_default(self):
+        planner = IdecPlanner([cfn('A'), cfn('B'), cfn('C')])
+        self.assertEqual(planner.dependencies, [set(), {0}, {1}])
+
+    #
+    def test_wave(self):
+        planner = IdecPlanner([cfn('A'), cfn('B', Wave=1), cfn('C', Wave=1), cfn('D')])
+        self.assertEqual(planner.dependencies, [set(), {0}, {0}, {1, 2}])
+
+    #
+    def test_depends_on_id_and_stack(self):
+        planner = IdecPlanner([cfn('A', Id='a'), cfn('B'), cfn('C', DependsOn=['a']), cfn('D', DependsOn='B')])
+        self.assertEqual(planner.dependencies[2], {0})
+        self.assertEqual(planner.dependencies[3], {1})
+
+    #
+    def test_depends_on_leaves_the_chain(self):
+        planner = IdecPlanner([cfn('A'), cfn('B', DependsOn=['A']), cfn('C'), cfn('D', Wave=1), cfn('E', DependsOn=[]), cfn('F', Wave=1), cfn('G')])
+        # C only waits for A, not for B
+        self.assertEqual(planner.dependencies[:3], [set(), {0}, {0}])
+        # E neither waits nor is waited for. It does not split the wave of D and F.
+        self.assertEqual(planner.dependencies[3:], [{2}, set(), {2}, {3, 5}])
+        self.assertEqual(planner.ready_blocks({0}, set()), [1, 2, 4])
+
+    #
+    def test_depends_on_later_block(self):
+        planner = IdecPlanner([cfn('A', DependsOn=['C']), cfn('B'), cfn('C')])
+        self.assertEqual(planner.dependencies, [{2}, set(), {1}])
+
+    #
+    def test_depends_on_reversed(self):
+        planner = IdecPlanner([cfn('A', Id='a'), cfn('B', DependsOn=['a'])], reverse=True)
+        self.assertEqual(planner.dependencies, [{1}, set()])
+
+    #
+    def test_depends_on_unknown_block(self):
+        with self.assertRaises(Exception):
+            IdecPlanner([cfn('A', DependsOn=['missing'])])
+
+    #
+    def test_circular_dependencies(self):
+        with self.assertRaises(Exception):
+            IdecPlanner([cfn('A', DependsOn=['B']), cfn('B', DependsOn=['A'])])
+
+    #
+    def test_output_ref_without_id(self):
+        planner = IdecPlanner([cfn('my-vpc', DependsOn=[]), cfn('app', DependsOn=[], Params={'VpcId': '${my-vpc.VpcId}'})])
+        self.assertEqual(planner.dependencies, [set(), {0}])
+
+    #
+    def test_output_ref_to_block_with_id(self):
+        planner = IdecPlanner([cfn('my-vpc', Id='vpc', DependsOn=[]), cfn('app', DependsOn=[], Params={'VpcId': '${my-vpc.VpcId}'})])
+        self.assertEqual(planner.dependencies, [set(), {0}])
+
+    #
+    def test_output_ref_in_wave(self):
+        planner = IdecPlanner([cfn('A', Wave=1), cfn('B', Wave=1, Params=[{'Name': 'X', 'Value': '${A.X}'}])])
+        self.assertEqual(planner.dependencies, [set(), {0}])
+
+    #
+    def test_output_ref_not_in_reverse_mode(self):
+        planner = IdecPlanner([cfn('A', DependsOn=[]), cfn('B', DependsOn=[], Params={'X': '${A.X}'})], reverse=True)
+        self.assertEqual(planner.dependencies, [set(), set()])
+
+    #
+    def test_output_ref_to_later_stack(self):
+        with self.assertRaises(Exception):
+            IdecPlanner([cfn('A', Params={'X': '${B.X}'}), cfn('B')])
+
+    #
+    def test_output_ref_not_to_aws_block(self):
+        planner = IdecPlanner([aws(Id='A', DependsOn=[]), cfn('B', DependsOn=[], Params={'X': '${A.X}'})])
+        self.assertEqual(planner.dependencies, [set(), set()])
+
+    #
+    def test_targets(self):
+        changes = list(idec.expand_targets([
+            cfn('A', Targets=[{'Region': 'eu-west-1'}, {'Region': 'us-east-1'}, {'Region': 'ap-southeast-1'}], TargetConcurrency=2),
+            cfn('B', Params={'X': '${A.X}'}, Targets=[{'Region': 'eu-west-1'}, {'Region': 'us-east-1'}], DependsOn=[])
+        ]))
+        self.assertEqual([change['Target']['Region'] for change in changes], ['eu-west-1', 'us-east-1', 'ap-southeast-1', 'eu-west-1', 'us-east-1'])
+        planner = IdecPlanner(changes)
+        # 2 targets at a time, then the third one
+        self.assertEqual(planner.dependencies[:3], [set(), set(), {0, 1}])
+        # Outputs of the same target only
+        self.assertEqual(planner.dependencies[3:], [{0}, {1}])
+
+    #
+    def test_target_waves(self):
+        targets = [{'Region': region} for region in ['eu-west-1', 'us-east-1', 'ap-southeast-1', 'sa-east-1', 'ca-central-1']]
+        changes = list(idec.expand_targets([cfn('A'), cfn('B', Targets=targets, TargetConcurrency=2), cfn('C', Targets=targets[:2])]))
+        # Named by block position and group of TargetConcurrency targets
+        self.assertEqual([change.get('Wave') for change in changes], [None, 'targets-1-0', 'targets-1-0', 'targets-1-1', 'targets-1-1', 'targets-1-2', 'targets-2-0', 'targets-2-0'])
+        self.assertTrue(all('Targets' not in change and 'TargetConcurrency' not in change for change in changes))
+        self.assertEqual(IdecPlanner(changes).dependencies, [set(), {0}, {0}, {1, 2}, {1, 2}, {3, 4}, {5}, {5}])
+
+    #
+    def test_target_waves_of_block_with_wave(self):
+        targets = [{'Account': 111111111111}, {'Account': '222222222222'}, {'Account': '333333333333'}]
+        changes = list(idec.expand_targets([cfn('A', Wave=1), cfn('B', Wave=1, Targets=targets, TargetConcurrency=2)]))
+        # The first targets join the wave of the block
+        self.assertEqual([change.get('Wave') for change in changes], [1, 1, 1, 'targets-1-1'])
+        self.assertEqual(changes[1]['Target'], {'Account': '111111111111'})
+        self.assertEqual(IdecPlanner(changes).dependencies, [set(), set(), set(), {0, 1, 2}])
+
+    #
+    def test_targets_with_depends_on(self):
+        changes = list(idec.expand_targets([cfn('A'), cfn('B', DependsOn=['A'], Targets=[{'Region': 'eu-west-1'}, {'Region': 'us-east-1'}], TargetConcurrency=1), cfn('C', DependsOn=['B'])]))
+        self.assertEqual([change.get('Wave') for change in changes], [None, None, None, None])
+        self.assertEqual(IdecPlanner(changes).dependencies, [set(), {0}, {0}, {1, 2}])
+
+    #
+    def test_invalid_targets(self):
+        for targets in [[], [{'Profile': 'x'}], ['eu-west-1'], [{}]]:
+            with self.assertRaises(Exception):
+                list(idec.expand_targets([cfn('A', Targets=targets)]))
+
+    #
+    def test_batch_aws(self):
+        changes = [cfn('A'), aws(), aws(), cfn('B'), aws()]
+        self.assertEqual(IdecPlanner(changes, batch_aws=False).dependencies, [set(), {0}, {1}, {2}, {3}])
+        self.assertEqual(IdecPlanner(changes, batch_aws=True).dependencies, [set(), {0}, {0}, {1, 2}, {3}])
+
+    #
+    def test_ready_blocks(self):
+        planner = IdecPlanner([cfn('A'), cfn('B', Wave=1), cfn('C', Wave=1)])
+        self.assertEqual(planner.ready_blocks(set(), set()), [0])
+        self.assertEqual(planner.ready_blocks({0}, {1}), [2])
+        self.assertTrue(planner.is_complete({0, 1, 2}))
+
+class FakeEc2:
+    """Pages of describe_instances, and the calls made, in order
+    """
+    pages = None
+    calls = None
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+        return
+
+    #
+    def describe_instances(self, **params):
+        self.calls.append(('describe_instances', params))
+        return self.pages[0]
+
+    #
+    def stop_instances(self, **params):
+        self.calls.append(('stop_instances', params))
+        return {}
+
+    #
+    def get_paginator(self, action):
+        client = self
+
+        class Paginator:
+            def paginate(self, **params):
+                for i, page in enumerate(client.pages):
+                    client.calls.append(('page', i))
+                    yield page
+        return Paginator()
+
+def instances_page(*instance_ids):
+    return {'Reservations': [{'Instances': [{'InstanceId': instance_id, 'State': {'Name': 'running'}} for instance_id in instance_ids]}]}
+
+class TestAwsBlocks(unittest.TestCase):
+    #
+    def test_iter_batches(self):
+        self.assertEqual(list(idec.iter_batches(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(idec.iter_batches(range(6), 3)), [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(list(idec.iter_batches([], 3)), [])
+        # Values are read as batches are consumed
+        values = iter(range(10))
+        batches = idec.iter_batches(values, 4)
+        next(batches)
+        self.assertEqual(next(values), 4)
+
+    #
+    def test_stream_without_query(self):
+        client = FakeEc2([instances_page('i-1'), instances_page('i-2')])
+        self.assertEqual(list(idec.stream_aws_call(client, 'describe_instances', {'MaxResults': 5})), [instances_page('i-1')])
+        self.assertEqual(client.calls, [('describe_instances', {'MaxResults': 5})])
+        self.assertEqual(len(list(idec.stream_aws_call(client, 'describe_instances', None, paginate=True))), 2)
+
+    #
+    def test_stream_pages_with_query(self):
+        client = FakeEc2([instances_page('i-1', 'i-2'), instances_page(), instances_page('i-3')])
+        values = idec.stream_aws_call(client, 'describe_instances', {}, paginate=True, query='Reservations[].Instances[].InstanceId')
+        self.assertEqual(next(values), 'i-1')
+        # One page at a time
+        self.assertEqual(client.calls, [('page', 0)])
+        self.assertEqual(list(values), ['i-2', 'i-3'])
+        # Scalar and missing values
+        self.assertEqual(list(idec.stream_aws_call(client, 'describe_instances', {}, paginate=True, query='length(Reservations[].Instances[])')), [2, 0, 1])
+        self.assertEqual(list(idec.stream_aws_call(client, 'describe_instances', {}, query='Missing')), [])
+
+    #
+    def test_chain(self):
+        client = FakeEc2([instances_page('i-1', 'i-2', 'i-3'), instances_page('i-4', 'i-5')])
+        values = idec.stream_aws_call(client, 'describe_instances', {}, paginate=True, query='Reservations[].Instances[].InstanceId')
+        then = {'Action': 'stop_instances', 'Key': 'InstanceIds', 'Params': {'Force': True}, 'BatchSize': 2}
+        result = idec.run_aws_chain(lambda action, params: getattr(client, action)(**params), then, values)
+        self.assertEqual(result, {'Count': 5, 'Calls': 3})
+        # Batches are passed while the next pages are read
+        self.assertEqual(client.calls, [
+            ('page', 0),
+            ('stop_instances', {'Force': True, 'InstanceIds': ['i-1', 'i-2']}),
+            ('page', 1),
+            ('stop_instances', {'Force': True, 'InstanceIds': ['i-3', 'i-4']}),
+            ('stop_instances', {'Force': True, 'InstanceIds': ['i-5']})
+        ])
+        self.assertNotIn('InstanceIds', then['Params'])
+
+    #
+    def test_chain_batch_size(self):
+        calls = []
+        result = idec.run_aws_chain(lambda action, params: calls.append(len(params['Ids'])), {'Action': 'x', 'Key': 'Ids'}, range(idec.AWS_CHAIN_BATCH_SIZE*2+1))
+        self.assertEqual(calls, [idec.AWS_CHAIN_BATCH_SIZE, idec.AWS_CHAIN_BATCH_SIZE, 1])
+        self.assertEqual(result['Count'], idec.AWS_CHAIN_BATCH_SIZE*2+1)
+        self.assertEqual(idec.run_aws_chain(lambda action, params: calls.append(params), {'Action': 'x', 'Key': 'Ids'}, []), {'Count': 0, 'Calls': 0})
+
+    #
+    def test_check_chains(self):
+        self.assertEqual(len(list(idec.check_aws_chains([aws('describe_instances', Query='Reservations[]', Then={'Action': 'stop_instances', 'Key': 'InstanceIds'})]))), 1)
+        for change in [aws('describe_instances', Then={'Action': 'stop_instances', 'Key': 'InstanceIds'}), aws('describe_instances', Query='x', Then={'Action': 'stop_instances'}), aws('describe_instances', Query='x', Then='stop_instances')]:
+            with self.assertRaises(Exception):
+                list(idec.check_aws_chains([change]))
+
+class TestOutputRefs(unittest.TestCase):
+    #
+    def test_find(self):
+        params = {'A': '${vpc-1.VpcId}', 'B': ['x-${Net.Subnet1}-${Net.Subnet2}'], 'C': '${aws:username}', 'D': 3}
+        self.assertEqual(idec.find_output_refs(params), {('vpc-1', 'VpcId'), ('Net', 'Subnet1'), ('Net', 'Subnet2')})
+
+    #
+    def test_output_refs_of_cfn_blocks_only(self):
+        self.assertEqual(idec.output_refs(cfn('B', Params={'X': '${A.X}'})), {('A', 'X')})
+        self.assertEqual(idec.output_refs(aws(Params={'X': '${A.X}'})), set())
+        self.assertEqual(idec.output_refs(cfn('B')), set())
+
+    #
+    def test_resolve(self):
+        outputs = {'Net': {'VpcId': 'vpc-123', 'Subnet1': 'subnet-1'}}
+        params = [{'Name': 'VpcId', 'Value': '${Net.VpcId}'}, {'Name': 'Subnets', 'Value': '${Net.Subnet1},x'}, {'Name': 'Size', 'Value': 3}]
+        resolved = idec.resolve_output_refs(params, lambda stack_name: outputs[stack_name])
+        self.assertEqual(resolved, [{'Name': 'VpcId', 'Value': 'vpc-123'}, {'Name': 'Subnets', 'Value': 'subnet-1,x'}, {'Name': 'Size', 'Value': 3}])
+        # Not changed in place
+        self.assertEqual(params[0]['Value'], '${Net.VpcId}')
+
+    #
+    def test_resolve_missing_output(self):
+        with self.assertRaises(Exception):
+            idec.resolve_output_refs({'X': '${Net.Missing}'}, lambda stack_name: {'VpcId': 'vpc-123'})
+
+    #
+    def test_resolve_without_refs(self):
+        def get_outputs(stack_name):
+            raise AssertionError('No output to read')
+        self.assertEqual(idec.resolve_output_refs({'X': '${aws:username}', 'Y': 1}, get_outputs), {'X': '${aws:username}', 'Y': 1})
+
+    #
+    def test_stack_outputs(self):
+        stack = {'Outputs': [{'OutputKey': 'VpcId', 'OutputValue': 'vpc-123'}]}
+        self.assertEqual(idec.stack_outputs(stack), {'VpcId': 'vpc-123'})
+        self.assertEqual(idec.stack_outputs({}), {})
+        self.assertEqual(idec.stack_outputs(None), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# test_idec_throttle.py
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import idec_throttle
+from idec_throttle import IdecTokenBucket, IdecRequestScheduler
+
+class FakeClock:
+    now = None
+
+    def __init__(self):
+        self.now = 1000.0
+        return
+
+    #
+    def __call__(self):
+        return self.now
+
+def throttled(code='Throttling'):
+    return (None, {'Error': {'Code': code}})
+
+class TestTokenBucket(unittest.TestCase):
+    #
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(idec_throttle.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    #
+    def test_burst_then_wait(self):
+        bucket = IdecTokenBucket(10)
+        # Burst of API_RATE_BURST seconds
+        self.assertEqual([bucket.reserve() for i in range(20)], [0]*20)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+
+    #
+    def test_refill(self):
+        bucket = IdecTokenBucket(10)
+        for i in range(20):
+            bucket.reserve()
+        self.clock.now += 0.5
+        self.assertEqual([bucket.reserve() for i in range(5)], [0]*5)
+        self.assertGreater(bucket.reserve(), 0)
+        # Never over the burst
+        self.clock.now += 3600
+        self.assertEqual([bucket.reserve() for i in range(20)], [0]*20)
+        self.assertGreater(bucket.reserve(), 0)
+
+    #
+    def test_throttled_then_recovered(self):
+        bucket = IdecTokenBucket(10)
+        bucket.throttled()
+        self.assertAlmostEqual(bucket.rate, 10*idec_throttle.API_RATE_BACKOFF)
+        # The next call waits
+        self.assertGreater(bucket.reserve(), 0)
+        for i in range(100):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, idec_throttle.API_RATE_MIN)
+        for i in range(100):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 10)
+
+class TestRequestScheduler(unittest.TestCase):
+    #
+    def test_buckets(self):
+        scheduler = IdecRequestScheduler()
+        with mock.patch.object(idec_throttle, 'API_RATE_LIMIT', 0):
+            self.assertIsNone(scheduler.bucket('cloudformation', ('cloudformation', None, None)))
+        with mock.patch.object(idec_throttle, 'API_RATE_LIMIT', 10):
+            bucket = scheduler.bucket('cloudformation', ('cloudformation', None, None))
+            self.assertIs(scheduler.bucket('cloudformation', ('cloudformation', None, None)), bucket)
+            self.assertIsNot(scheduler.bucket('cloudformation', ('cloudformation', 'us-east-1', None)), bucket)
+            self.assertIsNone(scheduler.bucket('s3', ('s3', None, None)))
+            self.assertIsNone(scheduler.bucket('sts', ('sts', None, None)))
+
+    #
+    def test_retry_of_throttled_call(self):
+        scheduler = IdecRequestScheduler()
+        bucket = IdecTokenBucket(10)
+        with mock.patch.object(idec_throttle.random, 'uniform', lambda low, high: high):
+            delays = [scheduler.on_needs_retry('cloudformation', None, response=throttled(), attempts=attempts, operation='DescribeStacks') for attempts in range(1, 8)]
+            # Exponential, up to API_RETRY_MAX_DELAY
+            self.assertEqual(delays, [1, 2, 4, 8, 16, 20, 20])
+            # The bucket slows down
+            scheduler.on_needs_retry('cloudformation', bucket, response=throttled('SlowDown'), attempts=1, operation='DescribeStacks')
+            self.assertLess(bucket.rate, 10)
+        throttles, waited = scheduler.drain()
+        self.assertEqual(throttles['cloudformation'], 8)
+        self.assertGreater(waited, 0)
+        self.assertEqual(scheduler.drain(), (idec_throttle.Counter(), 0.0))
+
+    #
+    def test_retry_delay_jittered(self):
+        scheduler = IdecRequestScheduler()
+        for attempts in range(1, 6):
+            delay = scheduler.on_needs_retry('ec2', None, response=throttled('RequestLimitExceeded'), attempts=attempts)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, idec_throttle.API_RETRY_BASE_DELAY*2**attempts)
+
+    #
+    def test_no_retry(self):
+        scheduler = IdecRequestScheduler()
+        # Left to botocore: no response, other errors, quotas, too many attempts
+        self.assertIsNone(scheduler.on_needs_retry('cloudformation', None, response=None, attempts=1))
+        self.assertIsNone(scheduler.on_needs_retry('cloudformation', None, response=throttled('ValidationError'), attempts=1))
+        self.assertIsNone(scheduler.on_needs_retry('cloudformation', None, response=throttled('LimitExceededException'), attempts=1))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(scheduler.on_needs_retry('cloudformation', None, response=throttled(), attempts=idec_throttle.API_THROTTLE_RETRIES+1))
+        self.assertEqual(scheduler.drain()[0]['cloudformation'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
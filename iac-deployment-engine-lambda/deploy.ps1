@@ -10,7 +10,7 @@ echo 'AWS profile: '$aws_profile
 echo '---Start'
 
 echo '---Zipping'
-7z a -y $function_name'.zip' .\function\*.py
+7z a -y $function_name'.zip' .\function\*.py ..\iac-deployment-engine-core\*.py
 echo '---Zip done'
 
 echo '---Deploying'
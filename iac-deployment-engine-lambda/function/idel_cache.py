@@ -0,0 +1,79 @@
+# idel_cache.py
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+# Max number of entries per cache that live across warm invocations
+WARM_CACHE_MAX_ENTRIES = int(os.environ.get('WARM_CACHE_MAX_ENTRIES', '4'))
+
+class IdelWarmCache:
+    """LRU cache at module level, so it lives across warm invocations of the Lambda container
+    """
+    logger = None
+    name = None
+    max_entries = None
+    on_evict = None
+    log_level = None
+    entries = None
+    lock = None
+
+    def __init__(self, name, max_entries=WARM_CACHE_MAX_ENTRIES, on_evict=None, log_level=logging.INFO):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.name = name
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.log_level = log_level
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        return
+
+    #
+    def get(self, key):
+        with self.lock:
+            if (key not in self.entries):
+                self.logger.log(self.log_level, 'Warm cache [{}] MISS.'.format(self.name))
+                return None
+            self.entries.move_to_end(key)
+            self.logger.log(self.log_level, 'Warm cache [{}] HIT.'.format(self.name))
+            return self.entries[key]
+
+    #
+    def put(self, key, value):
+        evicted = []
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while (len(self.entries)>self.max_entries):
+                evicted.append(self.entries.popitem(last=False)[1])
+
+        if (self.on_evict):
+            for value in evicted:
+                self.on_evict(value)
+        return value
+
+    #
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        return
+
+    #
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return
+
+# Artifacts: (bucket, key, ETag) -> IdelArtifact
+artifacts = IdelWarmCache('artifacts', on_evict=lambda artifact: artifact.close())
+# Plans: (bucket, key, execution id, changes file) -> (change mode, IdelPlanner, decorated changes)
+plans = IdelWarmCache('plans')
+# Assumed role credentials of targets: (access key id of the secret, account) -> credential (see idel_targets)
+target_credentials = IdelWarmCache('target credentials', max_entries=64)
+# Template stagings: (location, region, access key id) -> IdecTemplateStaging (objects known to exist)
+template_stagings = IdelWarmCache('template stagings')
@@ -1,23 +1,165 @@
 # idel_cfn.py
 import os
 import botocore
-import boto3
 import logging
-import urllib3
-import json
+import threading
+
+import idec
+import idel_utils
+import idel_clients
+import idel_polling
+from idel_events import WAIT_MODE_BLOCK
+from idel_polling import IdelDurationHistory, CFN_WAITER_CONFIG
+from idec_metrics import metrics
+
+# block: wait for stack within the round | poll/event: return right after the API call
+CFN_WAIT_MODE = os.environ.get('CFN_WAIT_MODE', WAIT_MODE_BLOCK)
+CFN_NOTIFICATION_ARNS = [arn for arn in os.environ.get('CFN_NOTIFICATION_ARNS', '').split(',') if (arn)]
+# Number of stacks from which one DescribeStacks sweep of the whole region is cheaper than per stack calls
+CFN_STACK_CACHE_SWEEP_MIN = int(os.environ.get('CFN_STACK_CACHE_SWEEP_MIN', '3'))
+# Skip deploying stacks whose template, parameters and capabilities did not change since the last deployment
+CFN_SKIP_UNCHANGED = os.environ.get('CFN_SKIP_UNCHANGED', 'false').lower()=='true'
+CFN_CONTENT_HASH_TAG = os.environ.get('CFN_CONTENT_HASH_TAG', 'idel:content-hash')
+# Statuses from which a stack with the same content hash does not need to be deployed again
+CFN_STABLE_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'IMPORT_COMPLETE']
+# direct: CreateStack/UpdateStack | changeset: change sets of all deploy blocks are created up front, empty ones are skipped
+DEPLOY_METHOD_DIRECT = 'direct'
+DEPLOY_METHOD_CHANGE_SET = 'changeset'
+CFN_DEPLOY_METHOD = os.environ.get('CFN_DEPLOY_METHOD', DEPLOY_METHOD_DIRECT)
+# Templates are uploaded to `s3://<bucket>/<prefix>` (by content hash) and deployed with TemplateURL. Empty to send TemplateBody.
+CFN_TEMPLATE_STAGING = os.environ.get('CFN_TEMPLATE_STAGING', '')
+CFN_CHANGE_SET_WAITER_CONFIG = {'Delay': 2, 'MaxAttempts': 150}
+# Summary statuses of change sets
+CHANGE_SET_PENDING = 'PENDING'
+CHANGE_SET_READY = 'READY'
+CHANGE_SET_EMPTY = 'EMPTY'
+CHANGE_SET_FAILED = 'FAILED'
+# Errors of ExecuteChangeSet when the change set is obsolete (Eg: the stack changed since)
+CHANGE_SET_STALE_ERRORS = ['ChangeSetNotFound', 'ChangeSetNotFoundException', 'InvalidChangeSetStatus', 'InvalidChangeSetStatusException']
+
+class IdelStackCache:
+    """Per-invocation cache of stack descriptions
+
+    Filled by one paginated DescribeStacks sweep (all stacks of the region) or by per stack calls,
+    then answers existence, id and status lookups from memory.
+    Entries are invalidated after each mutating call.
+    """
+    logger = None
+    boto3_client = None
+    stacks = None       # stack name or stack id -> stack
+    swept_names = None  # stack names known by the last sweep (existing stacks only)
+    invalidated_names = None  # stack names changed since the last sweep, described again
+    swept = False
+    lock = None
+
+    def __init__(self, boto3_client):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.boto3_client = boto3_client
+        self.stacks = {}
+        self.swept_names = set()
+        self.invalidated_names = set()
+        self.lock = threading.RLock()
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def prime(self, stack_names):
+        """Sweep the whole region once if there are enough stacks to look up
+        """
+        missing = [name for name in set(stack_names) if (name) and (name not in self.stacks)]
+        if (len(missing)<CFN_STACK_CACHE_SWEEP_MIN):
+            return False
+
+        self.logger.info('Sweep stacks for [{}] lookups.'.format(len(missing)))
+        with self.lock, metrics.timer('DescribeStacks', Sweep=True):
+            paginator = self.boto3_client.get_paginator('describe_stacks')
+            for page in paginator.paginate():
+                for stack in page['Stacks']:
+                    self.put(stack)
+                    self.swept_names.add(stack['StackName'])
+            self.invalidated_names.clear()
+            self.swept = True
+
+        return True
+
+    #
+    def put(self, stack):
+        with self.lock:
+            self.stacks[stack['StackId']] = stack
+            if (stack['StackStatus']!='DELETE_COMPLETE'):
+                self.stacks[stack['StackName']] = stack
+        return stack
+
+    #
+    def get(self, stack_name):
+        """Describe stack from memory, else DescribeStacks
+
+        Raises:
+            botocore.exceptions.ClientError: stack does not exist
+        """
+        with self.lock:
+            if (stack_name in self.stacks):
+                return self.stacks[stack_name]
+
+        with metrics.timer('DescribeStacks', StackName=stack_name):
+            stacks = self.boto3_client.describe_stacks(StackName=stack_name)
+        return self.put(stacks['Stacks'][0])
+
+    #
+    def exists(self, stack_name):
+        """None if unknown
+        """
+        with self.lock:
+            if (stack_name in self.stacks):
+                return self.stacks[stack_name]['StackStatus']!='DELETE_COMPLETE'
+            if (self.swept) and (not stack_name.startswith('arn:')) and (stack_name not in self.invalidated_names):
+                return stack_name in self.swept_names
+        return None
 
-CFN_WAITER_CONFIG = json.loads(os.environ['CFN_WAITER_CONFIG'])
+    #
+    def invalidate(self, stack_name):
+        """Forget a stack (by name or id) after a mutating call
+        """
+        with self.lock:
+            stack = self.stacks.pop(stack_name, None)
+            if (stack):
+                self.stacks.pop(stack['StackId'], None)
+                if (self.stacks.get(stack['StackName']) is stack):
+                    self.stacks.pop(stack['StackName'], None)
+            # The sweep does not tell about these names anymore, they are looked up again
+            if (not stack_name.startswith('arn:')):
+                self.invalidated_names.add(stack_name)
+            if (stack):
+                self.invalidated_names.add(stack['StackName'])
+        return
 
 class IdelCloudFormation:
     boto3_client = None
     logger = None
     role_arn = None
-
-    def __init__(self):
+    wait_mode = CFN_WAIT_MODE
+    notification_arns = CFN_NOTIFICATION_ARNS
+    # Prefix of stack names in the duration history. Eg: `<account>/<region>/` of a target
+    history_prefix = ''
+    skip_unchanged = CFN_SKIP_UNCHANGED
+    deploy_method = CFN_DEPLOY_METHOD
+    stack_cache = None
+    duration_history = None
+    wait_deadline = None
+
+    def __init__(self, duration_history=None):
         # Setup logging
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
 
+        self.duration_history = duration_history or IdelDurationHistory(location='')
+
         # Log DEBUG
         self.logger.debug('Init class {}'.format(self.__str__()))
 
@@ -29,12 +171,8 @@ class IdelCloudFormation:
         """
         logging.debug('Setting up boto3 low-level client for CloudFormation.')
         logging.debug('credential: {}'.format(str(credential)))
-        self.boto3_client = boto3.client(
-            'cloudformation',
-            aws_access_key_id=credential['ACCESS_KEY_ID'],
-            aws_secret_access_key=credential['SECRET_ACCESS_KEY'],
-            region_name=credential['REGION']
-        )
+        self.boto3_client = idel_clients.get_client_with_credential('cloudformation', credential)
+        self.stack_cache = IdelStackCache(self.boto3_client)
 
         if ('ROLE_NAME' in credential) and (credential['ROLE_NAME']):
             self.set_cfn_role_arn('arn:aws:iam::'+credential['ACCOUNT_NUMBER']+':role/'+credential['ROLE_NAME'])
@@ -48,22 +186,34 @@ class IdelCloudFormation:
         self.role_arn = role_arn
         return
 
+    #
+    def set_wait_deadline(self, wait_deadline):
+        """Time (`idel_polling.clock`) after which stacks are not waited for within the round
+        """
+        self.wait_deadline = wait_deadline
+        return
+
     #
     def get_stack(self, stack_name):
-        """ Describe stack
+        """ Describe stack (from the stack cache if possible)
 
         Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation.html?highlight=cloudformation#CloudFormation.Client.describe_stacks
         """
-
-
-        stacks = self.boto3_client.describe_stacks(StackName=stack_name)
-        stack = stacks['Stacks'][0]
+        stack = self.stack_cache.get(stack_name)
 
         self.logger.info('Get stack: {}'.format(stack_name))
         self.logger.info('Stack status: {}'.format(stack['StackStatus']))
 
         return stack
 
+    #
+    def get_stack_outputs(self, stack_name):
+        """Outputs of a stack {OutputKey: OutputValue} (from the stack cache if possible)
+        """
+        if (not self.stack_exists(stack_name)):
+            raise Exception('Stack \'{}\' does not exist, its outputs cannot be referred to.'.format(stack_name))
+        return idec.stack_outputs(self.stack_cache.get(stack_name))
+
     #
     def get_stack_status(self, stack_name):
         """Get the status of an existing CloudFormation stack
@@ -75,7 +225,18 @@ class IdelCloudFormation:
         self.logger.info('Get stack status: {}'.format(stack_name))
 
         stack = self.get_stack(stack_name)
-        return stack['Stacks'][0]['StackStatus']
+        return stack['StackStatus']
+
+    #
+    def prime_stack_cache(self, stack_names):
+        """Fill the stack cache by one sweep before looking up many stacks
+        """
+        return self.stack_cache.prime(stack_names)
+
+    #
+    def invalidate_stack(self, stack_name):
+        self.stack_cache.invalidate(stack_name)
+        return
 
     #
     def stack_exists(self, stack_name):
@@ -83,8 +244,13 @@ class IdelCloudFormation:
 
         Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation.html?highlight=cloudformation#CloudFormation.Client.describe_stacks
         """
+        is_existed = self.stack_cache.exists(stack_name)
+        if (is_existed is not None):
+            self.logger.info('Stack {}: {}'.format('exists' if (is_existed) else 'NOT exist', stack_name))
+            return is_existed
+
         try:
-            self.boto3_client.describe_stacks(StackName=stack_name)
+            self.get_stack(stack_name)
             self.logger.info('Stack exists: {}'.format(stack_name))
             return True
         except botocore.exceptions.ClientError as e:
@@ -95,7 +261,32 @@ class IdelCloudFormation:
                 raise e
 
     #
-    def update_stack(self, stack_name, template_body, parameters=[], capabilities=[], tags=[]):
+    def is_unchanged(self, stack_name, content_hash):
+        """Check if an existing stack was deployed from the same content (tag `CFN_CONTENT_HASH_TAG`)
+        """
+        stack = self.get_stack(stack_name)
+        if (stack['StackStatus'] not in CFN_STABLE_STATUSES):
+            return False
+        for tag in stack.get('Tags', []):
+            if (tag['Key']==CFN_CONTENT_HASH_TAG):
+                return tag['Value']==content_hash
+        return False
+
+    #
+    def content_hash_tags(self, stack_name, content_hash):
+        """Tags of a stack with the content hash tag replaced
+
+        UpdateStack removes the existing tags if `Tags` is empty, so the others are kept.
+        """
+        tags = []
+        if (stack_name) and (self.stack_exists(stack_name)):
+            stack = self.get_stack(stack_name)
+            tags = [tag for tag in stack.get('Tags', []) if (tag['Key']!=CFN_CONTENT_HASH_TAG)]
+        tags.append({'Key': CFN_CONTENT_HASH_TAG, 'Value': content_hash})
+        return tags
+
+    #
+    def update_stack(self, stack_name, template_body=None, parameters=[], capabilities=[], tags=[], template_url=None):
         """Start a CloudFormation stack update
         Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation.html?highlight=cloudformation#CloudFormation.Client.update_stack
         """
@@ -105,16 +296,23 @@ class IdelCloudFormation:
         try:
             params = {}
             params['StackName'] = stack_name
-            params['TemplateBody'] = template_body
+            if (template_url):
+                params['TemplateURL'] = template_url
+            else:
+                params['TemplateBody'] = template_body
             params['Parameters'] = parameters
             params['Capabilities'] = capabilities
             params['Tags'] = tags
             if (self.role_arn):
                 params['RoleARN'] = self.role_arn
+            if (self.notification_arns):
+                params['NotificationARNs'] = self.notification_arns
 
-            result = self.boto3_client.update_stack(**params)
+            with metrics.timer('StackUpdate', StackName=stack_name):
+                result = self.boto3_client.update_stack(**params)
+            self.invalidate_stack(stack_name)
 
-            result['WaitResult'] = self.waiter(result['StackId'], 'stack_update_complete')
+            result['WaitResult'] = self.wait(result['StackId'], 'stack_update_complete', stack_name)
 
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Message'] == 'No updates are to be performed.':
@@ -127,7 +325,7 @@ class IdelCloudFormation:
         return result
 
     #
-    def create_stack(self, stack_name, template_body, parameters=[], capabilities=[], tags=[]):
+    def create_stack(self, stack_name, template_body=None, parameters=[], capabilities=[], tags=[], template_url=None):
         """Starts a new CloudFormation stack creation
 
         Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation.html?highlight=cloudformation#CloudFormation.Client.create_stack
@@ -138,16 +336,23 @@ class IdelCloudFormation:
         try:
             params = {}
             params['StackName'] = stack_name
-            params['TemplateBody'] = template_body
+            if (template_url):
+                params['TemplateURL'] = template_url
+            else:
+                params['TemplateBody'] = template_body
             params['Parameters'] = parameters
             params['Capabilities'] = capabilities
             params['Tags'] = tags
             if (self.role_arn):
                 params['RoleARN'] = self.role_arn
+            if (self.notification_arns):
+                params['NotificationARNs'] = self.notification_arns
 
-            result = self.boto3_client.create_stack(**params)
+            with metrics.timer('StackCreate', StackName=stack_name):
+                result = self.boto3_client.create_stack(**params)
+            self.invalidate_stack(stack_name)
 
-            result['WaitResult'] = self.waiter(result['StackId'], 'stack_create_complete')
+            result['WaitResult'] = self.wait(result['StackId'], 'stack_create_complete', stack_name)
 
         except botocore.exceptions.ClientError as e:
             raise Exception('Error creating CloudFormation stack "{0}"'.format(stack_name), e)
@@ -178,9 +383,11 @@ class IdelCloudFormation:
             if (self.role_arn):
                 params['RoleARN'] = self.role_arn
 
-            self.boto3_client.delete_stack(**params)
+            with metrics.timer('StackDelete', StackName=stack_name):
+                self.boto3_client.delete_stack(**params)
+            self.invalidate_stack(stack_name)
 
-            result['WaitResult'] = self.waiter(result['StackId'], 'stack_delete_complete')
+            result['WaitResult'] = self.wait(result['StackId'], 'stack_delete_complete', stack_name)
 
         except botocore.exceptions.ClientError as e:
             raise Exception('Error deleting CloudFormation stack "{0}"'.format(stack_name), e)
@@ -189,19 +396,178 @@ class IdelCloudFormation:
         return result
 
     #
-    def waiter(self, stack_name, wait_for):
+    def create_change_set(self, stack_name, change_set_name, template_body=None, parameters=[], capabilities=[], tags=[], template_url=None):
+        """Start creating a change set: CREATE if the stack does not exist yet (or was never executed), else UPDATE
+
+        Reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudformation.html#CloudFormation.Client.create_change_set
+
+        Returns:
+            Summary of the change set (see describe_change_set())
         """
+        change_set_type = 'CREATE'
+        if (self.stack_exists(stack_name)) and (self.get_stack(stack_name)['StackStatus']!='REVIEW_IN_PROGRESS'):
+            change_set_type = 'UPDATE'
+        self.logger.info('Create change set {} ({}) of stack {}'.format(change_set_name, change_set_type, stack_name))
+
+        try:
+            params = {}
+            params['StackName'] = stack_name
+            params['ChangeSetName'] = change_set_name
+            params['ChangeSetType'] = change_set_type
+            if (template_url):
+                params['TemplateURL'] = template_url
+            else:
+                params['TemplateBody'] = template_body
+            params['Parameters'] = parameters
+            params['Capabilities'] = capabilities
+            params['Tags'] = tags
+            if (self.role_arn):
+                params['RoleARN'] = self.role_arn
+            if (self.notification_arns):
+                params['NotificationARNs'] = self.notification_arns
+
+            with metrics.timer('ChangeSetCreate', StackName=stack_name, ChangeSetType=change_set_type):
+                response = self.boto3_client.create_change_set(**params)
+            self.invalidate_stack(stack_name)
+
+        except botocore.exceptions.ClientError as e:
+            raise Exception('Error creating change set of CloudFormation stack "{0}"'.format(stack_name), e)
+
+        return {
+            'StackName': stack_name,
+            'StackId': response['StackId'],
+            'ChangeSetId': response['Id'],
+            'ChangeSetType': change_set_type,
+            'Status': CHANGE_SET_PENDING
+        }
+
+    #
+    def describe_change_set(self, summary):
+        """Wait for a change set to be created then summarize it
+
+        Status of the summary:
+            - READY: to execute. `Changes` lists the resource changes.
+            - EMPTY: nothing to deploy. The change set is deleted.
+            - FAILED: `Reason`. The change set is deleted.
         """
-        self.logger.info('Wait for stack {} to be {}'.format(stack_name, wait_for))
         try:
-            waiter = self.boto3_client.get_waiter(wait_for)
-            waiter.wait(
-                StackName=stack_name,
-                WaiterConfig=CFN_WAITER_CONFIG
-            )
-            self.logger.info('Wait is over. DESIRABLE. Desired: {}'.format(wait_for))
-            return True
-        except botocore.exceptions.WaiterError as e:
-            self.logger.info('Wait is over. UN-DESIRABLE. Desired: {}'.format(wait_for))
-            return e
-            # raise Exception('Error waiting for CloudFormation stack "{0}"'.format(stack_name), e)
+            with metrics.timer('ChangeSetWait', StackName=summary['StackName']):
+                self.boto3_client.get_waiter('change_set_create_complete').wait(
+                    ChangeSetName=summary['ChangeSetId'],
+                    WaiterConfig=CFN_CHANGE_SET_WAITER_CONFIG
+                )
+        except botocore.exceptions.WaiterError:
+            # Failed or empty, see its status
+            pass
+
+        changes = []
+        params = {'ChangeSetName': summary['ChangeSetId']}
+        while True:
+            change_set = self.boto3_client.describe_change_set(**params)
+            changes.extend(change_set.get('Changes', []))
+            if (not change_set.get('NextToken')):
+                break
+            params['NextToken'] = change_set['NextToken']
+
+        if (change_set['Status']=='CREATE_COMPLETE') and (change_set.get('ExecutionStatus', 'AVAILABLE')=='AVAILABLE'):
+            summary['Status'] = CHANGE_SET_READY
+            summary['Changes'] = idec.summarize_resource_changes(changes)
+        else:
+            summary['Status'] = CHANGE_SET_EMPTY if (idec.is_empty_change_set(change_set)) else CHANGE_SET_FAILED
+            if (summary['Status']==CHANGE_SET_FAILED):
+                summary['Reason'] = change_set.get('StatusReason')
+            self.boto3_client.delete_change_set(ChangeSetName=summary['ChangeSetId'])
+
+        self.logger.info('Change set of stack {}: {}'.format(summary['StackName'], summary['Status']))
+        return summary
+
+    #
+    def execute_change_set(self, summary):
+        """Execute a READY change set
+
+        Raises:
+            botocore.exceptions.ClientError: `CHANGE_SET_STALE_ERRORS` if the change set is obsolete
+        """
+        self.logger.info('Execute change set of stack: {}'.format(summary['StackName']))
+
+        with metrics.timer('ChangeSetExecute', StackName=summary['StackName']):
+            self.boto3_client.execute_change_set(ChangeSetName=summary['ChangeSetId'])
+        self.invalidate_stack(summary['StackName'])
+
+        result = {}
+        result['StackId'] = summary['StackId']
+        result['Desire'] = 'CREATE_COMPLETE' if (summary['ChangeSetType']=='CREATE') else 'UPDATE_COMPLETE'
+        result['WaitResult'] = self.wait(result['StackId'], 'stack_'+result['Desire'].lower(), summary['StackName'])
+
+        return result
+
+    #
+    def is_blocking(self):
+        return self.wait_mode==WAIT_MODE_BLOCK
+
+    #
+    def wait(self, stack_name, wait_for, name=None):
+        """Wait for stack in blocking mode
+
+        Returns:
+            None in non-blocking modes since the status is resolved in next rounds,
+            else the result of waiter()
+        """
+        if (not self.is_blocking()):
+            self.logger.info('Do not wait for stack {} to be {} (wait mode: {}).'.format(stack_name, wait_for, self.wait_mode))
+            return None
+        return self.waiter(stack_name, wait_for, name)
+
+    #
+    def waiter(self, stack_name, wait_for, name=None, started=None):
+        """Wait for stack within the round
+
+        Checks are scheduled from the durations of the previous deployments of the stack (see idel_polling).
+        Waiting stops after `Delay`*`MaxAttempts` of `CFN_WAITER_CONFIG` or at the wait deadline of the round,
+        and does not start if the stack is not expected to be done by then.
+
+        Args:
+            stack_name: stack name or id to describe
+            name: stack name in the duration history (default: stack_name)
+            started: when the stack operation was started (default: now)
+
+        Returns:
+            True if the stack has the desired status,
+            None if it is still in progress (checked again in next rounds),
+            else an exception
+        """
+        desire = wait_for[len('stack_'):].upper()
+        schedule = self.duration_history.schedule(self.history_prefix+(name or stack_name), desire, started)
+        deadline = idel_polling.clock()+CFN_WAITER_CONFIG['Delay']*CFN_WAITER_CONFIG['MaxAttempts']
+        if (self.wait_deadline is not None):
+            deadline = min(deadline, self.wait_deadline)
+        if (schedule.expected_end() is not None) and (schedule.expected_end()>deadline):
+            self.logger.info('Stack {} is not expected to be {} within the round. Do not wait.'.format(stack_name, desire))
+            return None
+
+        self.logger.info('Wait for stack {} to be {}'.format(stack_name, wait_for))
+        check = schedule.first_check()
+        with metrics.timer('StackWait', StackName=stack_name, WaitFor=wait_for):
+            while True:
+                idel_polling.sleep(max(0, min(check, deadline)-idel_polling.clock()))
+                self.invalidate_stack(stack_name)
+                try:
+                    stack_status = self.get_stack(stack_name)['StackStatus']
+                except botocore.exceptions.ClientError as e:
+                    if ('does not exist' not in e.response['Error']['Message']):
+                        raise e
+                    stack_status = 'DELETE_COMPLETE'
+
+                done = idel_utils.stack_desire_corresponding_statuses(desire, stack_status)
+                if (done):
+                    self.logger.info('Wait is over. DESIRABLE. Desired: {}'.format(wait_for))
+                    return True
+                if (done is None):
+                    self.logger.info('Wait is over. UN-DESIRABLE. Desired: {}'.format(wait_for))
+                    return Exception('Stack {} is {}. Desired: {}'.format(stack_name, stack_status, desire))
+
+                now = idel_polling.clock()
+                if (now>=deadline):
+                    self.logger.info('Wait is over. Stack {} is still {}.'.format(stack_name, stack_status))
+                    return None
+                check = schedule.next_check(now)
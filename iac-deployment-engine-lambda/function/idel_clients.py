@@ -3,10 +3,92 @@ import os
 import botocore
 import boto3
 import logging
-import urllib3
-import json
+import hashlib
+import threading
+
+import idel_cache
+import idec
+from idec_throttle import scheduler
 
 NOTHING = 'nothing'
+BOTO3_MAX_POOL_CONNECTIONS = int(os.environ.get('BOTO3_MAX_POOL_CONNECTIONS', '10'))
+BOTO3_TCP_KEEPALIVE = os.environ.get('BOTO3_TCP_KEEPALIVE', 'true').lower()=='true'
+BOTO3_CLIENT_POOL_MAX = int(os.environ.get('BOTO3_CLIENT_POOL_MAX', '32'))
+
+# Clients: (service, region, credential fingerprint, config) -> boto3 client
+# Reused across blocks and warm invocations. Looked up for every handler, so HIT/MISS are logged at DEBUG.
+clients = idel_cache.IdelWarmCache('clients', max_entries=BOTO3_CLIENT_POOL_MAX, log_level=logging.DEBUG)
+# The default boto3 session is not thread-safe when creating clients
+clients_lock = threading.Lock()
+# Creates clients instead of boto3 if set: factory(service, region) -> client. Eg: in-process backend of the benchmark suite
+client_factory = None
+
+def set_client_factory(factory):
+    """Replace boto3 as the creator of clients (None to restore). Pooled clients are dropped.
+    """
+    global client_factory
+    client_factory = factory
+    clients.clear()
+    return
+
+def get_client(service, access_key_id=None, secret_access_key=None, session_token=None, region=None, pooled=True, **config):
+    """Get a pooled boto3 low-level client
+
+    Clients are created from the default session (so service models are loaded once)
+    then kept by (service, region, credential fingerprint). Their calls go through the request scheduler
+    (rate limit and retries of throttled calls) of that key.
+
+    Args:
+        service: boto3 service name
+        access_key_id, secret_access_key, session_token: explicit credential. Default credential chain if omitted.
+        region: region name. Default region if omitted.
+        pooled: False for credentials that are never seen twice (Eg: artifact credentials of a CodePipeline job).
+            The client is neither kept nor looked up, and shares the scheduler bucket of the default credential.
+        config: extra botocore Config options. Eg: signature_version='s3v4'
+    """
+    fingerprint = None
+    if (access_key_id) and (pooled):
+        fingerprint = hashlib.sha256('{}:{}:{}'.format(access_key_id, secret_access_key, session_token).encode('utf-8')).hexdigest()
+    key = (service, region, fingerprint, tuple(sorted(config.items())))
+
+    if (pooled):
+        client = clients.get(key)
+        if (client):
+            return client
+
+    with clients_lock:
+        logging.debug('Creating boto3 low-level client for {} (region: {}).'.format(service, region))
+        if (client_factory):
+            client = scheduler.attach(client_factory(service, region), key[:3])
+            return clients.put(key, client) if (pooled) else client
+        client = boto3.client(
+            service,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            aws_session_token=session_token,
+            region_name=region,
+            config=botocore.config.Config(
+                max_pool_connections=BOTO3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=BOTO3_TCP_KEEPALIVE,
+                **config
+            )
+        )
+    client = scheduler.attach(client, key[:3])
+    if (not pooled):
+        return client
+    return clients.put(key, client)
+
+def get_client_with_credential(service, credential, **config):
+    """Get a pooled boto3 low-level client within credentials of target AWS environment (secret)
+    """
+    return get_client(
+        service,
+        access_key_id=credential['ACCESS_KEY_ID'],
+        secret_access_key=credential['SECRET_ACCESS_KEY'],
+        session_token=credential.get('SESSION_TOKEN'),
+        region=credential['REGION'],
+        **config
+    )
 
 class IdelClients:
     boto3_client = None
@@ -24,17 +106,15 @@ class IdelClients:
         return
 
     #
-    def setup_boto3_client(self, service, credential):
+    def setup_boto3_client(self, service, credential, **config):
         """Set up boto3 client within credentials of target AWS environment
+
+        Args:
+            config: extra botocore Config options. Eg: read_timeout=30
         """
         logging.debug('Setting up boto3 low-level client for {}.'.format(service))
         logging.debug('credential: {}'.format(str(credential)))
-        self.boto3_client = boto3.client(
-            service,
-            aws_access_key_id=credential['ACCESS_KEY_ID'],
-            aws_secret_access_key=credential['SECRET_ACCESS_KEY'],
-            region_name=credential['REGION']
-        )
+        self.boto3_client = get_client_with_credential(service, credential, **config)
         logging.debug('Finish setting up boto3 low-level client for {}.'.format(service))
 
         return
@@ -58,3 +138,17 @@ class IdelClients:
             raise ValueError('The parameters you provided are incorrect: {}'.format(error))
 
         return result
+
+    #
+    def dynamic_stream(self, action, params, paginate=False, query=None):
+        """Same as dynamic_call(), as a generator of pages or of the values of `query` (see idec.stream_aws_call())
+        """
+        if (NOTHING==getattr(self.boto3_client, action, NOTHING)):
+            raise Exception('Function \'{}\' not found!'.format(action))
+        if (paginate) and (not self.boto3_client.can_paginate(action)):
+            raise Exception('Function \'{}\' cannot be paginated!'.format(action))
+
+        try:
+            yield from idec.stream_aws_call(self.boto3_client, action, params, paginate, query)
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
@@ -1,8 +1,9 @@
 # idel_cp.py
 import os
-import boto3
 import logging
 
+import idel_clients
+
 class IdelCodePipeline:
     """
     """
@@ -15,7 +16,7 @@ class IdelCodePipeline:
         self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
 
         # Setup boto3 client
-        self.boto3_client = boto3.client('codepipeline')
+        self.boto3_client = idel_clients.get_client('codepipeline')
 
         # Log DEBUG
         self.logger.debug('Init class {}'.format(self.__str__()))
@@ -0,0 +1,234 @@
+# idel_drift.py
+"""Drift detection of the stacks to update, before the first round deploys anything
+
+Detection takes from seconds to minutes per stack, so it is started for all stacks at once
+and the detections are polled together: the pre-flight costs about one detection in total.
+
+Policies (`DRIFT_POLICY`, or `Drift` of a `cfn` block):
+    - `off`: no detection (default)
+    - `proceed`: detect and report, then deploy
+    - `warn`: same as `proceed`, drifted stacks are logged as warnings
+    - `abort`: fail the job before any deployment if a stack to update drifted
+"""
+
+import os
+import json
+import logging
+import threading
+import botocore
+from concurrent.futures import ThreadPoolExecutor
+
+import idel_polling
+from idel_store import IdelPlanStore, PLAN_STORE
+from idec_metrics import metrics
+
+DRIFT_POLICY_OFF = 'off'
+DRIFT_POLICY_PROCEED = 'proceed'
+DRIFT_POLICY_WARN = 'warn'
+DRIFT_POLICY_ABORT = 'abort'
+DRIFT_POLICIES = [DRIFT_POLICY_OFF, DRIFT_POLICY_PROCEED, DRIFT_POLICY_WARN, DRIFT_POLICY_ABORT]
+DRIFT_POLICY = os.environ.get('DRIFT_POLICY', DRIFT_POLICY_OFF)
+# Seconds. Detections still running after this are reported as UNKNOWN.
+DRIFT_DETECTION_TIMEOUT = float(os.environ.get('DRIFT_DETECTION_TIMEOUT', '300'))
+DRIFT_POLL_DELAY = 5
+# Results are reused for the same stack and template within this time (seconds). 0 to disable.
+DRIFT_CACHE_TTL = float(os.environ.get('DRIFT_CACHE_TTL', '900'))
+DRIFT_CACHE_STORE = os.environ.get('DRIFT_CACHE_STORE', PLAN_STORE)
+DRIFT_CACHE_FILE = 'cfn-drifts.json'
+DRIFT_CACHE_VERSION = 1
+# Stack drift statuses
+DRIFT_DRIFTED = 'DRIFTED'
+DRIFT_IN_SYNC = 'IN_SYNC'
+DRIFT_UNKNOWN = 'UNKNOWN'
+# Detectors of many targets share the cache file
+cache_lock = threading.Lock()
+
+class IdelDriftDetector:
+    """Detect drifts of many stacks at once, with results cached by stack name and template digest
+
+    Cache: one JSON object {"Version": 1, "Drifts": {"<prefix><stack name>|<digest>": {<result>}}}
+    """
+    logger = None
+    boto3_client = None
+    store = None
+    max_workers = None
+    prefix = None
+
+    def __init__(self, boto3_client, location=None, max_workers=10, prefix=''):
+        """
+        Args:
+            prefix: of the stack names in the cache. Eg: `<account>/<region>/` of a target
+        """
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.boto3_client = boto3_client
+        if (location is None):
+            location = DRIFT_CACHE_STORE
+        if (location) and (DRIFT_CACHE_TTL>0):
+            self.store = IdelPlanStore(location)
+        self.max_workers = max_workers
+        self.prefix = prefix
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def key(self, stack_name, digest):
+        return '{}{}|{}'.format(self.prefix, stack_name, digest)
+
+    #
+    def read_cache(self):
+        if (self.store is None):
+            return {}
+        raw = self.store.read(self.store.path('', DRIFT_CACHE_FILE))
+        if (raw is None):
+            return {}
+        try:
+            cache = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            self.logger.warning('Drift cache is corrupted. Ignore.')
+            return {}
+        if (cache.get('Version')!=DRIFT_CACHE_VERSION):
+            return {}
+        now = idel_polling.clock()
+        return {key: result for key, result in cache['Drifts'].items() if (now-result['Checked']<DRIFT_CACHE_TTL)}
+
+    #
+    def save_cache(self, results):
+        """Merge the new results into the stored cache. Unknown results are not cached.
+        """
+        if (self.store is None):
+            return
+        with cache_lock:
+            cache = self.read_cache()
+            cache.update({key: result for key, result in results.items() if (result['Status']!=DRIFT_UNKNOWN)})
+            self.store.write(
+                self.store.path('', DRIFT_CACHE_FILE),
+                json.dumps({'Version': DRIFT_CACHE_VERSION, 'Drifts': cache}, separators=(',', ':')).encode('utf-8')
+            )
+        return
+
+    #
+    def run_concurrently(self, func, items):
+        if (len(items)<=1):
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(items)))) as executor:
+            return list(executor.map(func, items))
+
+    #
+    def detect(self, stacks, deadline=None):
+        """Detect the drifts of the stacks
+
+        Args:
+            stacks: list of (stack name, template digest)
+            deadline: time (`idel_polling.clock`) after which detections are not waited for
+
+        Returns:
+            Mapping of stack name -> {'StackName', 'Status': DRIFTED|IN_SYNC|UNKNOWN, 'DriftedResources', 'Reason', 'Checked', 'Cached'}
+        """
+        results = {}
+        cache = self.read_cache()
+        pending = []
+        for stack_name, digest in stacks:
+            key = self.key(stack_name, digest)
+            if (key in cache):
+                results[key] = dict(cache[key], Cached=True)
+            else:
+                pending.append((stack_name, digest))
+        self.logger.info('Detect drifts of [{}] stack(s), [{}] from cache.'.format(len(pending), len(stacks)-len(pending)))
+
+        if (pending):
+            with metrics.timer('DriftDetection', Stacks=len(pending)):
+                detected = self.detect_pending(pending, deadline)
+            results.update(detected)
+            self.save_cache(detected)
+
+        return {result['StackName']: result for result in results.values()}
+
+    #
+    def detect_pending(self, stacks, deadline=None):
+        timeout = idel_polling.clock()+DRIFT_DETECTION_TIMEOUT
+        deadline = timeout if (deadline is None) else min(deadline, timeout)
+
+        # Start all detections
+        detections = {}
+        results = {}
+        for (stack_name, digest), started in zip(stacks, self.run_concurrently(lambda stack: self.start_detection(stack[0]), stacks)):
+            key = self.key(stack_name, digest)
+            if (isinstance(started, Exception)):
+                results[key] = self.result(stack_name, DRIFT_UNKNOWN, reason=str(started))
+            else:
+                detections[key] = (stack_name, started)
+
+        # Poll them together
+        while (detections):
+            idel_polling.sleep(DRIFT_POLL_DELAY)
+            statuses = self.run_concurrently(lambda key: (key, self.get_detection_status(detections[key][1])), list(detections))
+            for key, status in statuses:
+                stack_name = detections[key][0]
+                if (status['DetectionStatus']=='DETECTION_IN_PROGRESS'):
+                    continue
+                del detections[key]
+                if (status.get('StackDriftStatus') in [DRIFT_DRIFTED, DRIFT_IN_SYNC]):
+                    results[key] = self.result(stack_name, status['StackDriftStatus'])
+                else:
+                    results[key] = self.result(stack_name, DRIFT_UNKNOWN, reason=status.get('DetectionStatusReason'))
+            if (detections) and (idel_polling.clock()>=deadline):
+                for key, (stack_name, detection_id) in detections.items():
+                    results[key] = self.result(stack_name, DRIFT_UNKNOWN, reason='Detection did not complete in time.')
+                break
+
+        # Resources of the drifted stacks
+        drifted = [key for key, result in results.items() if (result['Status']==DRIFT_DRIFTED)]
+        for key, resources in zip(drifted, self.run_concurrently(lambda key: self.get_drifted_resources(results[key]['StackName']), drifted)):
+            results[key]['DriftedResources'] = resources
+
+        return results
+
+    #
+    def start_detection(self, stack_name):
+        """
+        Returns:
+            Detection ID, or the exception if the detection cannot be started (Eg: stack in progress)
+        """
+        try:
+            return self.boto3_client.detect_stack_drift(StackName=stack_name)['StackDriftDetectionId']
+        except botocore.exceptions.ClientError as e:
+            self.logger.warning('Cannot detect drift of stack {}: {}'.format(stack_name, e))
+            return e
+
+    #
+    def get_detection_status(self, detection_id):
+        return self.boto3_client.describe_stack_drift_detection_status(StackDriftDetectionId=detection_id)
+
+    #
+    def get_drifted_resources(self, stack_name):
+        """
+        Returns:
+            List of `<logical id> (<type>): <MODIFIED|DELETED>`
+        """
+        resources = []
+        params = {'StackName': stack_name, 'StackResourceDriftStatusFilters': ['MODIFIED', 'DELETED']}
+        # No paginator in boto3 for this operation
+        while True:
+            page = self.boto3_client.describe_stack_resource_drifts(**params)
+            for drift in page['StackResourceDrifts']:
+                resources.append('{} ({}): {}'.format(drift['LogicalResourceId'], drift['ResourceType'], drift['StackResourceDriftStatus']))
+            if (not page.get('NextToken')):
+                break
+            params['NextToken'] = page['NextToken']
+        return resources
+
+    #
+    def result(self, stack_name, status, reason=None):
+        return {
+            'StackName': stack_name,
+            'Status': status,
+            'DriftedResources': [],
+            'Reason': reason,
+            'Checked': idel_polling.clock()
+        }
@@ -0,0 +1,186 @@
+# idel_events.py
+
+import os
+import abc
+import json
+import logging
+
+import idel_clients
+
+# Constants
+WAIT_MODE_BLOCK = 'block'
+WAIT_MODE_POLL = 'poll'
+WAIT_MODE_EVENT = 'event'
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+class IdelEventSource(abc.ABC):
+    """Source of CloudFormation stack statuses for in-flight stacks
+
+    Sub-classes implement get_stack_statuses().
+    """
+    logger = None
+
+    def __init__(self):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    @abc.abstractmethod
+    def get_stack_statuses(self, stack_ids):
+        """Get statuses of stacks
+
+        Args:
+            stack_ids: list of stack ids
+
+        Returns:
+            Mapping of stack id -> stack status. Stacks without a known status are omitted.
+        """
+
+class IdelPollingEventSource(IdelEventSource):
+    """Poll stack statuses once per round via DescribeStacks
+    """
+    cfn_handler = None
+
+    def __init__(self, cfn_handler):
+        super().__init__()
+        self.cfn_handler = cfn_handler
+        return
+
+    #
+    def get_stack_statuses(self, stack_ids):
+        statuses = {}
+        for stack_id in stack_ids:
+            stack = self.cfn_handler.get_stack(stack_id)
+            statuses[stack_id] = stack['StackStatus']
+        return statuses
+
+class IdelSqsEventSource(IdelEventSource):
+    """Stack statuses from CloudFormation stack notifications
+
+    CloudFormation publishes stack events to the SNS topics declared in `NotificationARNs`.
+    The topic is subscribed by an SQS queue which is read by this event source.
+    Stacks without notification keep their last known status (in progress).
+    """
+    boto3_client = None
+    queue_url = None
+    wait_seconds = None
+
+    def __init__(self, queue_url, wait_seconds=20):
+        super().__init__()
+        self.queue_url = queue_url
+        self.wait_seconds = wait_seconds
+        self.boto3_client = idel_clients.get_client('sqs')
+        return
+
+    #
+    def get_stack_statuses(self, stack_ids):
+        statuses = {}
+        if (not stack_ids):
+            return statuses
+
+        timestamps = {}
+        wait_seconds = self.wait_seconds
+        while True:
+            response = self.boto3_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=wait_seconds
+            )
+            messages = response.get('Messages', [])
+            if (not messages):
+                break
+            # Drain the queue without waiting
+            wait_seconds = 0
+
+            for message in messages:
+                event = parse_stack_notification(message['Body'])
+                if (not event) or (event['StackId'] not in stack_ids):
+                    # Not ours. It will be visible again for the others.
+                    continue
+                # Standard queues do not keep order, so keep the latest event
+                if (event['StackId'] not in timestamps) or (timestamps[event['StackId']]<=event['Timestamp']):
+                    timestamps[event['StackId']] = event['Timestamp']
+                    statuses[event['StackId']] = event['ResourceStatus']
+                self.boto3_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+        self.logger.info('Stack statuses from notifications: {}'.format(str(statuses)))
+        return statuses
+
+class IdelFakeEventSource(IdelEventSource):
+    """In-process event source. Statuses are published by the caller (tests, benchmarks)
+    """
+    statuses = None
+
+    def __init__(self):
+        super().__init__()
+        self.statuses = {}
+        return
+
+    #
+    def publish(self, stack_id, stack_status):
+        self.statuses[stack_id] = stack_status
+        return
+
+    #
+    def get_stack_statuses(self, stack_ids):
+        return {stack_id: self.statuses[stack_id] for stack_id in stack_ids if (stack_id in self.statuses)}
+
+def parse_stack_notification(body):
+    """Parse a CloudFormation stack notification delivered through SNS to SQS
+
+    The SNS `Message` is a list of lines `Key='Value'`.
+
+    Returns:
+        {'StackId': ..., 'StackName': ..., 'ResourceStatus': ..., 'Timestamp': ...} for stack level events, else None
+    """
+    try:
+        message = json.loads(body).get('Message', body)
+    except ValueError:
+        message = body
+
+    event = {}
+    for line in message.splitlines():
+        if ('=' not in line):
+            continue
+        key, value = line.split('=', 1)
+        event[key.strip()] = value.strip().strip('\'')
+
+    if (event.get('ResourceType')!=STACK_RESOURCE_TYPE) or ('StackId' not in event) or ('ResourceStatus' not in event):
+        return None
+    # Nested stacks are resources of the parent stack
+    if (event.get('LogicalResourceId', event.get('StackName'))!=event.get('StackName')):
+        return None
+
+    return {
+        'StackId': event['StackId'],
+        'StackName': event.get('StackName'),
+        'ResourceStatus': event['ResourceStatus'],
+        'Timestamp': event.get('Timestamp', '')
+    }
+
+def get_event_source(wait_mode, cfn_handler):
+    """Event source according to the wait mode
+
+    The event mode needs both the topics (`CFN_NOTIFICATION_ARNS`) and the queue (`CFN_EVENT_QUEUE_URL`),
+    else no status would ever arrive: it falls back to the poll mode with a warning.
+
+    Returns:
+        (wait mode, event source): the wait mode actually used, to be set on the CloudFormation handler
+    """
+    if (wait_mode==WAIT_MODE_EVENT):
+        queue_url = os.environ.get('CFN_EVENT_QUEUE_URL')
+        missing = [name for name, value in [('CFN_NOTIFICATION_ARNS', cfn_handler.notification_arns), ('CFN_EVENT_QUEUE_URL', queue_url)] if (not value)]
+        if (not missing):
+            return wait_mode, IdelSqsEventSource(
+                queue_url=queue_url,
+                wait_seconds=int(os.environ.get('CFN_EVENT_WAIT_SECONDS', '20'))
+            )
+        logging.getLogger().warning('CFN_WAIT_MODE is {} but {} not set: stacks are polled instead.'.format(WAIT_MODE_EVENT, ' and '.join(missing)))
+        wait_mode = WAIT_MODE_POLL
+    return wait_mode, IdelPollingEventSource(cfn_handler)
@@ -1,19 +1,35 @@
-# idel_iac.py
+# idel_main.py
 
 import os
-import json
+import re
 import traceback
 import logging
-import yaml
-from yaml import load, dump, Loader, Dumper
+import threading
+import botocore
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from logdecorator import log_on_start, log_on_end, log_on_error, log_exception
 
+import idec
 import idel_utils
+import idel_cache
+from idel_planner import IdelPlanner, encode_block_set, decode_block_set
 from idel_s3 import IdelS3
 from idel_cp import IdelCodePipeline
-from idel_cfn import IdelCloudFormation
+from idel_cfn import IdelCloudFormation, CFN_TEMPLATE_STAGING, DEPLOY_METHOD_CHANGE_SET, CHANGE_SET_READY, CHANGE_SET_EMPTY, CHANGE_SET_FAILED, CHANGE_SET_STALE_ERRORS
 from idel_sm import IdelSecretsManager
+import idel_clients
 from idel_clients import IdelClients
+from idel_events import get_event_source, IdelPollingEventSource, WAIT_MODE_EVENT, WAIT_MODE_POLL
+from idel_store import IdelPlanStore, PLAN_STORE
+from idel_token import IdelTokenCodec
+from idel_targets import get_target_credential
+import idel_polling
+from idel_polling import IdelDurationHistory
+from idel_drift import IdelDriftDetector, DRIFT_POLICY, DRIFT_POLICIES, DRIFT_POLICY_OFF, DRIFT_POLICY_PROCEED, DRIFT_POLICY_ABORT, DRIFT_DRIFTED, DRIFT_IN_SYNC
+from idel_profiler import profiler
+from idec_metrics import metrics, UNIT_SECONDS, UNIT_COUNT
+from idec_throttle import scheduler
 
 # Constants
 STR_CFN = 'cfn'
@@ -28,10 +44,20 @@ CHANGE_MODE_OFF = 'off'
 INVENTORY_FILE = '.inventory.yaml'
 STATUS_DONE = 'DONE'
 STATUS_WAITING = 'WAITING'
-ARTIFACT_DIR = os.environ['ARTIFACT_DIR']
 CHANGES_FILE = os.environ['CHANGES_FILE']
 SECRET_NAME = os.environ['SECRET_NAME']
 WAITING_OCCURRENCE = int(os.environ['WAITING_OCCURRENCE'])
+MAX_PARALLEL_BLOCKS = int(os.environ.get('MAX_PARALLEL_BLOCKS', '10'))
+# In-flight blocks per target (`Targets` of blocks, the default target included). 0 for no limit.
+MAX_PARALLEL_BLOCKS_PER_TARGET = int(os.environ.get('MAX_PARALLEL_BLOCKS_PER_TARGET', '0'))
+# Seconds to connect and to read the response of the call of an `aws` block (`Timeout` of the block)
+AWS_BLOCK_TIMEOUT = int(os.environ.get('AWS_BLOCK_TIMEOUT', '60'))
+# Results of `aws` blocks bigger than this (bytes, JSON) are stored truncated
+AWS_RESULT_MAX_SIZE = int(os.environ.get('AWS_RESULT_MAX_SIZE', '65536'))
+# Do not launch another wave of blocks within a round if the remaining time (seconds) is less than this
+ROUND_TIME_RESERVE = int(os.environ.get('ROUND_TIME_RESERVE', '660'))
+# Stop waiting for stacks within a round when the remaining time (seconds) is less than this
+ROUND_WAIT_RESERVE = 30
 
 class IdelIaC:
     #
@@ -40,11 +66,35 @@ class IdelIaC:
     context = None
     secret = None
 
-    # handlers
-    cp_handler = None
-    sm_handler = None
-    s3_handler = None
-    cfn_handler = None
+    # handlers (created on first use, see properties)
+    _cp_handler = None
+    _sm_handler = None
+    _s3_handler = None
+    _cfn_handler = None
+    # handlers of the other targets by target key (`<account>/<region>`), see cfn_for()
+    cfn_handlers = None
+    cfn_handlers_lock = None
+
+    # execution planner
+    change_mode = None
+    planner = None
+    _plan_store = None
+    _duration_history = None
+    _template_staging = None
+
+    # change set summaries by block order (string), see prepare_change_sets()
+    change_sets = None
+    change_sets_lock = None
+    sequence = None
+
+    # outputs of stacks by stack_key(), see get_stack_outputs()
+    outputs = None
+    outputs_lock = None
+    outputs_changed = False
+
+    # stack statuses of in-flight blocks
+    event_source = None
+    stack_statuses = None
 
     # codepipeline variables
     cp_job_id = None
@@ -52,6 +102,8 @@ class IdelIaC:
     cp_user_params = None
     cp_artifact = None
     cp_artifact_s3 = None
+    artifact = None
+    artifact_key = None
 
     def __init__(self, event, context):
         # Setup logging
@@ -60,17 +112,137 @@ class IdelIaC:
 
         self.event = event
         self.context = context
-
-        self.s3_handler = IdelS3(event['CodePipeline.job']['data']['artifactCredentials'])
-        self.cp_handler = IdelCodePipeline()
-        self.cfn_handler = IdelCloudFormation()
-        self.sm_handler = IdelSecretsManager()
+        self.change_sets_lock = threading.Lock()
+        self.outputs_lock = threading.Lock()
+        self.cfn_handlers = {}
+        self.cfn_handlers_lock = threading.Lock()
 
         # Log
         self.logger.info('Finish instantiating class: {}'.format(self.__str__()))
 
         return
 
+    # Handlers are created on first use. Eg: a polling round does not touch the artifact at all.
+    @property
+    def cp_handler(self):
+        if (self._cp_handler is None):
+            with profiler.measure('init IdelCodePipeline'):
+                self._cp_handler = IdelCodePipeline()
+        return self._cp_handler
+
+    #
+    @property
+    def sm_handler(self):
+        if (self._sm_handler is None):
+            with profiler.measure('init IdelSecretsManager'):
+                self._sm_handler = IdelSecretsManager()
+        return self._sm_handler
+
+    #
+    @property
+    def s3_handler(self):
+        if (self._s3_handler is None):
+            with profiler.measure('init IdelS3'):
+                self._s3_handler = IdelS3(self.event['CodePipeline.job']['data']['artifactCredentials'])
+        return self._s3_handler
+
+    #
+    @property
+    def cfn_handler(self):
+        if (self._cfn_handler is None):
+            with profiler.measure('init IdelCloudFormation'):
+                self._cfn_handler = IdelCloudFormation(self.duration_history)
+        return self._cfn_handler
+
+    #
+    def cfn_for(self, target):
+        """CloudFormation handler of a target key (`<account>/<region>`), the default one for None
+
+        Notifications (`CFN_NOTIFICATION_ARNS`) are topics of the default target, so other targets are polled.
+        """
+        if (target is None):
+            return self.cfn_handler
+        with self.cfn_handlers_lock:
+            if (target not in self.cfn_handlers):
+                with profiler.measure('init IdelCloudFormation'):
+                    cfn_handler = IdelCloudFormation(self.duration_history)
+                cfn_handler.setup_boto3_client(get_target_credential(self.secret, idec.parse_target_key(target)))
+                cfn_handler.set_wait_deadline(self.cfn_handler.wait_deadline)
+                cfn_handler.notification_arns = []
+                cfn_handler.history_prefix = target+'/'
+                if (cfn_handler.wait_mode==WAIT_MODE_EVENT):
+                    cfn_handler.wait_mode = WAIT_MODE_POLL
+                self.cfn_handlers[target] = cfn_handler
+            return self.cfn_handlers[target]
+
+    #
+    def cfn_of(self, change):
+        return self.cfn_for(idec.target_key(change.get('Target')))
+
+    #
+    def credential_of(self, change):
+        """Credential of the target of a block, the secret for the default target
+        """
+        if (not change.get('Target')):
+            return self.secret
+        return get_target_credential(self.secret, change['Target'])
+
+    #
+    def history_name(self, block, stack_name):
+        """Name of a stack in the duration history: `<account>/<region>/<stack name>` for the other targets
+        """
+        return self.stack_key(self.planner.targets[block], stack_name)
+
+    #
+    def stack_key(self, target, stack_name):
+        if (target) and (stack_name):
+            return '{}/{}'.format(target, stack_name)
+        return stack_name
+
+    #
+    @property
+    def plan_store(self):
+        if (self._plan_store is None) and (PLAN_STORE):
+            with profiler.measure('init IdelPlanStore'):
+                self._plan_store = IdelPlanStore(PLAN_STORE)
+        return self._plan_store
+
+    #
+    @property
+    def state_store(self):
+        """The plan store if it keeps the state of the pipeline execution across rounds (results, outputs, change sets,
+        overflowing tokens): on S3 only, as the next round may run in another Lambda container. None otherwise.
+
+        A local plan store only caches the compiled plan, which is compiled again if it is missing.
+        """
+        if (self.plan_store) and (self.plan_store.is_s3()):
+            return self.plan_store
+        return None
+
+    #
+    @property
+    def duration_history(self):
+        if (self._duration_history is None):
+            self._duration_history = IdelDurationHistory()
+        return self._duration_history
+
+    #
+    @property
+    def template_staging(self):
+        """Template staging of the target AWS environment (shared across warm invocations), None if disabled
+        """
+        if (self._template_staging is None) and (CFN_TEMPLATE_STAGING):
+            key = (CFN_TEMPLATE_STAGING, self.secret['REGION'], self.secret['ACCESS_KEY_ID'])
+            staging = idel_cache.template_stagings.get(key)
+            if (staging is None):
+                staging = idel_cache.template_stagings.put(key, idec.IdecTemplateStaging(
+                    idel_clients.get_client_with_credential('s3', self.secret),
+                    CFN_TEMPLATE_STAGING,
+                    self.secret['REGION']
+                ))
+            self._template_staging = staging
+        return self._template_staging
+
     @log_on_start(logging.INFO, "Start processing.")
     @log_on_end(logging.INFO, "End processing.")
     def process(self):
@@ -85,41 +257,28 @@ class IdelIaC:
 
             # LOGGING
             self.logger.info('Pipeline execution ID: {}'.format(self.cp_user_params['Pipeline']['ExecutionId']))
-
-            # Download artifact
-            self.s3_handler.download_artifact(
-                s3_bucket=self.cp_artifact['location']['s3Location']['bucketName'],
-                s3_object=self.cp_artifact['location']['s3Location']['objectKey'],
-                af_dir=ARTIFACT_DIR
-            )
+            metrics.set_dimensions(Engine='idel')
+            metrics.set_properties(PipelineExecutionId=self.cp_user_params['Pipeline']['ExecutionId'])
 
             # Get secret
             self.secret = self.sm_handler.get_secret(SECRET_NAME)
 
             # Set up boto3 handler for CloudFormation
             self.cfn_handler.setup_boto3_client(self.secret)
+            if (hasattr(self.context, 'get_remaining_time_in_millis')):
+                self.cfn_handler.set_wait_deadline(idel_polling.clock()+self.context.get_remaining_time_in_millis()/1000-ROUND_WAIT_RESERVE)
+            self.cfn_handler.wait_mode, self.event_source = get_event_source(self.cfn_handler.wait_mode, self.cfn_handler)
 
             # Selective decision based on continuation data
             continuation = self.get_continuation_token()
 
-            # If Status is STATUS_WAITING and Occurrence is over WAITING_OCCURRENCE times
-            # throw exception then exit pipeline
-            if (STATUS_WAITING==continuation['Status']) and (WAITING_OCCURRENCE<int(continuation['Occurrence'])):
-                raise Exception('Waiting too much. Exit!')
-
-            # Get changes deployment script
-            changes = self.get_changes()
+            # Get the execution plan of changes deployment script
+            changes = self.get_plan()
 
-            # New or still?
-            if (continuation['Status']==STATUS_DONE):
-                # Previous block is done
-                # it's time to process new block
-                self.process_new_block(continuation, changes)
-
-            elif (continuation['Status']==STATUS_WAITING):
-                # Previous block is not done yet
-                # so we are going to get the status
-                self.process_old_block(continuation, changes)
+            # Poll in-flight blocks then launch the ready ones
+            if (continuation['Status'] in [STATUS_DONE, STATUS_WAITING]):
+                with metrics.timer('RoundDuration', Sequence=continuation['Sequence'], InFlight=len(continuation['InFlight'])):
+                    self.process_round(continuation, changes)
 
             else:
                 self.cp_handler.put_job_failure(self.cp_job_id, 'Unknown status')
@@ -131,79 +290,144 @@ class IdelIaC:
             self.logger.error(e)
             traceback.print_exc()
 
+            # The cached secret may be rotated. Get it again in next execution.
+            if (idel_utils.is_credential_error(e)):
+                self.sm_handler.invalidate_secret(SECRET_NAME)
+
             self.cp_handler.put_job_failure(self.cp_job_id, 'Function exception: ' + str(e))
 
+        self.report_throttles()
         return None
 
+    #
+    def report_throttles(self):
+        """Throttled API calls absorbed by the request scheduler (retried) within the invocation
+        """
+        throttles, waited = scheduler.drain()
+        for service, count in throttles.items():
+            metrics.record('ApiThrottles', count, UNIT_COUNT, Service=service)
+        if (throttles) or (waited):
+            self.logger.info('API throttles absorbed: {} ({:.1f}s spent waiting for the rate limits).'.format(dict(throttles), waited))
+        return
+
+    #
+    def get_artifact(self):
+        """Get artifact from the warm container cache, else from S3
+
+        The cache is keyed by bucket/key/ETag. ETag is checked by a HEAD request.
+        """
+        s3_bucket = self.cp_artifact['location']['s3Location']['bucketName']
+        s3_object = self.cp_artifact['location']['s3Location']['objectKey']
+        etag = self.s3_handler.get_artifact_etag(s3_bucket, s3_object)
+        self.artifact_key = (s3_bucket, s3_object, etag)
+
+        self.artifact = idel_cache.artifacts.get(self.artifact_key)
+        if (not self.artifact):
+            with metrics.timer('ArtifactDownload'):
+                artifact = self.s3_handler.open_artifact(s3_bucket=s3_bucket, s3_object=s3_object)
+            self.artifact = idel_cache.artifacts.put(self.artifact_key, artifact)
+
+        return self.artifact
+
+    @log_on_start(logging.INFO, "Start getting execution plan.")
+    @log_on_end(logging.INFO, "End getting execution plan.")
+    def get_plan(self):
+        """Get the execution plan (change mode, planner and decorated changes)
+
+        1. From the warm container cache.
+        2. From the plan store (PLAN_STORE), keyed by pipeline execution ID. Blocks are loaded on demand.
+        3. Else compile: get_changes() then build the planner, and save to the plan store.
+
+        Returns:
+            Decorated changes (sequence)
+        """
+        execution_id = self.cp_user_params['Pipeline']['ExecutionId']
+        s3_location = self.cp_artifact['location']['s3Location']
+        plan_key = (s3_location['bucketName'], s3_location['objectKey'], execution_id, CHANGES_FILE)
+
+        cached = idel_cache.plans.get(plan_key)
+        if (cached):
+            self.change_mode, self.planner, changes = cached
+            self.logger.info('Change mode: {}'.format(self.change_mode))
+            return changes
+
+        header = None
+        if (self.plan_store):
+            header, changes = self.plan_store.load(execution_id)
+
+        if (header):
+            self.change_mode = header['Mode']
+            self.planner = IdelPlanner(dependencies=header['Dependencies'], stacks=header['Stacks'], targets=header.get('Targets'))
+            self.logger.info('Change mode: {}'.format(self.change_mode))
+        else:
+            changes = self.get_changes()
+            self.planner = IdelPlanner(changes, reverse=idec.is_reverse_mode(self.change_mode))
+            if (self.plan_store):
+                self.plan_store.save(execution_id, self.change_mode, self.planner, changes)
+
+        idel_cache.plans.put(plan_key, (self.change_mode, self.planner, changes))
+        return changes
+
     @log_on_start(logging.INFO, "Start getting changes deployment script.")
     @log_on_end(logging.INFO, "End getting changes deployment script. Return: (Omitted. Please run debug.)")
     @log_on_end(logging.DEBUG, "End getting changes deployment script. Return: {result!r}")
     def get_changes(self):
-        """Get list of changes
-        Then convert Template reference path to TemplateBody
+        """Get list of changes through the shared change pipeline (idec)
+        Template reference paths are converted to TemplateBody on demand (get_template_body)
         """
-        with open(ARTIFACT_DIR+CHANGES_FILE, encoding='utf-8') as file:
-            raw_data_changes = file.read()
-        data_changes = yaml.load(raw_data_changes, Loader=Loader)
-        idel_utils.validate_changes(data_changes)
+        self.get_artifact()
+        # PyYAML is only needed when the plan is compiled, so it is not imported at cold start
+        with profiler.measure('load changes'):
+            data_changes, changes = idec.load_changes(self.artifact, CHANGES_FILE)
 
         change_mode = data_changes['Mode']
-
-        raw_data_inventory = None
-        data_inventory = None
-
-        if (change_mode in [CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
-            with open(ARTIFACT_DIR+INVENTORY_FILE, encoding='utf-8') as file:
-                raw_data_inventory = file.read()
-            data_inventory = yaml.load(raw_data_inventory, Loader=Loader)
-            idel_utils.validate_inventory(data_inventory)
+        self.change_mode = change_mode
 
         # LOGGING
         self.logger.info('Change mode: {}'.format(change_mode))
         if ('Description' in data_changes):
             self.logger.info('Change\'s overall description: {}'.format(str(data_changes['Description'])))
 
-        if (not raw_data_inventory):
-            changes = data_changes['Changes']
-        else:
-            changes = data_inventory['Inventory']
-            if (change_mode in [CHANGE_MODE_DESTROY,CHANGE_MODE_OFF]):
-                changes.reverse()
-
-        # Decorate changes
-        decorated_changes = list()
-        for i, change in enumerate(changes):
-            self.logger.debug('i: {}'.format(i))
+        decorated_changes = list(idec.decorate_changes(self.artifact, change_mode, changes))
 
-            # Eliminate inappropriate objects
-            if (idel_utils.skip_object(change_mode, change)):
-                continue
+        self.logger.info('Processing [{}] objects.'.format(len(decorated_changes)))
+        return decorated_changes
 
-            # `cfn` blocks: force `Action` property
-            if (change['Object']==STR_CFN):
-                if ('Action' not in change):
-                    change['Action'] = ''
-                change['Action'] = idel_utils.override_cfn_action(change_mode, change['Action'])
+    #
+    def get_template_body(self, change):
+        """Convert the referred relative path template to string (Body) once
+        """
+        if ('TemplateBody' not in change) and (not self.artifact):
+            self.get_artifact()
+        return idec.get_template_body(self.artifact, change)
 
-            # `cfn` blocks in modes: provision/change/on
-            # we need to convert the referred relative path template to string (Body)
-            if (change['Object']==STR_CFN) and (change['Action']==STR_DEPLOY):
-                with open(ARTIFACT_DIR+change['Template'], encoding='utf-8') as file:
-                    template_body = file.read()
-                change['TemplateBody'] = template_body
+    #
+    def get_template(self, change):
+        """Template argument of a deploy call: `template_url` when templates are staged, else `template_body`
+        A template already staged (same digest) is neither read nor uploaded again.
+        Templates are staged for the default target only: the staging bucket is in its account and region.
+        """
+        if (not change.get('Target')) and (self.template_staging):
+            digest = change.get('TemplateDigest') or idec.sha256(self.get_template_body(change))
+            return {'template_url': self.template_staging.stage(digest, lambda: self.get_template_body(change))}
 
-            decorated_changes.append(change)
-        # /Decorate changes
+        template_body = self.get_template_body(change)
+        if (len(template_body.encode('utf-8'))>idec.CFN_TEMPLATE_BODY_MAX_SIZE):
+            raise Exception('Template of stack {} is larger than {} bytes. Set CFN_TEMPLATE_STAGING to deploy it through S3.'.format(change['Stack'], idec.CFN_TEMPLATE_BODY_MAX_SIZE))
+        return {'template_body': template_body}
 
-        self.logger.info('Processing [{}] objects.'.format(len(decorated_changes)))
-        return decorated_changes
+    #
+    def token_codec(self):
+        """Tokens that do not fit are kept in the plan store of the pipeline execution
+        """
+        return IdelTokenCodec(self.state_store, self.cp_user_params['Pipeline']['ExecutionId'])
 
     @log_on_start(logging.INFO, "Start getting continuation token.")
     @log_on_end(logging.INFO, "End getting continuation token. Return: {result!r}")
     def get_continuation_token(self):
         if 'continuationToken' in self.cp_job_data:
             # Sequence run
-            continuation = json.loads(self.cp_job_data['continuationToken'])
+            continuation = self.token_codec().decode(self.cp_job_data['continuationToken'])
 
             self.logger.info('Round #{}'.format(str(int(continuation['Sequence'])+1)))
 
@@ -211,7 +435,8 @@ class IdelIaC:
             # First run
             # Fake continuationToken
             continuation = idel_utils.build_continuation_token(
-                block='-1',
+                completed='',
+                in_flight=[],
                 status=STATUS_DONE,
                 sequence=0
             )
@@ -221,37 +446,227 @@ class IdelIaC:
 
         return continuation
 
-    @log_on_start(logging.INFO, "Old block is DONE. Going to process NEW change block.")
-    @log_on_start(logging.DEBUG, "Old block is DONE. Going to process NEW change block: continuation: {continuation!r} | changes: {changes!r}")
-    def process_new_block(self, continuation, changes):
-        """
+    @log_on_start(logging.INFO, "Start processing round.")
+    @log_on_start(logging.DEBUG, "Start processing round: continuation: {continuation!r} | changes: {changes!r}")
+    @log_on_end(logging.INFO, "End processing round.")
+    def process_round(self, continuation, changes):
+        """Process a Lambda round
+
+        1. Poll the in-flight blocks (OLD change blocks).
+        2. Launch every ready block concurrently (NEW change blocks), wave after wave
+           while the remaining time of the Lambda invocation allows.
+        3. Complete the job, or continue the pipeline with the blocks that are still in-flight.
         """
-        target_block_order = int(continuation['Block'])+1
+        completed = decode_block_set(continuation['Completed'])
+        in_flight = {}
+        for entry in continuation['InFlight']:
+            in_flight[int(entry['Block'])] = entry
+
+        # If a block is waited over WAITING_OCCURRENCE times (and over its budget from the duration history)
+        # throw exception then exit pipeline
+        now = idel_polling.clock()
+        for entry in in_flight.values():
+            if (WAITING_OCCURRENCE<int(entry['Occurrence'])) and ((not entry.get('Deadline')) or (now>entry['Deadline'])):
+                raise Exception('Waiting too much. Exit!')
+
+        # Stacks are polled when they are due only. Notifications are read for all of them.
+        due = [
+            block for block, entry in in_flight.items()
+            if (self.cfn_for(self.planner.targets[block]).wait_mode==WAIT_MODE_EVENT) or (entry.get('NextCheck', 0)<=now)
+        ]
+
+        # Describe the relevant stacks at once, per target
+        stacks = collections.defaultdict(list)
+        for block in due:
+            if (in_flight[block].get('StackId')):
+                stacks[self.planner.targets[block]].append(in_flight[block]['StackId'])
+        for i, stack in enumerate(self.planner.stacks):
+            if (stack) and (i not in completed) and (i not in in_flight):
+                stacks[self.planner.targets[i]].append(stack)
+        self.run_concurrently(lambda target: self.cfn_for(target).prime_stack_cache(stacks[target]), list(stacks))
+
+        # OLD blocks
+        if (in_flight):
+            self.logger.info('Processing [{}] in-flight block(s), [{}] due.'.format(len(in_flight), len(due)))
+            stack_ids = collections.defaultdict(list)
+            for block in due:
+                if (in_flight[block].get('StackId')):
+                    stack_ids[self.planner.targets[block]].append(in_flight[block]['StackId'])
+            self.stack_statuses = {}
+            for statuses in self.run_concurrently(lambda target: self.event_source_for(target).get_stack_statuses(stack_ids[target]), list(stack_ids)).values():
+                self.stack_statuses.update(statuses)
+            results = self.run_concurrently(
+                lambda block: self.process_old_block(in_flight[block], changes[block]),
+                due
+            ) if (due) else {}
+            for block in list(in_flight.keys()):
+                if (block in results) and (results[block]['Done']):
+                    self.record_block_duration(block, changes[block], in_flight[block].get('Started'), in_flight[block].get('StackDesire'))
+                    self.forget_outputs(block)
+                    completed.add(block)
+                    del in_flight[block]
+                    continue
+                in_flight[block]['Occurrence'] = int(in_flight[block]['Occurrence'])+1
+                if (block in results):
+                    self.schedule_check(in_flight[block])
+
+        # Drifts of the stacks to update, then change sets of all pending deploy blocks, once per pipeline execution
+        self.sequence = int(continuation['Sequence'])
+        if (0==self.sequence):
+            self.check_drifts(changes, completed, in_flight)
+        if (self.cfn_handler.deploy_method==DEPLOY_METHOD_CHANGE_SET) and (0==self.sequence):
+            self.prepare_change_sets(changes, completed, in_flight)
+
+        # NEW blocks
+        results = {}
+        while True:
+            ready = self.planner.ready_blocks(completed, set(in_flight.keys()))
+            ready = self.limit_per_target(ready, in_flight)
+            ready = ready[:max(0, MAX_PARALLEL_BLOCKS-len(in_flight))]
+            if (not ready):
+                break
+
+            self.logger.info('Launching [{}] ready block(s): {}'.format(len(ready), ready))
+            self.load_outputs(ready, changes)
+            run_results = self.run_concurrently(
+                lambda block: self.process_new_block(block, changes[block]),
+                ready
+            )
+            for block, run_result in run_results.items():
+                if (not run_result):
+                    raise Exception('Unexpected exception. :)')
+                if (run_result['Done']):
+                    self.forget_outputs(block)
+                    completed.add(block)
+                    if ('Result' in run_result):
+                        results[str(block)] = run_result['Result']
+                else:
+                    in_flight[block] = {
+                        'Block': block,
+                        'StackName': changes[block].get('Stack'),
+                        'StackId': run_result.get('StackId'),
+                        'StackDesire': run_result.get('Desire'),
+                        'Occurrence': 1,
+                        'Started': run_result.get('Started')
+                    }
+                    self.schedule_check(in_flight[block])
+
+            if (not self.has_time_for_another_wave()):
+                break
+
+        self.duration_history.save()
+        self.save_results(results)
+        self.save_outputs()
 
         # Check: out of block?
-        if (target_block_order+1 > len(changes)):
+        if (self.planner.is_complete(completed)) and (not in_flight):
             # Yes. Out of block
             self.logger.info('There is NO more block to process.')
             self.cp_handler.put_job_success(self.cp_job_id, 'Job is complete.')
-
+            if (self.plan_store):
+                self.plan_store.delete(self.cp_user_params['Pipeline']['ExecutionId'])
         else:
-            # there is block to process
-            # then process and get result
-            self.logger.info('There is more block to process.')
+            # Prepare data for another run to continue the pipeline.
+            self.continue_pipeline(continuation, completed, in_flight)
 
-            change = changes[target_block_order]
-            self.logger.info('Do process. Change: {}'.format(str(change)))
+        return None
 
-            if ('Description' in change):
-                self.logger.info('Description: {}'.format(change['Description']))
+    #
+    def event_source_for(self, target):
+        """Event source of the default target, polling for the other ones
+        """
+        if (target is None):
+            return self.event_source
+        return IdelPollingEventSource(self.cfn_for(target))
 
-            case = self.process_new_block_case(change['Object'])
-            run_result = case(change)
+    #
+    def limit_per_target(self, ready, in_flight):
+        """Ready blocks within MAX_PARALLEL_BLOCKS_PER_TARGET in-flight blocks per target
+        """
+        if (MAX_PARALLEL_BLOCKS_PER_TARGET<=0):
+            return ready
+        counts = collections.Counter(self.planner.targets[block] for block in in_flight)
+        limited = []
+        for block in ready:
+            target = self.planner.targets[block]
+            if (counts[target]<MAX_PARALLEL_BLOCKS_PER_TARGET):
+                counts[target] += 1
+                limited.append(block)
+        return limited
 
-            # Prepare data for another run to continue the pipeline.
-            self.continue_pipeline(target_block_order, continuation, change, run_result)
+    #
+    def run_concurrently(self, func, blocks):
+        """Run `func(block)` for every block in a thread pool
 
-        return None
+        Returns:
+            Mapping of block order -> result
+        """
+        if (1==len(blocks)):
+            return {blocks[0]: func(blocks[0])}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_PARALLEL_BLOCKS, len(blocks)))) as executor:
+            futures = {block: executor.submit(func, block) for block in blocks}
+            # Propagate the first exception (if any) after every block has been processed
+            results = {}
+            for block, future in futures.items():
+                results[block] = future.result()
+        return results
+
+    #
+    def has_time_for_another_wave(self):
+        """Check the remaining time of the Lambda invocation before launching another wave
+        """
+        if (not hasattr(self.context, 'get_remaining_time_in_millis')):
+            return False
+        return (self.context.get_remaining_time_in_millis()/1000)>ROUND_TIME_RESERVE
+
+    @log_on_start(logging.INFO, "Going to process NEW change block #{block:d}.")
+    @log_on_start(logging.DEBUG, "Going to process NEW change block #{block:d}: change: {change!r}")
+    def process_new_block(self, block, change):
+        """
+        """
+        self.logger.info('Do process. Change: {}'.format(str(change)))
+
+        if ('Description' in change):
+            self.logger.info('Description: {}'.format(change['Description']))
+
+        started = idel_polling.clock()
+        case = self.process_new_block_case(change['Object'])
+        run_result = case(block, change)
+
+        if (run_result) and (run_result['Done']):
+            self.record_block_duration(block, change, started, run_result.get('Desire'))
+        elif (run_result):
+            # Kept in the in-flight entry to measure the block across rounds
+            run_result['Started'] = int(started)
+
+        return run_result
+
+    #
+    def record_block_duration(self, block, change, started, desire=None):
+        """Record the wall-clock duration of a completed block, from its launch
+
+        Stack operations (`desire`) are also kept in the duration history.
+        Skipped stacks (unchanged, nothing to delete) have no desire.
+        """
+        if (started is None):
+            # In-flight entry of an older token
+            return
+        duration = idel_polling.clock()-float(started)
+        metrics.record('BlockDuration', duration, UNIT_SECONDS,
+            Block=block, Object=change['Object'], Action=change['Action'], StackName=change.get('Stack'), Target=self.planner.targets[block])
+        self.duration_history.record(self.history_name(block, change.get('Stack')), desire, duration)
+        return
+
+    #
+    def schedule_check(self, entry):
+        """Set when an in-flight stack is polled next (`NextCheck`) and until when it is waited for (`Deadline`)
+        """
+        schedule = self.duration_history.schedule(self.history_name(int(entry['Block']), entry['StackName']), entry['StackDesire'], entry.get('Started'))
+        entry['NextCheck'] = int(schedule.next_check(idel_polling.clock()))
+        if (schedule.deadline() is not None):
+            entry['Deadline'] = int(schedule.deadline())
+        return
 
     #
     def process_new_block_case(self, case):
@@ -263,101 +678,469 @@ class IdelIaC:
 
     @log_on_start(logging.INFO, "Start processing NEW CloudFormation change block.")
     @log_on_end(logging.INFO, "End processing NEW CloudFormation change block. Return: {result!r}")
-    def process_new_block_cfn(self, change):
+    def process_new_block_cfn(self, block, change):
         """
         """
-        self.logger.info('Stack: {}'.format(change['Stack']))
+        self.logger.info('Stack: {}{}'.format(change['Stack'], ' (target: {})'.format(idec.target_key(change['Target'])) if (change.get('Target')) else ''))
 
+        cfn_handler = self.cfn_of(change)
         stack_result = {}
         if (change['Action']==STR_DEPLOY):
-            parameters = []
-            if ('Params' in change):
-                params = change['Params']
-                if (isinstance(params, dict)):
-                    for key in params:
-                        parameters.append({
-                            'ParameterKey': str(key),
-                            'ParameterValue': str(params[key])
-                        })
-                elif (isinstance(params, list)):
-                    for param in params:
-                        parameters.append({
-                            'ParameterKey': str(param['Name']),
-                            'ParameterValue': str(param['Value'])
-                        })
-                else:
-                    self.logger.warn('Invalid format of parameters.')
-
-            capabilities = []
-            if ('Caps' in change):
-                for cap in change['Caps']:
-                    capabilities.append(cap)
-
-            if self.cfn_handler.stack_exists(change['Stack']):
-                stack_result = self.cfn_handler.update_stack(
+            parameters, capabilities, tags, content_hash = self.build_deploy_request(change)
+
+            if (self.is_unchanged_stack(change, content_hash)):
+                self.logger.info('Stack {} is unchanged. Skip.'.format(change['Stack']))
+                stack_result = False
+            elif (cfn_handler.deploy_method==DEPLOY_METHOD_CHANGE_SET):
+                stack_result = self.deploy_change_set(block, change, parameters, capabilities, tags)
+            elif cfn_handler.stack_exists(change['Stack']):
+                stack_result = cfn_handler.update_stack(
                     stack_name=change['Stack'],
-                    template_body=change['TemplateBody'],
+                    **self.get_template(change),
                     parameters=parameters,
-                    capabilities=capabilities
+                    capabilities=capabilities,
+                    tags=tags
                 )
             else:
-                stack_result = self.cfn_handler.create_stack(
+                stack_result = cfn_handler.create_stack(
                     stack_name=change['Stack'],
-                    template_body=change['TemplateBody'],
+                    **self.get_template(change),
                     parameters=parameters,
-                    capabilities=capabilities
+                    capabilities=capabilities,
+                    tags=tags
                 )
 
         elif (change['Action']==STR_DELETE):
-            stack_result = self.cfn_handler.delete_stack(change['Stack'])
+            stack_result = cfn_handler.delete_stack(change['Stack'])
 
         else:
             raise Exception('Unknown action.')
 
         # Parse the result then process next
-        parsed_result = self.cfn_parse_waiter_result(stack_result, change['Stack'])
+        parsed_result = self.cfn_parse_waiter_result(stack_result, change['Stack'], cfn_handler)
 
         return parsed_result
 
+    #
+    def get_outputs(self):
+        """Outputs cache of the pipeline execution (loaded from the plan store once per round)
+        """
+        with self.outputs_lock:
+            if (self.outputs is None):
+                self.outputs = {}
+                if (self.state_store):
+                    self.outputs = self.state_store.load_outputs(self.cp_user_params['Pipeline']['ExecutionId']) or {}
+            return self.outputs
+
+    #
+    def get_stack_outputs(self, target, stack_name):
+        """Outputs of a stack from the outputs cache, else from the stack cache (the DescribeStacks responses of the round)
+        """
+        outputs = self.get_outputs()
+        key = self.stack_key(target, stack_name)
+        with self.outputs_lock:
+            if (key in outputs):
+                return outputs[key]
+        stack_outputs = self.cfn_for(target).get_stack_outputs(stack_name)
+        with self.outputs_lock:
+            outputs[key] = stack_outputs
+            self.outputs_changed = True
+        return stack_outputs
+
+    #
+    def load_outputs(self, blocks, changes):
+        """Fill the outputs cache for all references of some blocks at once: one stack cache sweep per target for many stacks
+
+        Missing stacks/outputs are left to the blocks that refer to them.
+        """
+        outputs = self.get_outputs()
+        missing = collections.defaultdict(set)
+        for block in blocks:
+            target = self.planner.targets[block]
+            for stack_name, _ in idec.output_refs(changes[block]):
+                if (self.stack_key(target, stack_name) not in outputs):
+                    missing[target].add(stack_name)
+        if (not missing):
+            return
+
+        def load(target):
+            self.cfn_for(target).prime_stack_cache(list(missing[target]))
+            for stack_name in missing[target]:
+                try:
+                    self.get_stack_outputs(target, stack_name)
+                except Exception as e:
+                    self.logger.warning('Cannot read the outputs of stack {}: {}'.format(stack_name, e))
+            return True
+
+        self.logger.info('Read the outputs of [{}] stack(s).'.format(sum(len(stack_names) for stack_names in missing.values())))
+        self.run_concurrently(load, list(missing))
+        return
+
+    #
+    def forget_outputs(self, block):
+        """Outputs of the stack of a completed block are read again when referred to
+        """
+        key = self.history_name(block, self.planner.stacks[block])
+        if (key is None):
+            return
+        outputs = self.get_outputs()
+        with self.outputs_lock:
+            if (outputs.pop(key, None) is not None):
+                self.outputs_changed = True
+        return
+
+    #
+    def save_outputs(self):
+        if (not self.outputs_changed) or (not self.state_store):
+            return
+        with self.outputs_lock:
+            self.state_store.save_outputs(self.cp_user_params['Pipeline']['ExecutionId'], self.outputs)
+            self.outputs_changed = False
+        return
+
+    #
+    def build_deploy_request(self, change):
+        """Parameters, capabilities and tags of a deploy block
+
+        Returns:
+            (parameters, capabilities, tags, content hash or None)
+        """
+        parameters = []
+        if ('Params' in change):
+            target = idec.target_key(change.get('Target'))
+            params = idec.resolve_output_refs(change['Params'], lambda stack_name: self.get_stack_outputs(target, stack_name))
+            parameters = idel_utils.build_cfn_parameters(params)
+            if (parameters is None):
+                self.logger.warn('Invalid format of parameters.')
+                parameters = []
+
+        capabilities = []
+        if ('Caps' in change):
+            for cap in change['Caps']:
+                capabilities.append(cap)
+
+        # Content hash to skip unchanged stacks
+        content_hash = None
+        tags = []
+        cfn_handler = self.cfn_of(change)
+        if (cfn_handler.skip_unchanged):
+            content_hash = idel_utils.cfn_content_hash(self.get_template_body(change), parameters, capabilities, cfn_handler.role_arn)
+            self.logger.info('Content hash: {}'.format(content_hash))
+            tags = cfn_handler.content_hash_tags(change['Stack'], content_hash)
+
+        return parameters, capabilities, tags, content_hash
+
+    #
+    def is_unchanged_stack(self, change, content_hash):
+        cfn_handler = self.cfn_of(change)
+        return (cfn_handler.skip_unchanged) and (cfn_handler.stack_exists(change['Stack'])) and (cfn_handler.is_unchanged(change['Stack'], content_hash))
+
+    #
+    def is_unchanged_up_front(self, change, pending_stacks):
+        """Same as is_unchanged_stack() before the block runs
+
+        Parameters are only resolved with `CFN_SKIP_UNCHANGED`, and not for blocks referring to the outputs of pending stacks
+        (which may not exist yet): those are not known as unchanged.
+        """
+        if (not self.cfn_of(change).skip_unchanged) or (self.refers_to_stacks(change, pending_stacks)):
+            return False
+        return self.is_unchanged_stack(change, self.build_deploy_request(change)[3])
+
+    #
+    def pending_stacks(self, completed):
+        """Stack names of the `cfn` blocks that are not completed yet
+        """
+        return set(stack for i, stack in enumerate(self.planner.stacks) if (stack) and (i not in completed))
+
+    #
+    def refers_to_stacks(self, change, stack_names):
+        """True if the `Params` of a block refer to the outputs of any of these stacks
+        """
+        return bool(stack_names.intersection(stack_name for stack_name, _ in idec.output_refs(change)))
+
+    #
+    def change_set_name(self, block):
+        """Unique per pipeline execution, block and round. Eg: idel-<execution id>-12-0
+        """
+        execution_id = re.sub('[^a-zA-Z0-9-]', '-', self.cp_user_params['Pipeline']['ExecutionId'])
+        return 'idel-{}-{}-{}'.format(execution_id, block, self.sequence)[-128:]
+
+    #
+    def drift_policy(self, change):
+        """`Drift` of the block, else `DRIFT_POLICY`
+        """
+        policy = change.get('Drift', DRIFT_POLICY)
+        if (policy not in DRIFT_POLICIES):
+            raise Exception('Unknown drift policy {} of stack {}.'.format(policy, change['Stack']))
+        return policy
+
+    @log_on_start(logging.INFO, "Start checking drifts.")
+    @log_on_end(logging.INFO, "End checking drifts.")
+    def check_drifts(self, changes, completed, in_flight):
+        """Detect the drifts of all stacks to update at once, then apply the drift policies before anything is deployed
+
+        Stacks to create and unchanged stacks (`CFN_SKIP_UNCHANGED`) are not checked.
+        """
+        pending_stacks = self.pending_stacks(completed)
+        blocks = [
+            i for i, stack in enumerate(self.planner.stacks)
+            if (stack) and (i not in completed) and (i not in in_flight) and (changes[i]['Action']==STR_DEPLOY)
+            and (self.drift_policy(changes[i])!=DRIFT_POLICY_OFF) and (self.cfn_of(changes[i]).stack_exists(stack))
+            and (not self.is_unchanged_up_front(changes[i], pending_stacks))
+        ]
+        if (not blocks):
+            return
+
+        # One detector per target, the targets at once
+        targets = list(collections.OrderedDict.fromkeys(self.planner.targets[block] for block in blocks))
+        def detect(target):
+            cfn_handler = self.cfn_for(target)
+            detector = IdelDriftDetector(cfn_handler.boto3_client, max_workers=MAX_PARALLEL_BLOCKS, prefix=cfn_handler.history_prefix)
+            return detector.detect(
+                [(changes[block]['Stack'], changes[block].get('TemplateDigest')) for block in blocks if (self.planner.targets[block]==target)],
+                cfn_handler.wait_deadline
+            )
+        detected = self.run_concurrently(detect, targets)
+        results = {block: detected[self.planner.targets[block]][changes[block]['Stack']] for block in blocks}
+
+        self.logger.info('Drifts of [{}] stack(s): [{}] drifted, [{}] in sync, [{}] unknown.'.format(
+            len(results),
+            len([result for result in results.values() if (result['Status']==DRIFT_DRIFTED)]),
+            len([result for result in results.values() if (result['Status']==DRIFT_IN_SYNC)]),
+            len([result for result in results.values() if (result['Status'] not in [DRIFT_DRIFTED, DRIFT_IN_SYNC])])
+        ))
+        aborted = []
+        for block in blocks:
+            change = changes[block]
+            result = results[block]
+            policy = self.drift_policy(change)
+            if (result['Status']==DRIFT_IN_SYNC):
+                self.logger.info('= #{} {}: in sync{}'.format(block, change['Stack'], ' (cached)' if (result.get('Cached')) else ''))
+                continue
+            log = self.logger.info if (policy==DRIFT_POLICY_PROCEED) else self.logger.warning
+            if (result['Status']==DRIFT_DRIFTED):
+                log('! #{} {}: drifted, policy {}'.format(block, change['Stack'], policy))
+                for resource in result['DriftedResources']:
+                    log('    {}'.format(resource))
+                if (policy==DRIFT_POLICY_ABORT):
+                    aborted.append(change['Stack'])
+            else:
+                # Unknown drifts do not abort: a stack which cannot be checked is not known to be drifted
+                log('? #{} {}: {} ({})'.format(block, change['Stack'], result['Status'], result.get('Reason')))
+
+        if (aborted):
+            raise Exception('Drifted stack(s) with drift policy abort: {}'.format(', '.join(aborted)))
+        return
+
+    @log_on_start(logging.INFO, "Start preparing change sets.")
+    @log_on_end(logging.INFO, "End preparing change sets.")
+    def prepare_change_sets(self, changes, completed, in_flight):
+        """Create the change sets of all pending deploy blocks up front
+
+        All change sets are created first, then waited for, so that their creations overlap.
+        Summaries are saved to the plan store for the next rounds, and logged as a diff report.
+        """
+        # Blocks referring to the outputs of pending stacks wait for them: their change sets are created when they run
+        pending_stacks = self.pending_stacks(completed)
+        blocks = [
+            i for i, stack in enumerate(self.planner.stacks)
+            if (stack) and (i not in completed) and (i not in in_flight) and (changes[i]['Action']==STR_DEPLOY)
+            and (not self.refers_to_stacks(changes[i], pending_stacks))
+        ]
+        if (not blocks):
+            return
+        self.load_outputs(blocks, changes)
+
+        summaries = self.run_concurrently(lambda block: self.create_change_set_up_front(block, changes[block]), blocks)
+        summaries = {block: summary for block, summary in summaries.items() if (summary)}
+        pending = [block for block, summary in summaries.items() if (summary['Status'] not in [CHANGE_SET_FAILED])]
+        if (pending):
+            summaries.update(self.run_concurrently(lambda block: self.cfn_of(changes[block]).describe_change_set(summaries[block]), pending))
+
+        with self.change_sets_lock:
+            self.change_sets = {str(block): summary for block, summary in summaries.items()}
+            if (self.state_store):
+                self.state_store.save_change_sets(self.cp_user_params['Pipeline']['ExecutionId'], self.change_sets)
+
+        for line in self.change_set_report(self.change_sets):
+            self.logger.info(line)
+        return
+
+    #
+    def create_change_set_up_front(self, block, change):
+        """
+        Returns:
+            Change set summary, FAILED if it cannot be created, None for unchanged stacks
+        """
+        try:
+            parameters, capabilities, tags, content_hash = self.build_deploy_request(change)
+            if (self.is_unchanged_stack(change, content_hash)):
+                return None
+            return self.cfn_of(change).create_change_set(
+                stack_name=change['Stack'],
+                change_set_name=self.change_set_name(block),
+                **self.get_template(change),
+                parameters=parameters,
+                capabilities=capabilities,
+                tags=tags
+            )
+        except Exception as e:
+            # Eg: imports from a stack which is deployed by a former block. Created again when the block runs.
+            self.logger.warning('Cannot create change set of stack {} up front: {}'.format(change['Stack'], e))
+            return {'StackName': change['Stack'], 'Status': CHANGE_SET_FAILED, 'Reason': str(e)}
+
+    #
+    def change_set_report(self, summaries):
+        """Diff report of the change sets for reviewers
+
+        Returns:
+            List of lines
+        """
+        ready = [summary for summary in summaries.values() if (summary['Status']==CHANGE_SET_READY)]
+        lines = ['Change sets of [{}] stack(s): [{}] to create, [{}] to update, [{}] without changes, [{}] failed.'.format(
+            len(summaries),
+            len([summary for summary in ready if (summary['ChangeSetType']=='CREATE')]),
+            len([summary for summary in ready if (summary['ChangeSetType']=='UPDATE')]),
+            len([summary for summary in summaries.values() if (summary['Status']==CHANGE_SET_EMPTY)]),
+            len([summary for summary in summaries.values() if (summary['Status']==CHANGE_SET_FAILED)])
+        )]
+        for block in sorted(summaries, key=int):
+            summary = summaries[block]
+            if (summary['Status']==CHANGE_SET_READY):
+                lines.append('{} #{} {} ({}): [{}] change(s)'.format('+' if (summary['ChangeSetType']=='CREATE') else '~', block, summary['StackName'], summary['ChangeSetType'], len(summary['Changes'])))
+                for change in summary['Changes']:
+                    lines.append('    {} {} {}{}'.format(
+                        change.get('Action'), change.get('Type'), change.get('Id'),
+                        ' (Replacement: {})'.format(change['Replacement']) if (change.get('Replacement')) else ''
+                    ))
+            elif (summary['Status']==CHANGE_SET_EMPTY):
+                lines.append('= #{} {}: no changes'.format(block, summary['StackName']))
+            else:
+                lines.append('! #{} {}: {}'.format(block, summary['StackName'], summary.get('Reason')))
+        return lines
+
+    #
+    def get_change_set(self, block):
+        """Summary of the change set prepared for a block (loaded from the plan store once per round)
+        """
+        with self.change_sets_lock:
+            if (self.change_sets is None):
+                self.change_sets = {}
+                if (self.state_store):
+                    self.change_sets = self.state_store.load_change_sets(self.cp_user_params['Pipeline']['ExecutionId']) or {}
+            return self.change_sets.get(str(block))
+
+    #
+    def prepare_change_set(self, block, change, parameters, capabilities, tags):
+        """Create a change set when its block runs, then wait for it
+        """
+        cfn_handler = self.cfn_of(change)
+        summary = cfn_handler.create_change_set(
+            stack_name=change['Stack'],
+            change_set_name=self.change_set_name(block),
+            **self.get_template(change),
+            parameters=parameters,
+            capabilities=capabilities,
+            tags=tags
+        )
+        summary = cfn_handler.describe_change_set(summary)
+        with self.change_sets_lock:
+            self.change_sets[str(block)] = summary
+        return summary
+
+    #
+    def deploy_change_set(self, block, change, parameters, capabilities, tags):
+        """Execute the change set of a block
+
+        The change set is created again if it failed up front or is obsolete.
+
+        Returns:
+            Result of execute_change_set() or False if there is nothing to deploy
+        """
+        summary = self.get_change_set(block)
+        for attempt in range(2):
+            if (summary is None) or (summary['Status']==CHANGE_SET_FAILED and 0==attempt):
+                summary = self.prepare_change_set(block, change, parameters, capabilities, tags)
+
+            if (summary['Status']==CHANGE_SET_EMPTY):
+                self.logger.info('No changes to deploy. Stack {} is up to date.'.format(change['Stack']))
+                return False
+            if (summary['Status']==CHANGE_SET_FAILED):
+                raise Exception('Error creating change set of CloudFormation stack "{0}": {1}'.format(change['Stack'], summary.get('Reason')))
+
+            try:
+                return self.cfn_of(change).execute_change_set(summary)
+            except botocore.exceptions.ClientError as e:
+                if (e.response['Error']['Code'] not in CHANGE_SET_STALE_ERRORS) or (attempt>0):
+                    raise Exception('Error executing change set of CloudFormation stack "{0}"'.format(change['Stack']), e)
+                self.logger.info('Change set of stack {} is obsolete. Create it again.'.format(change['Stack']))
+                summary = None
+
+        return False
+
     @log_on_start(logging.INFO, "Start processing NEW AWS change block.")
     @log_on_end(logging.INFO, "End processing NEW AWS change block. Return: {result!r}")
-    def process_new_block_aws(self, change):
+    def process_new_block_aws(self, block, change):
         """
         """
         self.logger.info('Action: {}'.format(change['Action']))
 
+        timeout = int(change.get('Timeout', AWS_BLOCK_TIMEOUT))
         aws_client = IdelClients()
-        aws_client.setup_boto3_client(change['Service'], self.secret)
+        aws_client.setup_boto3_client(change['Service'], self.credential_of(change), connect_timeout=timeout, read_timeout=timeout)
 
         try:
-            result = aws_client.dynamic_call(change['Action'], change['Params'])
+            if (change.get('Paginate')) or (change.get('Query')):
+                # Pages/values are streamed: only the projected values (or the counts of the chain) are kept
+                values = aws_client.dynamic_stream(change['Action'], change['Params'], bool(change.get('Paginate')), change.get('Query'))
+                if (change.get('Then')):
+                    result = idec.run_aws_chain(aws_client.dynamic_call, change['Then'], values)
+                    self.logger.info('Action: {} on [{}] value(s) in [{}] call(s).'.format(change['Then']['Action'], result['Count'], result['Calls']))
+                else:
+                    result = list(values)
+            else:
+                result = aws_client.dynamic_call(change['Action'], change['Params'])
         except Exception as error:
             raise error
 
-        # Just send AWS API request and do not mind the response
+        # The response is kept as the result of the block (see save_results())
         return {
             'Done': True,
-            'Result': result
+            'Result': idel_utils.compact_result(result, AWS_RESULT_MAX_SIZE)
         }
 
-    @log_on_start(logging.INFO, "Old block is still in progress. Going to process OLD change block.")
-    @log_on_start(logging.DEBUG, "Old block is still in progress. Going to process OLD change block: continuation: {continuation!r} | changes: {changes!r}")
-    def process_old_block(self, continuation, changes):
+    #
+    def save_results(self, results):
+        """Merge the results of the `aws` blocks of the round into the ones of the former rounds (S3 plan store)
+        """
+        if (not results):
+            return
+        if (not self.state_store):
+            self.logger.warning('Results of [{}] block(s) are only logged: set PLAN_STORE to s3://<bucket>/<prefix> to keep them.'.format(len(results)))
+            return
+        execution_id = self.cp_user_params['Pipeline']['ExecutionId']
+        stored = self.state_store.load_results(execution_id) or {}
+        stored.update(results)
+        self.state_store.save_results(execution_id, stored)
+        self.logger.info('Results of [{}] block(s) saved, [{}] in total.'.format(len(results), len(stored)))
+        return
+
+    @log_on_start(logging.INFO, "Going to process OLD change block: {continuation!r}")
+    @log_on_start(logging.DEBUG, "Going to process OLD change block: continuation: {continuation!r} | change: {change!r}")
+    def process_old_block(self, continuation, change):
         """
+        Args:
+            continuation: in-flight entry of the continuationToken
+            change: the corresponding change block
         """
-        block_order = int(continuation['Block'])
-        change = changes[block_order]
         self.logger.info('Do process. Change: {}'.format(str(change)))
 
-        run_result = {}
+        run_result = {'Done': True}
         # cfn
-        if (change['Object']==STR_CFN) and ('StackName' in continuation) and (change['Stack']==continuation['StackName']):
+        if (change['Object']==STR_CFN) and (continuation.get('StackName')) and (change['Stack']==continuation['StackName']):
             run_result = self.process_old_block_cfn(continuation, change)
 
-        # Prepare data for another run to continue the pipeline.
-        self.continue_pipeline(block_order, continuation, change, run_result)
-
-        return None
+        return run_result
 
     @log_on_start(logging.INFO, "Start processing OLD CloudFormation change block.")
     @log_on_end(logging.INFO, "End processing OLD CloudFormation change block. Return: {result!r}")
@@ -373,26 +1156,39 @@ class IdelIaC:
             'Done': <True|False>
         }
         """
-        # Get stack and its status
-        stack = self.cfn_handler.get_stack(continuation['StackId'])
-        stack_status = stack['StackStatus']
-
         stack_result = {}
         stack_result['StackName'] = continuation['StackName']
         stack_result['StackId'] = continuation['StackId']
         stack_result['Desire'] = continuation['StackDesire']
 
+        # Get stack status from the event source
+        stack_status = self.stack_statuses.get(continuation['StackId'])
+        if (stack_status is None):
+            # No notification yet. Still in progress.
+            self.logger.info('No status of stack {} yet.'.format(continuation['StackName']))
+            stack_result['Done'] = False
+            return stack_result
+
         # Check corresponding statuses
         result = idel_utils.stack_action_corresponding_statuses(change['Action'], stack_status)
         if (result=='COMPLETE'):
             stack_result['Done'] = True
             parsed_result = stack_result
+        elif (result=='IN_PROGRESS') and (not self.cfn_of(change).is_blocking()):
+            # check again in next round
+            stack_result['Done'] = False
+            parsed_result = stack_result
         elif (result=='IN_PROGRESS'):
             # wait
             wait_for = 'stack_'+continuation['StackDesire'].lower()
-            stack_result['WaitResult'] = self.cfn_handler.waiter(stack_name=continuation['StackId'], wait_for=wait_for)
+            stack_result['WaitResult'] = self.cfn_of(change).waiter(
+                stack_name=continuation['StackId'],
+                wait_for=wait_for,
+                name=continuation['StackName'],
+                started=continuation.get('Started')
+            )
 
-            parsed_result = self.cfn_parse_waiter_result(stack_result)
+            parsed_result = self.cfn_parse_waiter_result(stack_result, cfn_handler=self.cfn_of(change))
 
         else:
             # Exception then exit
@@ -402,7 +1198,7 @@ class IdelIaC:
 
     @log_on_start(logging.INFO, "Start parsing wait result. Input: {stack_result!r}")
     @log_on_end(logging.INFO, "End parsing wait result. Return: {result!r}")
-    def cfn_parse_waiter_result(self, stack_result, stack_name=None):
+    def cfn_parse_waiter_result(self, stack_result, stack_name=None, cfn_handler=None):
         """Since CloudFormation Waiter does not clearly return, we need to parse it
 
         Input:
@@ -410,13 +1206,16 @@ class IdelIaC:
             {
                 'StackName': '<from change>',
                 'StackId': <Stack Id generated by AWS>,
-                'WaitResult': <True|Waiter exception>
+                'WaitResult': <True|Waiter exception|None>
             }
             if WaitResult is True then everything is good
+            if WaitResult is None (non-blocking wait modes) then it will be checked in next rounds
             else we need to get stack status to see if it is good
 
             OR BOOLEAN: False
 
+            cfn_handler: handler of the target of the stack (default one if omitted)
+
         Output:
             {
                 'StackName': '<from change>',
@@ -438,8 +1237,10 @@ class IdelIaC:
 
         if (True==stack_result['WaitResult']):
             stack_result['Done'] = True
+        elif (stack_result['WaitResult'] is None):
+            stack_result['Done'] = False
         else:
-            stack = self.cfn_handler.get_stack(stack_result['StackId'])
+            stack = (cfn_handler or self.cfn_handler).get_stack(stack_result['StackId'])
             stack_result['Done'] = idel_utils.stack_desire_corresponding_statuses(stack_result['Desire'], stack['StackStatus'])
             if (None==stack_result['Done']):
                 # Un-handled statuses so we throw exception
@@ -448,38 +1249,20 @@ class IdelIaC:
         return stack_result
 
     @log_on_start(logging.INFO, "Start preparing for next run.")
-    @log_on_start(logging.DEBUG, "Start preparing for next run: block_order: {block_order:d} | continuation: {continuation!r} | change: {change!r} | run_result: {run_result!r}")
-    def continue_pipeline(self, block_order, continuation, change, run_result):
+    @log_on_start(logging.DEBUG, "Start preparing for next run: continuation: {continuation!r} | completed: {completed!r} | in_flight: {in_flight!r}")
+    def continue_pipeline(self, continuation, completed, in_flight):
         """
         """
-        if (not run_result):
-            raise Exception('Unexpected exception. :)')
-
         # build continuationToken to continue
         next_continuation = idel_utils.build_continuation_token(
-            block=block_order,
+            completed=encode_block_set(completed),
+            in_flight=[in_flight[block] for block in sorted(in_flight)],
+            status=STATUS_WAITING if (in_flight) else STATUS_DONE,
             sequence=int(continuation['Sequence'])+1
         )
-        if (run_result['Done']):
-            next_continuation['Status'] = STATUS_DONE
-            next_continuation['Occurrence'] = None
-        else:
-            next_continuation['Status'] = STATUS_WAITING
-            if (continuation['Occurrence']):
-                next_continuation['Occurrence'] = int(continuation['Occurrence'])+1
-            else:
-                next_continuation['Occurrence'] = 1
-
-        # cfn
-        if ('Stack' in change):
-            next_continuation['StackName'] = change['Stack']
-        if ('StackId' in run_result):
-            next_continuation['StackId'] = run_result['StackId']
-        if ('Desire' in run_result):
-            next_continuation['StackDesire'] = run_result['Desire']
 
         # continue
-        self.cp_handler.continue_job_later(self.cp_job_id, json.dumps(next_continuation), 'Still in progress...')
+        self.cp_handler.continue_job_later(self.cp_job_id, self.token_codec().encode(next_continuation), 'Still in progress...')
 
         return None
 
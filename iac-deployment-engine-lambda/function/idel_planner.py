@@ -0,0 +1,74 @@
+# idel_planner.py
+
+import os
+import logging
+
+from idec import IdecPlanner, STR_CFN, block_name, as_list, target_key
+
+class IdelPlanner(IdecPlanner):
+    """Execution planner for decorated changes (rules: IdecPlanner)
+
+    Can also be restored from the dependencies, stack names and targets of a stored plan.
+    """
+    logger = None
+    stacks = None
+    targets = None  # target keys (`<account>/<region>`) of the blocks, None for the default target
+
+    def __init__(self, changes=None, reverse=False, dependencies=None, stacks=None, targets=None):
+        """Build from decorated changes, or restore from dependencies, stack names and targets of a stored plan
+        """
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        if (changes is not None):
+            self.stacks = [change['Stack'] if (change['Object']==STR_CFN) else None for change in changes]
+            self.targets = [target_key(change.get('Target')) for change in changes]
+            super().__init__(changes, reverse)
+        else:
+            self.stacks = stacks
+            # Plans stored before targets
+            self.targets = targets or [None]*len(stacks)
+            self.dependencies = [set(deps) for deps in dependencies]
+            self.dependents = [set() for _ in dependencies]
+            for i, deps in enumerate(self.dependencies):
+                for j in deps:
+                    self.dependents[j].add(i)
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+def encode_block_set(blocks):
+    """Encode a set of block orders as compact ranges. Eg: {0,1,2,3,7,9,10} -> '0-3,7,9-10'
+    """
+    ordered = sorted(int(block) for block in blocks)
+    ranges = []
+    start = None
+    prev = None
+    for block in ordered:
+        if (start is None):
+            start = prev = block
+        elif (block==prev+1):
+            prev = block
+        else:
+            ranges.append(str(start) if (start==prev) else '{}-{}'.format(start, prev))
+            start = prev = block
+    if (start is not None):
+        ranges.append(str(start) if (start==prev) else '{}-{}'.format(start, prev))
+    return ','.join(ranges)
+
+def decode_block_set(value):
+    """Reverse of encode_block_set()
+    """
+    blocks = set()
+    if (not value):
+        return blocks
+    for item in str(value).split(','):
+        if ('-' in item):
+            start, end = item.split('-')
+            blocks.update(range(int(start), int(end)+1))
+        else:
+            blocks.add(int(item))
+    return blocks
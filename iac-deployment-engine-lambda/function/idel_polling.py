@@ -0,0 +1,190 @@
+# idel_polling.py
+"""When to check in-flight stacks, from the durations of their previous deployments
+
+A stack that usually takes 30 seconds and one that takes 40 minutes are not polled the same way:
+    - First check at `CFN_POLL_INITIAL_RATIO` of the median duration (else `Delay` of `CFN_WAITER_CONFIG`).
+    - Then exponential backoff with jitter: the delay grows with the time already spent past the first check,
+      from `Delay` up to `CFN_POLL_MAX_DELAY`.
+    - Round budget: a block which is known to be long is not failed by `WAITING_OCCURRENCE`
+      before `CFN_WAIT_BUDGET_FACTOR` times its longest duration.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import statistics
+
+from idel_store import IdelPlanStore, PLAN_STORE
+
+# Where the durations are kept: a local directory or `s3://<bucket>/<prefix>`. Empty to disable.
+DURATION_HISTORY_STORE = os.environ.get('DURATION_HISTORY_STORE', PLAN_STORE)
+DURATION_HISTORY_FILE = 'cfn-durations.json'
+DURATION_HISTORY_SIZE = int(os.environ.get('DURATION_HISTORY_SIZE', '5'))
+DURATION_HISTORY_VERSION = 1
+CFN_WAITER_CONFIG = json.loads(os.environ['CFN_WAITER_CONFIG'])
+CFN_POLL_INITIAL_RATIO = float(os.environ.get('CFN_POLL_INITIAL_RATIO', '0.8'))
+CFN_POLL_MAX_DELAY = float(os.environ.get('CFN_POLL_MAX_DELAY', '60'))
+CFN_WAIT_BUDGET_FACTOR = float(os.environ.get('CFN_WAIT_BUDGET_FACTOR', '3'))
+
+# Time source. Replaced by benchmarks (virtual time).
+clock = time.time
+sleep = time.sleep
+
+class IdelDurationHistory:
+    """Last `DURATION_HISTORY_SIZE` durations (seconds) per stack name and desired status
+
+    Stored as one JSON object: {"Version": 1, "Durations": {"<stack name>|<desire>": [<seconds>, ...]}}
+    Loaded on first use. New durations are merged into the latest stored version on save(),
+    so that concurrent pipelines do not drop each other's durations.
+    """
+    logger = None
+    store = None
+    durations = None
+    pending = None
+    lock = None
+
+    def __init__(self, location=None):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        if (location is None):
+            location = DURATION_HISTORY_STORE
+        if (location):
+            self.store = IdelPlanStore(location)
+        self.pending = []
+        self.lock = threading.Lock()
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def is_enabled(self):
+        return self.store is not None
+
+    #
+    def key(self, stack_name, desire):
+        return '{}|{}'.format(stack_name, desire)
+
+    #
+    def read(self):
+        raw = self.store.read(self.store.path('', DURATION_HISTORY_FILE))
+        if (raw is None):
+            return {}
+        try:
+            history = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            self.logger.warning('Duration history is corrupted. Ignore.')
+            return {}
+        if (history.get('Version')!=DURATION_HISTORY_VERSION):
+            return {}
+        return history['Durations']
+
+    #
+    def load(self):
+        with self.lock:
+            if (self.durations is None):
+                self.durations = self.read() if (self.is_enabled()) else {}
+            return self.durations
+
+    #
+    def estimate(self, stack_name, desire):
+        """
+        Returns:
+            {'Median': <seconds>, 'Longest': <seconds>, 'Count': <number>} or None if never deployed
+        """
+        if (not stack_name) or (not self.is_enabled()):
+            return None
+        durations = self.load().get(self.key(stack_name, desire))
+        if (not durations):
+            return None
+        return {
+            'Median': statistics.median(durations),
+            'Longest': max(durations),
+            'Count': len(durations)
+        }
+
+    #
+    def record(self, stack_name, desire, seconds):
+        if (not stack_name) or (not desire) or (not self.is_enabled()):
+            return
+        with self.lock:
+            self.pending.append((self.key(stack_name, desire), round(seconds, 1)))
+        return
+
+    #
+    def save(self):
+        """Merge the new durations into the stored history
+        """
+        with self.lock:
+            if (not self.pending):
+                return False
+            durations = self.read()
+            for key, seconds in self.pending:
+                durations[key] = (durations.get(key, [])+[seconds])[-DURATION_HISTORY_SIZE:]
+            self.store.write(
+                self.store.path('', DURATION_HISTORY_FILE),
+                json.dumps({'Version': DURATION_HISTORY_VERSION, 'Durations': durations}, separators=(',', ':')).encode('utf-8')
+            )
+            self.logger.info('Saved [{}] stack duration(s).'.format(len(self.pending)))
+            self.durations = durations
+            self.pending = []
+        return True
+
+    #
+    def schedule(self, stack_name, desire, started=None):
+        return IdelPollSchedule(
+            started=clock() if (started is None) else float(started),
+            estimate=self.estimate(stack_name, desire)
+        )
+
+class IdelPollSchedule:
+    """Checks of one in-flight stack
+    """
+    started = None
+    estimate = None
+    delay = None
+    max_delay = None
+
+    def __init__(self, started, estimate=None, delay=CFN_WAITER_CONFIG['Delay'], max_delay=CFN_POLL_MAX_DELAY):
+        self.started = started
+        self.estimate = estimate
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        return
+
+    #
+    def first_check(self):
+        if (self.estimate):
+            return self.started+max(self.delay, CFN_POLL_INITIAL_RATIO*self.estimate['Median'])
+        return self.started+self.delay
+
+    #
+    def next_check(self, now):
+        """Backoff with jitter: the delay is the time spent past the first check, within [Delay, CFN_POLL_MAX_DELAY],
+        then drawn in its upper half
+        """
+        first_check = self.first_check()
+        if (now<first_check):
+            return first_check
+        delay = min(self.max_delay, max(self.delay, now-first_check))
+        return now+random.uniform(delay/2, delay)
+
+    #
+    def expected_end(self):
+        if (self.estimate):
+            return self.started+self.estimate['Median']
+        return None
+
+    #
+    def deadline(self):
+        """Until when the block is worth waiting for (None if never deployed)
+        """
+        if (self.estimate):
+            return self.started+CFN_WAIT_BUDGET_FACTOR*self.estimate['Longest']
+        return None
@@ -0,0 +1,72 @@
+# idel_profiler.py
+
+import os
+import time
+import logging
+import importlib
+import sys
+import threading
+from contextlib import contextmanager
+
+STARTUP_PROFILE = os.environ.get('STARTUP_PROFILE', 'true').lower()=='true'
+
+class IdelStartupProfiler:
+    """Record timings of imports and handler initializations then report them once
+
+    Cold start reports all the timings. Warm invocations only report when a module is loaded lazily for the first time.
+    """
+    logger = None
+    enabled = None
+    cold = None
+    timings = None
+    lock = None
+
+    def __init__(self, enabled=STARTUP_PROFILE):
+        # Setup logging
+        self.logger = logging.getLogger()
+
+        self.enabled = enabled
+        self.cold = True
+        self.timings = []
+        self.lock = threading.Lock()
+
+        return
+
+    #
+    @contextmanager
+    def measure(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if (self.enabled):
+                with self.lock:
+                    self.timings.append((label, (time.perf_counter()-start)*1000))
+
+    #
+    def import_module(self, name):
+        """Import a module and record its import time. Modules already imported are not recorded.
+        """
+        if (name in sys.modules):
+            return sys.modules[name]
+        with self.measure('import {}'.format(name)):
+            module = importlib.import_module(name)
+        return module
+
+    #
+    def report(self):
+        with self.lock:
+            timings = self.timings
+            self.timings = []
+            cold = self.cold
+            self.cold = False
+        if (not cold) and (not any(label.startswith('import ') for label, _ in timings)):
+            return []
+        if (timings):
+            self.logger.info('Startup profile: {} | total: {:.1f} ms'.format(
+                ', '.join('{}: {:.1f} ms'.format(label, ms) for label, ms in timings),
+                sum(ms for _, ms in timings)
+            ))
+        return timings
+
+profiler = IdelStartupProfiler()
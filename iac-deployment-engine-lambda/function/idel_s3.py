@@ -1,11 +1,72 @@
 # idel_s3.py
 
-from boto3.session import Session
-import botocore
 import os
 import logging
 import zipfile
-import glob
+import tempfile
+import posixpath
+
+import idel_clients
+
+# Artifacts up to this size (bytes) are held in memory, bigger ones are spooled to /tmp
+ARTIFACT_SPOOL_MAX_SIZE = int(os.environ.get('ARTIFACT_SPOOL_MAX_SIZE', str(16*1024*1024)))
+ARTIFACT_CHUNK_SIZE = 1024*1024
+
+class IdelArtifact:
+    """Zipped artifact held in memory (or a spooled temporary file)
+
+    Files are read on demand from the zip instead of extracting the whole artifact.
+    """
+    logger = None
+    zip_file = None
+    names = None
+
+    def __init__(self, fileobj):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.zip_file = zipfile.ZipFile(fileobj)
+        self.names = set(self.zip_file.namelist())
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def exists(self, name):
+        return normalize_artifact_path(name) in self.names
+
+    #
+    def read(self, name):
+        """Read a file of the artifact
+
+        Args:
+            name: Unix-style path relative to the root of the artifact
+
+        Raises:
+            FileNotFoundError: the file is not in the artifact
+        """
+        path = normalize_artifact_path(name)
+        if (path not in self.names):
+            raise FileNotFoundError('File not found in artifact: {}'.format(name))
+        self.logger.debug('Read from artifact: {}'.format(path))
+        return self.zip_file.read(path)
+
+    #
+    def read_text(self, name, encoding='utf-8'):
+        return self.read(name).decode(encoding)
+
+    #
+    def close(self):
+        self.zip_file.close()
+        return
+
+def normalize_artifact_path(name):
+    """'./cfn-templates//VPC.tpl.yaml' -> 'cfn-templates/VPC.tpl.yaml'
+    """
+    return posixpath.normpath(str(name).replace('\\', '/')).lstrip('/')
 
 class IdelS3:
     boto3_client = None
@@ -42,46 +103,53 @@ class IdelS3:
         key_secret = credential['secretAccessKey']
         session_token = credential['sessionToken']
 
-        session = Session(aws_access_key_id=key_id,
-            aws_secret_access_key=key_secret,
-            aws_session_token=session_token)
-        self.boto3_client = session.client('s3', config=botocore.client.Config(signature_version='s3v4'))
+        self.boto3_client = idel_clients.get_client(
+            's3',
+            access_key_id=key_id,
+            secret_access_key=key_secret,
+            session_token=session_token,
+            # Temporary credentials of the job, a pooled client would never be reused
+            pooled=False,
+            signature_version='s3v4'
+        )
         return
 
     #
-    def download_artifact(self, s3_bucket, s3_object, af_dir):
-        """Gets the artifact
+    def get_artifact_etag(self, s3_bucket, s3_object):
+        """Cheap HEAD request to identify the content of the artifact
+        """
+        response = self.boto3_client.head_object(Bucket=s3_bucket, Key=s3_object)
+        return response['ETag']
+
+    #
+    def open_artifact(self, s3_bucket, s3_object):
+        """Gets the artifact without extracting it
 
-        Downloads the artifact from the S3 artifact store to a temporary file
-        then extracts the zip and returns the path containing the CloudFormation
-        templates and changes.
+        Streams the artifact from the S3 artifact store into a spooled buffer
+        (memory up to ARTIFACT_SPOOL_MAX_SIZE, then /tmp).
 
         Args:
             s3_bucket:
             s3_object:
-            af_dir: artifact dir
 
         Returns:
-            The path to the deployment materials
-
-        Raises:
-            Exception: Any exception thrown while downloading the artifact or unzipping it
+            IdelArtifact
 
         """
-        self.logger.info('Download artifact from S3.')
+        self.logger.info('Stream artifact from S3.')
 
-        af_tmp = '/tmp/af_tmp.zip'
+        response = self.boto3_client.get_object(Bucket=s3_bucket, Key=s3_object)
+        buffer = tempfile.SpooledTemporaryFile(max_size=ARTIFACT_SPOOL_MAX_SIZE)
+        for chunk in response['Body'].iter_chunks(chunk_size=ARTIFACT_CHUNK_SIZE):
+            buffer.write(chunk)
+        buffer.seek(0)
 
-        self.boto3_client.download_file(s3_bucket, s3_object, af_tmp)
-        af = zipfile.ZipFile(af_tmp)
-        af.extractall(af_dir)
-        af.close()
-        os.remove(af_tmp)
+        artifact = IdelArtifact(buffer)
 
         # log debug
         self.logger.debug('Listing...')
-        for filename in glob.iglob(af_dir + '**/**', recursive=True):
+        for filename in sorted(artifact.names):
             self.logger.debug(filename)
         self.logger.debug('End listing.')
 
-        return af_dir
+        return artifact
@@ -1,21 +1,34 @@
 import os
-import boto3
+import time
 import json
 import logging
 
+import idel_cache
+import idel_clients
+from idec_metrics import metrics
+
+# Seconds a secret is kept in memory (across warm invocations). 0 to disable
+SECRET_CACHE_TTL = int(os.environ.get('SECRET_CACHE_TTL', '300'))
+SECRET_VERSION_STAGE = os.environ.get('SECRET_VERSION_STAGE', 'AWSCURRENT')
+# Local JSON file standing in for Secrets Manager (offline tests)
+SECRET_FILE = os.environ.get('SECRET_FILE', '')
+
+# Secrets: (secret name, version stage) -> (expiry, secret data)
+secrets = idel_cache.IdelWarmCache('secrets')
+
 class IdelSecretsManager:
     """To play with SecretsManager service through boto3
     """
     boto3_client = None
     logger = None
+    secret_file = None
 
-    def __init__(self):
+    def __init__(self, secret_file=SECRET_FILE):
         # Setup logging
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
 
-        # Setup boto3 client
-        self.boto3_client = boto3.client('secretsmanager')
+        self.secret_file = secret_file
 
         # Log DEBUG
         self.logger.debug('Init class {}'.format(self.__str__()))
@@ -23,16 +36,57 @@ class IdelSecretsManager:
         return
 
     #
-    def get_secret(self, secret_name):
+    def setup_boto3_client(self):
+        """Set up boto3 client on first use
         """
+        if (not self.boto3_client):
+            self.boto3_client = idel_clients.get_client('secretsmanager')
+        return self.boto3_client
+
+    #
+    def get_secret(self, secret_name, version_stage=SECRET_VERSION_STAGE):
+        """Get secret from memory if not expired (SECRET_CACHE_TTL), else from the backend
         """
         self.logger.debug('secret_name: {}'.format(secret_name))
 
-        secret = self.boto3_client.get_secret_value(
-            SecretId=secret_name
-        )
-        self.logger.debug('secret: {}'.format(str(secret)))
+        key = (secret_name, version_stage)
+        cached = secrets.get(key)
+        if (cached) and (cached[0]>time.monotonic()):
+            return cached[1]
+
+        if (self.secret_file):
+            secret_data = self.get_secret_from_file(secret_name)
+        else:
+            self.setup_boto3_client()
+            with metrics.timer('SecretFetch'):
+                secret = self.boto3_client.get_secret_value(
+                    SecretId=secret_name,
+                    VersionStage=version_stage
+                )
+            self.logger.debug('secret: {}'.format(str(secret)))
+            self.logger.info('Secret version: {} ({})'.format(secret.get('VersionId'), version_stage))
+
+            secret_data = json.loads(secret['SecretString'])
 
-        secret_data = json.loads(secret['SecretString'])
+        if (SECRET_CACHE_TTL>0):
+            secrets.put(key, (time.monotonic()+SECRET_CACHE_TTL, secret_data))
 
         return secret_data
+
+    #
+    def get_secret_from_file(self, secret_name):
+        """Local stand-in: JSON file of either `{<secret name>: <secret data>}` or the secret data itself
+        """
+        self.logger.info('Get secret from file: {}'.format(self.secret_file))
+        with open(self.secret_file, encoding='utf-8') as file:
+            data = json.load(file)
+        if (secret_name in data) and (isinstance(data[secret_name], dict)):
+            return data[secret_name]
+        return data
+
+    #
+    def invalidate_secret(self, secret_name, version_stage=SECRET_VERSION_STAGE):
+        """Forget a cached secret. Eg: after it is rotated
+        """
+        secrets.delete((secret_name, version_stage))
+        return
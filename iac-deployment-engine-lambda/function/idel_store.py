@@ -0,0 +1,277 @@
+# idel_store.py
+
+import os
+import json
+import gzip
+import shutil
+import logging
+import threading
+import botocore
+
+import idel_clients
+
+# Where compiled plans are persisted: a local directory or `s3://<bucket>/<prefix>`
+PLAN_STORE = os.environ.get('PLAN_STORE', '/tmp/idel-plans/')
+PLAN_VERSION = 1
+PLAN_HEADER = 'plan.json.gz'
+PLAN_BLOCKS = 'blocks.jsonl'
+PLAN_CHANGE_SETS = 'changesets.json.gz'
+PLAN_TOKEN = 'token.bin'
+PLAN_RESULTS = 'results.json.gz'
+PLAN_OUTPUTS = 'outputs.json.gz'
+
+class IdelPlanStore:
+    """Persist compiled plans keyed by pipeline execution ID
+
+    A plan is stored as 2 objects:
+        - `plan.json.gz`: header (mode, dependencies, stack names, byte offsets of blocks)
+        - `blocks.jsonl`: one decorated change per line, so one block is loaded by a ranged read
+    and, with change set deployments, `changesets.json.gz`: summaries of the change sets by block order,
+    and `token.bin`: state of the last round if it does not fit in `continuationToken` (see idel_token).
+    `results.json.gz` keeps the results of `aws` blocks. It is not deleted with the plan.
+    """
+    logger = None
+    location = None
+    boto3_client = None
+    bucket = None
+    prefix = None
+
+    def __init__(self, location=PLAN_STORE):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.location = location
+        if (location.startswith('s3://')):
+            self.bucket, _, self.prefix = location[len('s3://'):].partition('/')
+            self.prefix = self.prefix.strip('/')
+            self.boto3_client = idel_clients.get_client('s3')
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def is_s3(self):
+        return self.bucket is not None
+
+    #
+    def path(self, execution_id, name):
+        if (self.is_s3()):
+            return '/'.join([part for part in [self.prefix, execution_id, name] if (part)])
+        return os.path.join(self.location, execution_id, name)
+
+    #
+    def save(self, execution_id, mode, planner, changes):
+        """Serialize the plan: header and blocks (TemplateBody is not stored)
+        """
+        offsets = []
+        blocks = bytearray()
+        for change in changes:
+            line = json.dumps(
+                {key: value for key, value in change.items() if (key!='TemplateBody')},
+                separators=(',', ':'),
+                default=str
+            ).encode('utf-8')+b'\n'
+            offsets.append(len(blocks))
+            blocks.extend(line)
+        offsets.append(len(blocks))
+
+        header = {
+            'Version': PLAN_VERSION,
+            'Mode': mode,
+            'Dependencies': [sorted(deps) for deps in planner.dependencies],
+            'Stacks': planner.stacks,
+            'Targets': planner.targets,
+            'Offsets': offsets
+        }
+        header = gzip.compress(json.dumps(header, separators=(',', ':')).encode('utf-8'))
+
+        self.write(self.path(execution_id, PLAN_BLOCKS), bytes(blocks))
+        # Header last: a plan is complete once its header exists
+        self.write(self.path(execution_id, PLAN_HEADER), header)
+
+        self.logger.info('Saved plan of [{}] blocks ({} bytes) to {}.'.format(len(changes), len(blocks)+len(header), self.path(execution_id, '')))
+        return True
+
+    #
+    def load(self, execution_id):
+        """Load the plan header
+
+        Returns:
+            (header, IdelPlanBlocks) or (None, None) if not found
+        """
+        raw_header = self.read(self.path(execution_id, PLAN_HEADER))
+        if (raw_header is None):
+            return None, None
+
+        header = json.loads(gzip.decompress(raw_header).decode('utf-8'))
+        if (header.get('Version')!=PLAN_VERSION):
+            self.logger.info('Plan version {} is not supported. Ignore.'.format(header.get('Version')))
+            return None, None
+
+        self.logger.info('Loaded plan of [{}] blocks from {}.'.format(len(header['Stacks']), self.path(execution_id, '')))
+        return header, IdelPlanBlocks(self, execution_id, header['Offsets'])
+
+    #
+    def load_block(self, execution_id, start, end):
+        raw_block = self.read(self.path(execution_id, PLAN_BLOCKS), start, end)
+        return json.loads(raw_block.decode('utf-8'))
+
+    #
+    def save_change_sets(self, execution_id, summaries):
+        """
+        Args:
+            summaries: mapping of block order (string) -> change set summary
+        """
+        self.write(self.path(execution_id, PLAN_CHANGE_SETS), gzip.compress(json.dumps(summaries, separators=(',', ':')).encode('utf-8')))
+        return True
+
+    #
+    def load_change_sets(self, execution_id):
+        """
+        Returns:
+            Mapping of block order (string) -> change set summary, or None if not found
+        """
+        raw_summaries = self.read(self.path(execution_id, PLAN_CHANGE_SETS))
+        if (raw_summaries is None):
+            return None
+        return json.loads(gzip.decompress(raw_summaries).decode('utf-8'))
+
+    #
+    def save_token(self, execution_id, data):
+        self.write(self.path(execution_id, PLAN_TOKEN), data)
+        return True
+
+    #
+    def load_token(self, execution_id):
+        """
+        Returns:
+            bytes or None if not found
+        """
+        return self.read(self.path(execution_id, PLAN_TOKEN))
+
+    #
+    def save_results(self, execution_id, results):
+        """
+        Args:
+            results: mapping of block order (string) -> result of the block
+        """
+        self.write(self.path(execution_id, PLAN_RESULTS), gzip.compress(json.dumps(results, separators=(',', ':'), default=str).encode('utf-8')))
+        return True
+
+    #
+    def load_results(self, execution_id):
+        """
+        Returns:
+            Mapping of block order (string) -> result of the block, or None if not found
+        """
+        raw_results = self.read(self.path(execution_id, PLAN_RESULTS))
+        if (raw_results is None):
+            return None
+        return json.loads(gzip.decompress(raw_results).decode('utf-8'))
+
+    #
+    def save_outputs(self, execution_id, outputs):
+        """
+        Args:
+            outputs: mapping of stack name -> {OutputKey: OutputValue}
+        """
+        self.write(self.path(execution_id, PLAN_OUTPUTS), gzip.compress(json.dumps(outputs, separators=(',', ':')).encode('utf-8')))
+        return True
+
+    #
+    def load_outputs(self, execution_id):
+        """
+        Returns:
+            Mapping of stack name -> {OutputKey: OutputValue}, or None if not found
+        """
+        raw_outputs = self.read(self.path(execution_id, PLAN_OUTPUTS))
+        if (raw_outputs is None):
+            return None
+        return json.loads(gzip.decompress(raw_outputs).decode('utf-8'))
+
+    #
+    def delete(self, execution_id):
+        """Delete the plan of a pipeline execution. Results of blocks are kept (S3 only, see IdelIaC.state_store).
+        """
+        if (self.is_s3()):
+            for name in [PLAN_HEADER, PLAN_BLOCKS, PLAN_CHANGE_SETS, PLAN_TOKEN, PLAN_OUTPUTS]:
+                self.boto3_client.delete_object(Bucket=self.bucket, Key=self.path(execution_id, name))
+        else:
+            shutil.rmtree(os.path.join(self.location, execution_id), ignore_errors=True)
+        return
+
+    #
+    def write(self, path, data):
+        if (self.is_s3()):
+            self.boto3_client.put_object(Bucket=self.bucket, Key=path, Body=data)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(data)
+        return
+
+    #
+    def read(self, path, start=None, end=None):
+        """Read the whole object or bytes [start, end)
+
+        Returns:
+            bytes or None if not found
+        """
+        if (self.is_s3()):
+            params = {'Bucket': self.bucket, 'Key': path}
+            if (start is not None):
+                params['Range'] = 'bytes={}-{}'.format(start, end-1)
+            try:
+                return self.boto3_client.get_object(**params)['Body'].read()
+            except botocore.exceptions.ClientError as e:
+                if (e.response['Error']['Code'] in ['NoSuchKey', '404']):
+                    return None
+                raise e
+
+        if (not os.path.exists(path)):
+            return None
+        with open(path, 'rb') as file:
+            if (start is None):
+                return file.read()
+            file.seek(start)
+            return file.read(end-start)
+
+class IdelPlanBlocks:
+    """Read-only sequence of the decorated changes of a stored plan
+
+    A block is loaded on first access only. Blocks are loaded concurrently (the lock only guards the cache),
+    so a block may be read twice by concurrent first accesses: the first one loaded is kept.
+    """
+    store = None
+    execution_id = None
+    offsets = None
+    blocks = None
+    lock = None
+
+    def __init__(self, store, execution_id, offsets):
+        self.store = store
+        self.execution_id = execution_id
+        self.offsets = offsets
+        self.blocks = {}
+        self.lock = threading.Lock()
+        return
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, i):
+        if (i<0) or (i>=len(self)):
+            raise IndexError('Block #{} out of plan.'.format(i))
+        with self.lock:
+            if (i in self.blocks):
+                return self.blocks[i]
+        block = self.store.load_block(self.execution_id, self.offsets[i], self.offsets[i+1])
+        with self.lock:
+            return self.blocks.setdefault(i, block)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
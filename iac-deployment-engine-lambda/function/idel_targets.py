@@ -0,0 +1,62 @@
+# idel_targets.py
+"""Credentials of the deployment targets (`Targets` of `cfn` blocks)
+
+A target in the account of the secret only switches region. Other accounts are reached by assuming
+`TARGET_ROLE_NAME` there with the credential of the secret. Assumed credentials are kept across warm invocations
+and refreshed a while before they expire.
+"""
+
+import os
+import time
+import logging
+
+import idel_cache
+import idel_clients
+
+# Role assumed in the target accounts other than the one of the secret
+TARGET_ROLE_NAME = os.environ.get('TARGET_ROLE_NAME', '')
+TARGET_SESSION_NAME = 'iac-deployment-engine'
+TARGET_SESSION_DURATION = 3600
+# Seconds. Assumed credentials closer than this to their expiration are refreshed.
+TARGET_CREDENTIAL_REFRESH = 600
+
+def get_target_credential(secret, target):
+    """Credential of a target, in the format of the secret
+
+    Args:
+        secret: secret of the target AWS environment (ACCOUNT_NUMBER, REGION, ACCESS_KEY_ID, SECRET_ACCESS_KEY, ROLE_NAME)
+        target: {'Account', 'Region'}, each defaults to the one of the secret
+    """
+    account = target.get('Account') or secret['ACCOUNT_NUMBER']
+    region = target.get('Region') or secret['REGION']
+    if (account==secret['ACCOUNT_NUMBER']):
+        return dict(secret, REGION=region)
+
+    if (not TARGET_ROLE_NAME):
+        raise Exception('Target account {} is not the account of the secret, and TARGET_ROLE_NAME is not set.'.format(account))
+
+    key = (secret['ACCESS_KEY_ID'], account)
+    cached = idel_cache.target_credentials.get(key)
+    if (cached is None) or (cached['Expiration']-time.time()<TARGET_CREDENTIAL_REFRESH):
+        role_arn = 'arn:aws:iam::{}:role/{}'.format(account, TARGET_ROLE_NAME)
+        logging.info('Assume role {}.'.format(role_arn))
+        credentials = idel_clients.get_client_with_credential('sts', secret).assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=TARGET_SESSION_NAME,
+            DurationSeconds=TARGET_SESSION_DURATION
+        )['Credentials']
+        cached = idel_cache.target_credentials.put(key, {
+            'ACCESS_KEY_ID': credentials['AccessKeyId'],
+            'SECRET_ACCESS_KEY': credentials['SecretAccessKey'],
+            'SESSION_TOKEN': credentials['SessionToken'],
+            'Expiration': credentials['Expiration'].timestamp()
+        })
+
+    return dict(
+        secret,
+        ACCOUNT_NUMBER=account,
+        REGION=region,
+        ACCESS_KEY_ID=cached['ACCESS_KEY_ID'],
+        SECRET_ACCESS_KEY=cached['SECRET_ACCESS_KEY'],
+        SESSION_TOKEN=cached['SESSION_TOKEN']
+    )
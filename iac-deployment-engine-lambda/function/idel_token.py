@@ -0,0 +1,193 @@
+# idel_token.py
+"""Codec of `continuationToken`, which CodePipeline caps at 2048 characters
+
+Formats (`CONTINUATION_TOKEN_FORMAT` selects the one written, all of them are read):
+    - `{...}`: plain JSON (`json`). Written by former versions, so tokens of running pipelines still decode after an upgrade.
+    - `v2:<data>`: compact state (`v2`), zlib compressed then base64url encoded. Default.
+    - `v2@<digest>`: the `v2` data does not fit in the token. It is kept in the plan store (`token.bin` of the
+      pipeline execution) and the token points to it. `digest` makes sure it is the data of this round.
+      The plan store must be on S3: the next round may run in another Lambda container, without this `/tmp`.
+
+Compact state: single letter keys, stack desires and statuses as codes, times as integer seconds from a base time,
+and the common prefix of stack IDs (`arn:aws:cloudformation:<region>:<account>:stack/`) stored once.
+Keys without a short name are kept as they are.
+"""
+
+import os
+import json
+import zlib
+import math
+import base64
+import hashlib
+import logging
+
+import idel_utils
+
+TOKEN_MAX_SIZE = 2048
+TOKEN_FORMAT_JSON = 'json'
+TOKEN_FORMAT_V2 = 'v2'
+CONTINUATION_TOKEN_FORMAT = os.environ.get('CONTINUATION_TOKEN_FORMAT', TOKEN_FORMAT_V2)
+TOKEN_PREFIX_INLINE = 'v2:'
+TOKEN_PREFIX_POINTER = 'v2@'
+# Short names of the keys
+TOKEN_KEYS = {'Completed': 'C', 'InFlight': 'F', 'Status': 'S', 'Sequence': 'Q'}
+IN_FLIGHT_KEYS = {'Block': 'b', 'StackName': 'n', 'StackId': 'i', 'StackDesire': 'd', 'Occurrence': 'o', 'Started': 's', 'NextCheck': 'c', 'Deadline': 'l'}
+# Times are stored as seconds from the base time `T`. NextCheck is rounded up so that a stack is never polled early.
+TIME_KEYS = ['Started', 'NextCheck', 'Deadline']
+STACK_ID_PREFIX_KEY = 'P'
+STACK_ID_SUFFIX_KEY = 'u'
+BASE_TIME_KEY = 'T'
+DESIRES = {'CREATE_COMPLETE': 'C', 'UPDATE_COMPLETE': 'U', 'DELETE_COMPLETE': 'D'}
+STATUSES = {'DONE': 'D', 'WAITING': 'W'}
+
+class IdelTokenCodec:
+    logger = None
+    store = None
+    execution_id = None
+    token_format = None
+
+    def __init__(self, store=None, execution_id=None, token_format=CONTINUATION_TOKEN_FORMAT):
+        """
+        Args:
+            store: IdelPlanStore for the tokens that do not fit (None or local: such tokens fail)
+            execution_id: pipeline execution ID
+        """
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
+
+        self.store = store
+        self.execution_id = execution_id
+        self.token_format = token_format
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
+
+    #
+    def encode(self, continuation):
+        """
+        Returns:
+            continuationToken (string)
+        """
+        plain = json.dumps(continuation, separators=(',', ':'))
+        if (self.token_format==TOKEN_FORMAT_JSON):
+            token = plain
+        else:
+            data = zlib.compress(json.dumps(pack(continuation), separators=(',', ':')).encode('utf-8'), 9)
+            token = TOKEN_PREFIX_INLINE+base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+            if (len(token)>TOKEN_MAX_SIZE):
+                if (self.store is None) or (not self.store.is_s3()):
+                    raise Exception('continuationToken is {} characters, over {}. Its state can only be kept in an S3 plan store, set PLAN_STORE to s3://<bucket>/<prefix>.'.format(len(token), TOKEN_MAX_SIZE))
+                self.store.save_token(self.execution_id, data)
+                token = TOKEN_PREFIX_POINTER+hashlib.sha256(data).hexdigest()[:32]
+
+        self.logger.info('continuationToken: [{}] characters (plain JSON: [{}]).'.format(len(token), len(plain)))
+        if (len(token)>TOKEN_MAX_SIZE):
+            raise Exception('continuationToken is {} characters, over {}. Use CONTINUATION_TOKEN_FORMAT v2.'.format(len(token), TOKEN_MAX_SIZE))
+        return token
+
+    #
+    def decode(self, token):
+        """
+        Returns:
+            continuation (dict) in the current format
+        """
+        if (token.startswith('{')):
+            return idel_utils.normalize_continuation_token(json.loads(token))
+
+        if (token.startswith(TOKEN_PREFIX_INLINE)):
+            data = token[len(TOKEN_PREFIX_INLINE):]
+            data = base64.urlsafe_b64decode(data+'='*(-len(data)%4))
+        elif (token.startswith(TOKEN_PREFIX_POINTER)):
+            data = self.store.load_token(self.execution_id) if (self.store) else None
+            if (data is None) or (hashlib.sha256(data).hexdigest()[:32]!=token[len(TOKEN_PREFIX_POINTER):]):
+                raise Exception('State of continuationToken {} is missing or was overwritten.'.format(token))
+        else:
+            raise Exception('Unknown continuationToken format: {}'.format(token[:16]))
+
+        return unpack(json.loads(zlib.decompress(data).decode('utf-8')))
+
+def stack_id_prefix(stack_id):
+    """`arn:aws:cloudformation:<region>:<account>:stack/` of a stack ID, or None
+    """
+    if (not stack_id) or (':stack/' not in stack_id):
+        return None
+    return stack_id[:stack_id.index(':stack/')+len(':stack/')]
+
+def pack(continuation):
+    """Compact state of a continuation
+    """
+    in_flight = continuation.get('InFlight') or []
+    times = [entry[key] for entry in in_flight for key in TIME_KEYS if (entry.get(key) is not None)]
+    base_time = int(min(times)) if (times) else 0
+    prefixes = [stack_id_prefix(entry.get('StackId')) for entry in in_flight]
+    prefixes = [prefix for prefix in prefixes if (prefix)]
+    prefix = max(set(prefixes), key=prefixes.count) if (prefixes) else None
+
+    entries = []
+    for entry in in_flight:
+        packed = {}
+        for key, value in entry.items():
+            if (value is None):
+                continue
+            if (key in TIME_KEYS):
+                value = (math.ceil(value) if (key=='NextCheck') else int(value))-base_time
+            elif (key=='StackDesire'):
+                value = DESIRES.get(value, value)
+            elif (key=='StackId') and (prefix) and (value.startswith('{}{}/'.format(prefix, entry.get('StackName')))):
+                packed[STACK_ID_SUFFIX_KEY] = value[len('{}{}/'.format(prefix, entry.get('StackName'))):]
+                continue
+            packed[IN_FLIGHT_KEYS.get(key, key)] = value
+        entries.append(packed)
+
+    state = {}
+    for key, value in continuation.items():
+        if (key=='InFlight'):
+            value = entries
+        elif (key=='Status'):
+            value = STATUSES.get(value, value)
+        state[TOKEN_KEYS.get(key, key)] = value
+    if (base_time):
+        state[BASE_TIME_KEY] = base_time
+    if (prefix):
+        state[STACK_ID_PREFIX_KEY] = prefix
+    return state
+
+def unpack(state):
+    """Continuation of a compact state
+    """
+    keys = {short: key for key, short in TOKEN_KEYS.items()}
+    in_flight_keys = {short: key for key, short in IN_FLIGHT_KEYS.items()}
+    desires = {code: desire for desire, code in DESIRES.items()}
+    statuses = {code: status for status, code in STATUSES.items()}
+    base_time = state.pop(BASE_TIME_KEY, 0)
+    prefix = state.pop(STACK_ID_PREFIX_KEY, None)
+
+    continuation = {}
+    for short, value in state.items():
+        key = keys.get(short, short)
+        if (key=='InFlight'):
+            value = [unpack_entry(entry, in_flight_keys, desires, base_time, prefix) for entry in value]
+        elif (key=='Status'):
+            value = statuses.get(value, value)
+        continuation[key] = value
+    if (not continuation.get('InFlight')):
+        continuation['InFlight'] = []
+    return continuation
+
+def unpack_entry(packed, in_flight_keys, desires, base_time, prefix):
+    entry = {}
+    for short, value in packed.items():
+        if (short==STACK_ID_SUFFIX_KEY):
+            continue
+        key = in_flight_keys.get(short, short)
+        if (key in TIME_KEYS):
+            value = value+base_time
+        elif (key=='StackDesire'):
+            value = desires.get(value, value)
+        entry[key] = value
+    if (STACK_ID_SUFFIX_KEY in packed):
+        entry['StackId'] = '{}{}/{}'.format(prefix, entry.get('StackName'), packed[STACK_ID_SUFFIX_KEY])
+    return entry
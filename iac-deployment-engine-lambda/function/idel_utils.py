@@ -3,6 +3,9 @@
 import os
 import json
 
+# Shared with IDES
+from idec import validate_changes, validate_inventory, skip_object, override_cfn_action, build_cfn_parameters, sha256
+
 # Constants
 STR_CFN = 'cfn'
 STR_AWS = 'aws'
@@ -13,26 +16,32 @@ CHANGE_MODE_PROVISION = 'provision'
 CHANGE_MODE_DESTROY = 'destroy'
 CHANGE_MODE_ON = 'on'
 CHANGE_MODE_OFF = 'off'
+CREDENTIAL_ERROR_CODES = ['UnrecognizedClientException', 'InvalidClientTokenId', 'SignatureDoesNotMatch', 'ExpiredToken', 'ExpiredTokenException']
 
 # Sample continuationToken
 """
 {
-    "StackName": "<STACK_NAME_HERE>",
-    "StackId": "<STACK_ID_HERE>",
-    "StackDesire": "<CREATE_COMPLETE|UPDATE_COMPLETE|DELETE_COMPLETE>",
-    "Block": "<Number>",
+    "Completed": "<Ranges of completed block orders. Eg: 0-3,5>",
+    "InFlight": [
+        {
+            "Block": "<Number>",
+            "StackName": "<STACK_NAME_HERE>",
+            "StackId": "<STACK_ID_HERE>",
+            "StackDesire": "<CREATE_COMPLETE|UPDATE_COMPLETE|DELETE_COMPLETE>",
+            "Occurrence": "<Number>",
+            "Started": "<Epoch seconds of the launch of the block>",
+            "NextCheck": "<Epoch seconds. The stack is not polled before>",
+            "Deadline": "<Epoch seconds. Optional: budget from the duration history>"
+        }
+    ],
     "Status": "<DONE|WAITING>",
-    "Occurrence": "<None|Number>",
     "Sequence": "<Number>"
 }
 """
 sample_continuation_token = {
-    "StackName": None,
-    "StackId": None,
-    "StackDesire": None,
-    "Block": None,
+    "Completed": None,
+    "InFlight": None,
     "Status": None,
-    "Occurrence": None,
     "Sequence": None
 }
 
@@ -68,17 +77,83 @@ def get_user_params(job_data):
 def get_sample_continuation_token():
     return sample_continuation_token.copy()
 
-def build_continuation_token(stack_name=None, stack_id=None, stack_desire=None, block=None, status=None, occurrence=None, sequence=None):
+def build_continuation_token(completed=None, in_flight=None, status=None, sequence=None):
     continuation_token = sample_continuation_token.copy()
-    continuation_token['StackName'] = stack_name
-    continuation_token['StackId'] = stack_id
-    continuation_token['StackDesire'] = stack_desire
-    continuation_token['Block'] = block
+    continuation_token['Completed'] = completed
+    continuation_token['InFlight'] = in_flight
     continuation_token['Status'] = status
-    continuation_token['Occurrence'] = occurrence
     continuation_token['Sequence'] = sequence
     return continuation_token
 
+def normalize_continuation_token(continuation):
+    """Convert a legacy (single block) continuationToken to the current format
+
+    Legacy format:
+    {
+        "StackName": "<STACK_NAME_HERE>",
+        "StackId": "<STACK_ID_HERE>",
+        "StackDesire": "<CREATE_COMPLETE|UPDATE_COMPLETE|DELETE_COMPLETE>",
+        "Block": "<Number>",
+        "Status": "<DONE|WAITING>",
+        "Occurrence": "<None|Number>",
+        "Sequence": "<Number>"
+    }
+    Blocks before `Block` are completed. `Block` itself is completed if `Status` is DONE,
+    else it is in-flight.
+    """
+    if ('InFlight' in continuation):
+        if (not continuation['InFlight']):
+            continuation['InFlight'] = []
+        return continuation
+
+    block = int(continuation['Block'])
+    in_flight = []
+    if (continuation['Status']=='DONE'):
+        last_completed = block
+    else:
+        last_completed = block-1
+        if (continuation.get('StackId')):
+            in_flight.append({
+                'Block': block,
+                'StackName': continuation['StackName'],
+                'StackId': continuation['StackId'],
+                'StackDesire': continuation['StackDesire'],
+                'Occurrence': int(continuation['Occurrence'] or 0)
+            })
+        else:
+            # Nothing to wait for
+            last_completed = block
+
+    completed = '0-{}'.format(last_completed) if (last_completed>0) else ('0' if (0==last_completed) else '')
+    return build_continuation_token(
+        completed=completed,
+        in_flight=in_flight,
+        status='WAITING' if (in_flight) else 'DONE',
+        sequence=continuation['Sequence']
+    )
+
+def cfn_content_hash(template_body, parameters, capabilities, role_arn=None):
+    """SHA-256 of what a stack is deployed from: template, parameters (sorted by key), capabilities and role
+    """
+    content = json.dumps({
+        'TemplateBody': template_body,
+        'Parameters': sorted([param['ParameterKey'], param['ParameterValue']] for param in parameters),
+        'Capabilities': sorted(capabilities),
+        'RoleARN': role_arn
+    }, sort_keys=True, separators=(',', ':'))
+    return sha256(content)
+
+def compact_result(result, max_size):
+    """Response of an API call as a JSON-ready result: without `ResponseMetadata`, dates as strings,
+    and truncated (`Truncated`, `Size`, `Head`) if it is bigger than `max_size` bytes
+    """
+    if (isinstance(result, dict)):
+        result = {key: value for key, value in result.items() if (key!='ResponseMetadata')}
+    content = json.dumps(result, separators=(',', ':'), default=str)
+    if (len(content)>max_size):
+        return {'Truncated': True, 'Size': len(content), 'Head': content[:max_size]}
+    return json.loads(content)
+
 def stack_action_corresponding_statuses(action, stack_status):
     ret = 'COMPLETE|IN_PROGRESS|UNKNOWN'
     if ((action=='deploy') and (stack_status in ['UPDATE_COMPLETE', 'CREATE_COMPLETE'])) or ((action=='delete') and (stack_status in ['DELETE_COMPLETE'])):
@@ -107,88 +182,20 @@ def stack_desire_corresponding_statuses(desire, stack_status):
 
     return ret
 
+def is_credential_error(error):
+    """True if a boto3 ClientError is caused by an invalid credential (Eg: rotated secret)
+    """
+    response = getattr(error, 'response', None)
+    if (isinstance(response, dict)):
+        return response.get('Error', {}).get('Code') in CREDENTIAL_ERROR_CODES
+    # Wrapped. Eg: Exception('Error creating CloudFormation stack ...', e)
+    return any(is_credential_error(arg) for arg in getattr(error, 'args', []) if (isinstance(arg, Exception)))
+
 def get_environment_variables():
     return {
         'LOGGING_LEVEL': os.environ['LOGGING_LEVEL'],
         'SECRET_NAME': os.environ['SECRET_NAME'],
-        'ARTIFACT_DIR': os.environ['ARTIFACT_DIR'],
         'CHANGES_FILE': os.environ['CHANGES_FILE'],
         'WAITING_OCCURRENCE': os.environ['WAITING_OCCURRENCE'],
         'CFN_WAITER_CONFIG': os.environ['CFN_WAITER_CONFIG']
     }
-
-def validate_changes(data_changes):
-    """
-    """
-    # Mode
-    if ('Mode' not in data_changes):
-        raise Exception('Broken changes file: Missing \'Mode\' item.')
-    elif (data_changes['Mode'] not in [CHANGE_MODE_CHANGE, CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
-        raise Exception('Broken changes file: \'Mode: {}\' not supported.'.format(data_changes['Mode']))
-    elif (data_changes['Mode']==CHANGE_MODE_CHANGE):
-        if ('Changes' not in data_changes):
-            raise Exception('Broken changes file: Missing \'Changes\' item.')
-        elif (0==len(data_changes['Changes'])):
-            raise Exception('Broken changes file: \'Changes\' item is empty.')
-    else:
-        pass
-
-    return True
-
-def validate_inventory(data_inventory):
-    """
-    """
-    # Inventory
-    if ('Inventory' not in data_inventory):
-        raise Exception('Broken inventory file: Missing \'Inventory\' item.')
-    elif (0==len(data_inventory['Inventory'])):
-        raise Exception('Broken inventory file: \'Inventory\' item is empty.')
-
-    return True
-
-def skip_object(change_mode, change):
-    """
-    If `Mode` is `change`: we do not care about the `Conditions`
-    Else:
-        If `cfn` objects:
-            - We can omit the `Conditions`, objects will be involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
-            - In case `Conditions` is declared, objects will be involed when `Mode` matches with `Conditions`.
-        If `aws` objects: we must declare `Conditions` and match with `Mode`, or else the engine will skip that Object/Block.
-
-    OR
-
-    If `Mode` is `change`: we do not care about the `Conditions`
-    Else:
-        If we omit the `Conditions`:
-            - Only `cfn` objects are involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
-            - Others will be skipped.
-        Else:
-            Objects will be involed when `Mode` matches with `Conditions`.
-
-    Return:
-        - `True` means skipped
-        - `False` means involved
-    """
-    if (change_mode!=CHANGE_MODE_CHANGE):
-        if ('Conditions' not in change):
-            if (change['Object']==STR_CFN) and (change_mode in [CHANGE_MODE_PROVISION,CHANGE_MODE_DESTROY]):
-                return False
-            return True
-        elif (change_mode not in change['Conditions']):
-            return True
-    return False
-
-def override_cfn_action(change_mode, original_action):
-    """
-    """
-    mappings = {
-        CHANGE_MODE_PROVISION: STR_DEPLOY,
-        CHANGE_MODE_DESTROY: STR_DELETE,
-        CHANGE_MODE_ON: STR_DEPLOY,
-        CHANGE_MODE_OFF: STR_DELETE
-    }
-
-    if (change_mode not in mappings):
-        return original_action
-
-    return mappings[change_mode]
@@ -1,14 +1,20 @@
 import os
 import logging
 
-from idel_iac import IdelIaC
+from idel_profiler import profiler
 
 NAME = 'IaC Deployment Engine Lambda'
-VERSION = '0.1.4'
+VERSION = '0.2.0'
 
 logger = logging.getLogger()
 logger.setLevel(logging.os.environ['LOGGING_LEVEL'])
 
+# Imported in the init phase (not billed, full CPU), each heavy dependency profiled on its own.
+# PyYAML is only imported when a plan is compiled (see idec.load_yaml), never by polling rounds.
+for module in ['botocore', 'boto3', 'logdecorator']:
+    profiler.import_module(module)
+idel_main = profiler.import_module('idel_main')
+
 def lambda_handler(event, context):
     """The Lambda function handler
 
@@ -22,8 +28,10 @@ def lambda_handler(event, context):
     logger.debug('event: {}'.format(str(event)))
     logger.debug('context: {}'.format(str(context)))
 
-    iac_handler = IdelIaC(event, context)
+    with profiler.measure('init IdelIaC'):
+        iac_handler = idel_main.IdelIaC(event, context)
     iac_handler.process()
+    profiler.report()
 
     logger.info('Function complete.')
     return True
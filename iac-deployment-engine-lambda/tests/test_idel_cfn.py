@@ -0,0 +1,315 @@
+# test_idel_cfn.py
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+os.environ.setdefault('CFN_WAITER_CONFIG', '{"Delay": 0, "MaxAttempts": 1}')
+for name, value in [('CHANGES_FILE', '.changes.yaml'), ('SECRET_NAME', 'secret'), ('WAITING_OCCURRENCE', '5')]:
+    os.environ.setdefault(name, value)
+
+import threading
+import logging
+import boto3
+import botocore
+from botocore.stub import Stubber
+import idec
+import idel_cfn
+import idel_main
+from idel_cfn import IdelStackCache, IdelCloudFormation, CHANGE_SET_READY, CHANGE_SET_EMPTY, CHANGE_SET_FAILED
+
+class FakeStacks:
+    """DescribeStacks of a region, by name or id
+    """
+    stacks = None
+    calls = None
+
+    def __init__(self, *stack_names):
+        self.stacks = {}
+        self.calls = []
+        for stack_name in stack_names:
+            self.create(stack_name)
+        return
+
+    #
+    def create(self, stack_name):
+        stack_id = 'arn:aws:cloudformation:eu-west-1:111111111111:stack/{}/{}'.format(stack_name, len(self.stacks))
+        self.stacks[stack_name] = {'StackName': stack_name, 'StackId': stack_id, 'StackStatus': 'CREATE_COMPLETE'}
+        return stack_id
+
+    #
+    def get_paginator(self, action):
+        self.calls.append('sweep')
+        fake = self
+
+        class Paginator:
+            def paginate(self):
+                return [{'Stacks': list(fake.stacks.values())}]
+        return Paginator()
+
+    #
+    def describe_stacks(self, StackName):
+        self.calls.append(StackName)
+        for stack in self.stacks.values():
+            if (StackName in (stack['StackName'], stack['StackId'])):
+                return {'Stacks': [stack]}
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Stack with id {} does not exist'.format(StackName)}}, 'DescribeStacks')
+
+class TestStackCache(unittest.TestCase):
+    #
+    def test_sweep(self):
+        client = FakeStacks('A', 'B', 'C')
+        cache = IdelStackCache(client)
+        self.assertTrue(cache.prime(['A', 'B', 'D']))
+        self.assertTrue(cache.exists('A'))
+        self.assertFalse(cache.exists('D'))
+        self.assertEqual(client.calls, ['sweep'])
+
+    #
+    def test_no_sweep_for_few_stacks(self):
+        cache = IdelStackCache(FakeStacks('A'))
+        self.assertFalse(cache.prime(['A']))
+        self.assertIsNone(cache.exists('A'))
+
+    #
+    def test_created_after_sweep(self):
+        client = FakeStacks('A', 'B')
+        cache = IdelStackCache(client)
+        cache.prime(['A', 'B', 'D'])
+        self.assertFalse(cache.exists('D'))
+        # Created by a block of the round
+        client.create('D')
+        cache.invalidate('D')
+        self.assertIsNone(cache.exists('D'))
+        self.assertEqual(cache.get('D')['StackStatus'], 'CREATE_COMPLETE')
+        self.assertTrue(cache.exists('D'))
+
+    #
+    def test_updated_after_sweep(self):
+        client = FakeStacks('A', 'B', 'C')
+        cache = IdelStackCache(client)
+        cache.prime(['A', 'B', 'C'])
+        stack_id = cache.get('A')['StackId']
+        cache.invalidate(stack_id)
+        self.assertIsNone(cache.exists('A'))
+        self.assertIsNone(cache.exists(stack_id))
+        self.assertTrue(cache.get('A'))
+        self.assertEqual(client.calls, ['sweep', 'A'])
+
+STACK_ID = 'arn:aws:cloudformation:eu-west-1:111111111111:stack/A/1'
+CHANGE_SET_ID = 'arn:aws:cloudformation:eu-west-1:111111111111:changeSet/idel-1/1'
+
+def change_set(status, reason=None, execution_status='AVAILABLE', changes=None, next_token=None):
+    response = {'ChangeSetId': CHANGE_SET_ID, 'StackId': STACK_ID, 'Status': status, 'ExecutionStatus': execution_status, 'Changes': changes or []}
+    if (reason):
+        response['StatusReason'] = reason
+    if (next_token):
+        response['NextToken'] = next_token
+    return response
+
+def resource_change(logical_id, action='Modify'):
+    return {'Type': 'Resource', 'ResourceChange': {'Action': action, 'LogicalResourceId': logical_id, 'ResourceType': 'AWS::SNS::Topic', 'Replacement': 'False'}}
+
+class TestChangeSets(unittest.TestCase):
+    #
+    def setUp(self):
+        client = boto3.client('cloudformation', region_name='eu-west-1', aws_access_key_id='x', aws_secret_access_key='x')
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        self.cfn_handler = IdelCloudFormation()
+        self.cfn_handler.boto3_client = client
+        self.cfn_handler.stack_cache = IdelStackCache(client)
+        self.cfn_handler.wait_mode = 'poll'
+        self.cfn_handler.notification_arns = []
+
+    #
+    def summary(self, change_set_type='UPDATE'):
+        return {'StackName': 'A', 'StackId': STACK_ID, 'ChangeSetId': CHANGE_SET_ID, 'ChangeSetType': change_set_type, 'Status': 'PENDING'}
+
+    #
+    def test_create_for_new_stack(self):
+        self.stubber.add_client_error('describe_stacks', 'ValidationError', 'Stack with id A does not exist')
+        self.stubber.add_response('create_change_set', {'Id': CHANGE_SET_ID, 'StackId': STACK_ID}, {
+            'StackName': 'A', 'ChangeSetName': 'idel-1', 'ChangeSetType': 'CREATE', 'TemplateBody': '{}', 'Parameters': [], 'Capabilities': [], 'Tags': []
+        })
+        summary = self.cfn_handler.create_change_set('A', 'idel-1', template_body='{}')
+        self.assertEqual(summary, self.summary('CREATE'))
+        self.stubber.assert_no_pending_responses()
+
+    #
+    def test_create_for_existing_stack(self):
+        self.stubber.add_response('describe_stacks', {'Stacks': [{'StackName': 'A', 'StackId': STACK_ID, 'StackStatus': 'UPDATE_COMPLETE', 'CreationTime': '2021-01-01'}]})
+        self.stubber.add_response('create_change_set', {'Id': CHANGE_SET_ID, 'StackId': STACK_ID}, {
+            'StackName': 'A', 'ChangeSetName': 'idel-1', 'ChangeSetType': 'UPDATE', 'TemplateURL': 'https://bucket/t', 'Parameters': [], 'Capabilities': [], 'Tags': []
+        })
+        summary = self.cfn_handler.create_change_set('A', 'idel-1', template_url='https://bucket/t')
+        self.assertEqual(summary['ChangeSetType'], 'UPDATE')
+        # Described again after the change
+        self.assertIsNone(self.cfn_handler.stack_cache.exists('A'))
+
+    #
+    def test_ready(self):
+        # Waiter, then the pages of the change set
+        self.stubber.add_response('describe_change_set', change_set('CREATE_COMPLETE'))
+        self.stubber.add_response('describe_change_set', change_set('CREATE_COMPLETE', changes=[resource_change('Topic')], next_token='2'))
+        self.stubber.add_response('describe_change_set', change_set('CREATE_COMPLETE', changes=[resource_change('Queue', 'Add')]), {'ChangeSetName': CHANGE_SET_ID, 'NextToken': '2'})
+        summary = self.cfn_handler.describe_change_set(self.summary())
+        self.assertEqual(summary['Status'], CHANGE_SET_READY)
+        self.assertEqual([change['Id'] for change in summary['Changes']], ['Topic', 'Queue'])
+        self.stubber.assert_no_pending_responses()
+
+    #
+    def test_empty_is_deleted(self):
+        reason = 'The submitted information didn\'t contain changes. Submit different information to create a change set.'
+        self.stubber.add_response('describe_change_set', change_set('FAILED', reason, 'UNAVAILABLE'))
+        self.stubber.add_response('describe_change_set', change_set('FAILED', reason, 'UNAVAILABLE'))
+        self.stubber.add_response('delete_change_set', {}, {'ChangeSetName': CHANGE_SET_ID})
+        summary = self.cfn_handler.describe_change_set(self.summary())
+        self.assertEqual(summary['Status'], CHANGE_SET_EMPTY)
+        self.assertNotIn('Reason', summary)
+        self.stubber.assert_no_pending_responses()
+
+    #
+    def test_failed_is_deleted(self):
+        reason = 'Template format error: Unresolved resource dependencies [Missing]'
+        self.stubber.add_response('describe_change_set', change_set('FAILED', reason, 'UNAVAILABLE'))
+        self.stubber.add_response('describe_change_set', change_set('FAILED', reason, 'UNAVAILABLE'))
+        self.stubber.add_response('delete_change_set', {}, {'ChangeSetName': CHANGE_SET_ID})
+        summary = self.cfn_handler.describe_change_set(self.summary())
+        self.assertEqual(summary['Status'], CHANGE_SET_FAILED)
+        self.assertEqual(summary['Reason'], reason)
+        self.stubber.assert_no_pending_responses()
+
+    #
+    def test_execute(self):
+        self.stubber.add_response('execute_change_set', {}, {'ChangeSetName': CHANGE_SET_ID})
+        result = self.cfn_handler.execute_change_set(self.summary('CREATE'))
+        self.assertEqual(result, {'StackId': STACK_ID, 'Desire': 'CREATE_COMPLETE', 'WaitResult': None})
+
+    #
+    def test_execute_obsolete(self):
+        self.stubber.add_client_error('execute_change_set', 'InvalidChangeSetStatus', 'Change set is obsolete')
+        with self.assertRaises(botocore.exceptions.ClientError) as context:
+            self.cfn_handler.execute_change_set(self.summary())
+        self.assertIn(context.exception.response['Error']['Code'], idel_cfn.CHANGE_SET_STALE_ERRORS)
+
+    #
+    def test_is_empty_change_set(self):
+        self.assertTrue(idec.is_empty_change_set(change_set('FAILED', 'No updates are to be performed.')))
+        self.assertFalse(idec.is_empty_change_set(change_set('FAILED', 'Template format error')))
+        self.assertFalse(idec.is_empty_change_set(change_set('FAILED')))
+        # Only failed change sets
+        self.assertFalse(idec.is_empty_change_set(change_set('CREATE_COMPLETE', 'No updates are to be performed.')))
+
+class FakeChangeSets:
+    """CloudFormation handler of change sets: statuses of the change sets created in turn, then of the executions
+    """
+    statuses = None
+    executions = None
+    calls = None
+
+    def __init__(self, statuses=None, executions=None):
+        self.statuses = list(statuses or [])
+        self.executions = list(executions or [])
+        self.calls = []
+        return
+
+    #
+    def create_change_set(self, stack_name, change_set_name, **kwargs):
+        self.calls.append('create')
+        return {'StackName': stack_name, 'StackId': STACK_ID, 'ChangeSetId': change_set_name, 'ChangeSetType': 'UPDATE', 'Status': 'PENDING'}
+
+    #
+    def describe_change_set(self, summary):
+        self.calls.append('describe')
+        summary['Status'] = self.statuses.pop(0)
+        if (summary['Status']==CHANGE_SET_FAILED):
+            summary['Reason'] = 'Template format error'
+        return summary
+
+    #
+    def execute_change_set(self, summary):
+        self.calls.append('execute')
+        error = self.executions.pop(0) if (self.executions) else None
+        if (error):
+            raise botocore.exceptions.ClientError({'Error': {'Code': error, 'Message': error}}, 'ExecuteChangeSet')
+        return {'StackId': summary['StackId'], 'Desire': 'UPDATE_COMPLETE', 'WaitResult': None}
+
+class TestDeployChangeSet(unittest.TestCase):
+    #
+    def iac(self, cfn_handler, prepared=None):
+        """Handler of a round with the change set summaries prepared up front
+        """
+        iac = idel_main.IdelIaC.__new__(idel_main.IdelIaC)
+        iac.logger = logging.getLogger()
+        iac.change_sets = {'0': prepared} if (prepared) else {}
+        iac.change_sets_lock = threading.Lock()
+        iac.cfn_of = lambda change: cfn_handler
+        iac.get_template = lambda change: {'template_body': '{}'}
+        iac.change_set_name = lambda block: 'idel-{}'.format(block)
+        return iac
+
+    #
+    def prepared(self, status):
+        return {'StackName': 'A', 'StackId': STACK_ID, 'ChangeSetId': 'idel-0', 'ChangeSetType': 'UPDATE', 'Status': status}
+
+    #
+    def deploy(self, iac):
+        return iac.deploy_change_set(0, {'Object': 'cfn', 'Stack': 'A', 'Action': 'deploy'}, [], [], [])
+
+    #
+    def test_empty_is_done(self):
+        cfn_handler = FakeChangeSets()
+        iac = self.iac(cfn_handler, self.prepared(CHANGE_SET_EMPTY))
+        result = self.deploy(iac)
+        self.assertIs(result, False)
+        self.assertEqual(cfn_handler.calls, [])
+        self.assertEqual(iac.cfn_parse_waiter_result(result, 'A'), {'StackName': 'A', 'StackId': None, 'WaitResult': True, 'Done': True})
+
+    #
+    def test_ready_is_executed(self):
+        cfn_handler = FakeChangeSets()
+        result = self.deploy(self.iac(cfn_handler, self.prepared(CHANGE_SET_READY)))
+        self.assertEqual(result['Desire'], 'UPDATE_COMPLETE')
+        self.assertEqual(cfn_handler.calls, ['execute'])
+
+    #
+    def test_not_prepared(self):
+        cfn_handler = FakeChangeSets([CHANGE_SET_EMPTY])
+        iac = self.iac(cfn_handler)
+        self.assertIs(self.deploy(iac), False)
+        self.assertEqual(cfn_handler.calls, ['create', 'describe'])
+        self.assertEqual(iac.change_sets['0']['Status'], CHANGE_SET_EMPTY)
+
+    #
+    def test_failed_up_front_is_created_again(self):
+        cfn_handler = FakeChangeSets([CHANGE_SET_READY])
+        self.deploy(self.iac(cfn_handler, self.prepared(CHANGE_SET_FAILED)))
+        self.assertEqual(cfn_handler.calls, ['create', 'describe', 'execute'])
+
+    #
+    def test_failed_again(self):
+        cfn_handler = FakeChangeSets([CHANGE_SET_FAILED])
+        with self.assertRaises(Exception) as context:
+            self.deploy(self.iac(cfn_handler, self.prepared(CHANGE_SET_FAILED)))
+        self.assertIn('Template format error', str(context.exception))
+
+    #
+    def test_obsolete_is_created_again(self):
+        cfn_handler = FakeChangeSets([CHANGE_SET_READY], executions=['InvalidChangeSetStatus'])
+        result = self.deploy(self.iac(cfn_handler, self.prepared(CHANGE_SET_READY)))
+        self.assertEqual(result['Desire'], 'UPDATE_COMPLETE')
+        self.assertEqual(cfn_handler.calls, ['execute', 'create', 'describe', 'execute'])
+
+    #
+    def test_execution_error(self):
+        cfn_handler = FakeChangeSets(executions=['AccessDenied'])
+        with self.assertRaises(Exception):
+            self.deploy(self.iac(cfn_handler, self.prepared(CHANGE_SET_READY)))
+        self.assertEqual(cfn_handler.calls, ['execute'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# test_idel_clients.py
+import os
+import sys
+import logging
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import boto3
+from botocore.stub import Stubber
+import idel_clients
+from idel_clients import IdelClients
+
+class TestClientPool(unittest.TestCase):
+    #
+    def setUp(self):
+        self.created = []
+        idel_clients.set_client_factory(lambda service, region: self.created.append((service, region)) or object())
+
+    #
+    def tearDown(self):
+        idel_clients.set_client_factory(None)
+
+    #
+    def test_pooled_by_credential(self):
+        a = idel_clients.get_client('s3', access_key_id='A', secret_access_key='a', region='eu-west-1')
+        self.assertIs(idel_clients.get_client('s3', access_key_id='A', secret_access_key='a', region='eu-west-1'), a)
+        self.assertIsNot(idel_clients.get_client('s3', access_key_id='B', secret_access_key='b', region='eu-west-1'), a)
+        self.assertEqual(len(self.created), 2)
+
+    #
+    def test_not_pooled(self):
+        for i in range(3):
+            idel_clients.get_client('s3', access_key_id='job-{}'.format(i), secret_access_key='x', session_token='t', pooled=False)
+        self.assertEqual(len(self.created), 3)
+        self.assertEqual(len(idel_clients.clients.entries), 0)
+
+    #
+    def test_logged_at_debug(self):
+        self.assertEqual(idel_clients.clients.log_level, logging.DEBUG)
+
+class TestDynamicStream(unittest.TestCase):
+    #
+    def setUp(self):
+        self.aws_client = IdelClients()
+        self.aws_client.boto3_client = boto3.client('ec2', region_name='eu-west-1', aws_access_key_id='x', aws_secret_access_key='x')
+        self.stubber = Stubber(self.aws_client.boto3_client)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    #
+    def test_pages_with_query(self):
+        self.stubber.add_response('describe_instances', {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}]}], 'NextToken': '2'}, {})
+        self.stubber.add_response('describe_instances', {'Reservations': [{'Instances': [{'InstanceId': 'i-2'}]}]}, {'NextToken': '2'})
+        values = self.aws_client.dynamic_stream('describe_instances', {}, paginate=True, query='Reservations[].Instances[].InstanceId')
+        self.assertEqual(list(values), ['i-1', 'i-2'])
+        self.stubber.assert_no_pending_responses()
+
+    #
+    def test_invalid_actions(self):
+        with self.assertRaises(Exception):
+            list(self.aws_client.dynamic_stream('describe_everything', {}))
+        # No paginator
+        with self.assertRaises(Exception):
+            list(self.aws_client.dynamic_stream('stop_instances', {'InstanceIds': ['i-1']}, paginate=True))
+        # Parameters are validated before any request
+        aws_client = IdelClients()
+        aws_client.boto3_client = boto3.client('ec2', region_name='eu-west-1', aws_access_key_id='x', aws_secret_access_key='x')
+        with self.assertRaises(ValueError):
+            list(aws_client.dynamic_stream('stop_instances', {'Unknown': 1}))
+
+if __name__ == '__main__':
+    unittest.main()
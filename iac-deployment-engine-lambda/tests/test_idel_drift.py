@@ -0,0 +1,162 @@
+# test_idel_drift.py
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+os.environ.setdefault('CFN_WAITER_CONFIG', '{"Delay": 0, "MaxAttempts": 1}')
+
+import botocore
+import idel_polling
+import idel_drift
+from idel_drift import IdelDriftDetector, DRIFT_DRIFTED, DRIFT_IN_SYNC, DRIFT_UNKNOWN
+
+class FakeDrifts:
+    """Drift detections of CloudFormation: each stack is detected after a number of polls
+
+    Args:
+        stacks: mapping of stack name -> (polls, detection status, stack drift status). Stacks not listed cannot be detected.
+    """
+    stacks = None
+    polls = None
+    started = None
+    lock = None
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.polls = {}
+        self.started = []
+        self.lock = threading.Lock()
+        return
+
+    #
+    def detect_stack_drift(self, StackName):
+        if (StackName not in self.stacks):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ValidationError', 'Message': 'Stack [{}] is in UPDATE_IN_PROGRESS state'.format(StackName)}}, 'DetectStackDrift')
+        with self.lock:
+            self.started.append(StackName)
+        return {'StackDriftDetectionId': 'detection-'+StackName}
+
+    #
+    def describe_stack_drift_detection_status(self, StackDriftDetectionId):
+        stack_name = StackDriftDetectionId[len('detection-'):]
+        polls, detection_status, drift_status = self.stacks[stack_name]
+        with self.lock:
+            self.polls[stack_name] = self.polls.get(stack_name, 0)+1
+            if (self.polls[stack_name]<polls):
+                return {'StackDriftDetectionId': StackDriftDetectionId, 'DetectionStatus': 'DETECTION_IN_PROGRESS'}
+        status = {'StackDriftDetectionId': StackDriftDetectionId, 'DetectionStatus': detection_status}
+        if (drift_status):
+            status['StackDriftStatus'] = drift_status
+        if (detection_status=='DETECTION_FAILED'):
+            status['DetectionStatusReason'] = 'Failed to detect drift on resource [Custom]'
+        return status
+
+    #
+    def describe_stack_resource_drifts(self, StackName, StackResourceDriftStatusFilters, NextToken=None):
+        if (NextToken is None):
+            return {'StackResourceDrifts': [{'LogicalResourceId': 'Topic', 'ResourceType': 'AWS::SNS::Topic', 'StackResourceDriftStatus': 'MODIFIED'}], 'NextToken': '2'}
+        return {'StackResourceDrifts': [{'LogicalResourceId': 'Queue', 'ResourceType': 'AWS::SQS::Queue', 'StackResourceDriftStatus': 'DELETED'}]}
+
+class TestDriftDetector(unittest.TestCase):
+    #
+    def setUp(self):
+        self.now = 1000.0
+
+        def sleep(seconds):
+            self.now += seconds
+        for name, value in [('clock', lambda: self.now), ('sleep', sleep)]:
+            patcher = mock.patch.object(idel_polling, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, True)
+
+    #
+    def test_detect(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_COMPLETE', DRIFT_IN_SYNC), 'B': (3, 'DETECTION_COMPLETE', DRIFT_DRIFTED)})
+        results = IdelDriftDetector(client, location='').detect([('A', 'a1'), ('B', 'b1')])
+        self.assertEqual(results['A']['Status'], DRIFT_IN_SYNC)
+        self.assertEqual(results['B']['Status'], DRIFT_DRIFTED)
+        self.assertEqual(results['B']['DriftedResources'], ['Topic (AWS::SNS::Topic): MODIFIED', 'Queue (AWS::SQS::Queue): DELETED'])
+        # Polled together
+        self.assertEqual(self.now, 1000.0+3*idel_drift.DRIFT_POLL_DELAY)
+
+    #
+    def test_detection_failed(self):
+        client = FakeDrifts({'A': (2, 'DETECTION_FAILED', None), 'B': (1, 'DETECTION_FAILED', DRIFT_DRIFTED)})
+        results = IdelDriftDetector(client, location='').detect([('A', 'a1'), ('B', 'b1')])
+        self.assertEqual(results['A']['Status'], DRIFT_UNKNOWN)
+        self.assertIn('Custom', results['A']['Reason'])
+        # Partial detection of a drifted stack: still drifted
+        self.assertEqual(results['B']['Status'], DRIFT_DRIFTED)
+
+    #
+    def test_cannot_start(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_COMPLETE', DRIFT_IN_SYNC)})
+        detector = IdelDriftDetector(client, location='')
+        with self.assertLogs(level='WARNING'):
+            results = detector.detect([('A', 'a1'), ('Busy', 'b1')])
+        self.assertEqual(results['Busy']['Status'], DRIFT_UNKNOWN)
+        self.assertIn('UPDATE_IN_PROGRESS', results['Busy']['Reason'])
+        self.assertEqual(results['A']['Status'], DRIFT_IN_SYNC)
+
+    #
+    def test_deadline(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_COMPLETE', DRIFT_IN_SYNC), 'Slow': (1000, 'DETECTION_COMPLETE', DRIFT_IN_SYNC)})
+        results = IdelDriftDetector(client, location='').detect([('A', 'a1'), ('Slow', 's1')], deadline=1000.0+4*idel_drift.DRIFT_POLL_DELAY)
+        self.assertEqual(results['A']['Status'], DRIFT_IN_SYNC)
+        self.assertEqual(results['Slow']['Status'], DRIFT_UNKNOWN)
+        self.assertEqual(results['Slow']['Reason'], 'Detection did not complete in time.')
+        self.assertEqual(self.now, 1000.0+4*idel_drift.DRIFT_POLL_DELAY)
+
+    #
+    def test_detection_timeout(self):
+        client = FakeDrifts({'Slow': (1000, 'DETECTION_COMPLETE', DRIFT_IN_SYNC)})
+        with mock.patch.object(idel_drift, 'DRIFT_DETECTION_TIMEOUT', 12):
+            results = IdelDriftDetector(client, location='').detect([('Slow', 's1')], deadline=5000.0)
+        self.assertEqual(results['Slow']['Status'], DRIFT_UNKNOWN)
+        self.assertLess(self.now, 1000.0+12+idel_drift.DRIFT_POLL_DELAY)
+
+    #
+    def test_unchanged_digest_from_cache(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_COMPLETE', DRIFT_IN_SYNC), 'B': (1, 'DETECTION_COMPLETE', DRIFT_DRIFTED)})
+        IdelDriftDetector(client, location=self.location).detect([('A', 'a1'), ('B', 'b1')])
+        self.assertEqual(sorted(client.started), ['A', 'B'])
+
+        client.started = []
+        self.now += 60
+        results = IdelDriftDetector(client, location=self.location).detect([('A', 'a1'), ('B', 'b2')])
+        # A is unchanged, B has a new template
+        self.assertEqual(client.started, ['B'])
+        self.assertTrue(results['A']['Cached'])
+        self.assertNotIn('Cached', results['B'])
+
+        # Expired
+        client.started = []
+        self.now += idel_drift.DRIFT_CACHE_TTL
+        IdelDriftDetector(client, location=self.location).detect([('A', 'a1')])
+        self.assertEqual(client.started, ['A'])
+
+    #
+    def test_unknown_not_cached(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_FAILED', None)})
+        IdelDriftDetector(client, location=self.location).detect([('A', 'a1')])
+        IdelDriftDetector(client, location=self.location).detect([('A', 'a1')])
+        self.assertEqual(client.started, ['A', 'A'])
+
+    #
+    def test_cache_of_targets(self):
+        client = FakeDrifts({'A': (1, 'DETECTION_COMPLETE', DRIFT_IN_SYNC)})
+        IdelDriftDetector(client, location=self.location, prefix='111111111111/eu-west-1/').detect([('A', 'a1')])
+        IdelDriftDetector(client, location=self.location, prefix='222222222222/eu-west-1/').detect([('A', 'a1')])
+        self.assertEqual(client.started, ['A', 'A'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# test_idel_events.py
+import os
+import sys
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import idel_clients
+import idel_events
+from idel_events import get_event_source, IdelPollingEventSource, IdelSqsEventSource, WAIT_MODE_EVENT, WAIT_MODE_POLL
+
+class FakeCloudFormation:
+    wait_mode = None
+    notification_arns = None
+
+    def __init__(self, notification_arns):
+        self.wait_mode = WAIT_MODE_EVENT
+        self.notification_arns = notification_arns
+        return
+
+class TestEventSource(unittest.TestCase):
+    #
+    def setUp(self):
+        idel_clients.set_client_factory(lambda service, region: object())
+
+    #
+    def tearDown(self):
+        idel_clients.set_client_factory(None)
+
+    #
+    def test_event_mode(self):
+        cfn_handler = FakeCloudFormation(['arn:aws:sns:eu-west-1:111111111111:stacks'])
+        with mock.patch.dict(os.environ, {'CFN_EVENT_QUEUE_URL': 'https://sqs/queue'}):
+            wait_mode, event_source = get_event_source(WAIT_MODE_EVENT, cfn_handler)
+        self.assertIsInstance(event_source, IdelSqsEventSource)
+        self.assertEqual(wait_mode, WAIT_MODE_EVENT)
+
+    #
+    def test_event_mode_falls_back_to_poll(self):
+        for notification_arns, queue_url in [([], 'https://sqs/queue'), (['arn:aws:sns:eu-west-1:111111111111:stacks'], None)]:
+            cfn_handler = FakeCloudFormation(notification_arns)
+            environ = {'CFN_EVENT_QUEUE_URL': queue_url} if (queue_url) else {}
+            with mock.patch.dict(os.environ, environ, clear=False):
+                if (not queue_url):
+                    os.environ.pop('CFN_EVENT_QUEUE_URL', None)
+                with self.assertLogs(level='WARNING'):
+                    wait_mode, event_source = get_event_source(WAIT_MODE_EVENT, cfn_handler)
+            self.assertIsInstance(event_source, IdelPollingEventSource)
+            self.assertEqual(wait_mode, WAIT_MODE_POLL)
+            # Left to the caller
+            self.assertEqual(cfn_handler.wait_mode, WAIT_MODE_EVENT)
+
+    #
+    def test_poll_mode(self):
+        cfn_handler = FakeCloudFormation([])
+        wait_mode, event_source = get_event_source(WAIT_MODE_POLL, cfn_handler)
+        self.assertEqual(wait_mode, WAIT_MODE_POLL)
+        self.assertIsInstance(event_source, IdelPollingEventSource)
+
+    #
+    def test_abstract_event_source(self):
+        with self.assertRaises(TypeError):
+            idel_events.IdelEventSource()
+
+    #
+    def test_parse_stack_notification(self):
+        body = "StackId='arn:x'\nTimestamp='2021'\nLogicalResourceId='A'\nResourceStatus='CREATE_COMPLETE'\nResourceType='AWS::CloudFormation::Stack'\nStackName='A'\n"
+        self.assertEqual(idel_events.parse_stack_notification(body), {'StackId': 'arn:x', 'StackName': 'A', 'ResourceStatus': 'CREATE_COMPLETE', 'Timestamp': '2021'})
+        self.assertIsNone(idel_events.parse_stack_notification(body.replace("LogicalResourceId='A'", "LogicalResourceId='Nested'")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# test_idel_polling.py
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+os.environ.setdefault('CFN_WAITER_CONFIG', '{"Delay": 0, "MaxAttempts": 1}')
+
+import idel_polling
+from idel_polling import IdelDurationHistory, IdelPollSchedule, DURATION_HISTORY_FILE
+
+class TestPollSchedule(unittest.TestCase):
+    #
+    def test_first_check_without_history(self):
+        schedule = IdelPollSchedule(started=1000, delay=10)
+        self.assertEqual(schedule.first_check(), 1010)
+        self.assertIsNone(schedule.expected_end())
+        self.assertIsNone(schedule.deadline())
+
+    #
+    def test_first_check_from_median(self):
+        schedule = IdelPollSchedule(started=1000, estimate={'Median': 600, 'Longest': 900, 'Count': 3}, delay=10)
+        self.assertEqual(schedule.first_check(), 1000+idel_polling.CFN_POLL_INITIAL_RATIO*600)
+        self.assertEqual(schedule.expected_end(), 1600)
+        # Never before Delay
+        schedule = IdelPollSchedule(started=1000, estimate={'Median': 2, 'Longest': 2, 'Count': 1}, delay=10)
+        self.assertEqual(schedule.first_check(), 1010)
+
+    #
+    def test_backoff_bounds(self):
+        schedule = IdelPollSchedule(started=1000, delay=10, max_delay=60)
+        # Not before the first check
+        self.assertEqual(schedule.next_check(1005), 1010)
+        for now, delay in [(1010, 10), (1015, 10), (1040, 30), (1100, 60), (5000, 60)]:
+            with mock.patch.object(idel_polling.random, 'uniform', lambda low, high: low):
+                self.assertEqual(schedule.next_check(now), now+delay/2)
+            with mock.patch.object(idel_polling.random, 'uniform', lambda low, high: high):
+                self.assertEqual(schedule.next_check(now), now+delay)
+            self.assertLessEqual(schedule.next_check(now), now+delay)
+            self.assertGreaterEqual(schedule.next_check(now), now+delay/2)
+
+    #
+    def test_max_delay_not_under_delay(self):
+        schedule = IdelPollSchedule(started=0, delay=30, max_delay=5)
+        self.assertEqual(schedule.max_delay, 30)
+
+    #
+    def test_deadline(self):
+        schedule = IdelPollSchedule(started=1000, estimate={'Median': 600, 'Longest': 900, 'Count': 3})
+        self.assertEqual(schedule.deadline(), 1000+idel_polling.CFN_WAIT_BUDGET_FACTOR*900)
+        with mock.patch.object(idel_polling, 'CFN_WAIT_BUDGET_FACTOR', 1.5):
+            self.assertEqual(schedule.deadline(), 1000+1.5*900)
+
+class TestDurationHistory(unittest.TestCase):
+    #
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, True)
+
+    #
+    def test_estimate(self):
+        history = IdelDurationHistory(self.location)
+        self.assertIsNone(history.estimate('A', 'CREATE_COMPLETE'))
+        for seconds in [100, 300, 200]:
+            history.record('A', 'CREATE_COMPLETE', seconds)
+        self.assertTrue(history.save())
+        self.assertEqual(IdelDurationHistory(self.location).estimate('A', 'CREATE_COMPLETE'), {'Median': 200, 'Longest': 300, 'Count': 3})
+        self.assertIsNone(IdelDurationHistory(self.location).estimate('A', 'UPDATE_COMPLETE'))
+
+    #
+    def test_merge_on_save(self):
+        first = IdelDurationHistory(self.location)
+        second = IdelDurationHistory(self.location)
+        first.load()
+        second.load()
+        first.record('A', 'CREATE_COMPLETE', 10)
+        second.record('B', 'CREATE_COMPLETE', 20)
+        second.record('A', 'CREATE_COMPLETE', 30)
+        first.save()
+        second.save()
+        durations = IdelDurationHistory(self.location).load()
+        self.assertEqual(durations, {'A|CREATE_COMPLETE': [10, 30], 'B|CREATE_COMPLETE': [20]})
+        # Nothing new to save
+        self.assertFalse(second.save())
+
+    #
+    def test_size(self):
+        history = IdelDurationHistory(self.location)
+        for seconds in range(idel_polling.DURATION_HISTORY_SIZE+3):
+            history.record('A', 'DELETE_COMPLETE', seconds)
+        history.save()
+        self.assertEqual(len(history.load()['A|DELETE_COMPLETE']), idel_polling.DURATION_HISTORY_SIZE)
+        self.assertEqual(history.load()['A|DELETE_COMPLETE'][-1], idel_polling.DURATION_HISTORY_SIZE+2)
+
+    #
+    def test_corrupted(self):
+        with open(os.path.join(self.location, DURATION_HISTORY_FILE), 'w') as file:
+            file.write('{not json')
+        history = IdelDurationHistory(self.location)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(history.load(), {})
+
+    #
+    def test_disabled(self):
+        history = IdelDurationHistory('')
+        self.assertFalse(history.is_enabled())
+        history.record('A', 'CREATE_COMPLETE', 10)
+        self.assertFalse(history.save())
+        self.assertIsNone(history.estimate('A', 'CREATE_COMPLETE'))
+
+    #
+    def test_schedule_with_swapped_clock(self):
+        history = IdelDurationHistory(self.location)
+        history.record('A', 'CREATE_COMPLETE', 100)
+        history.save()
+        with mock.patch.object(idel_polling, 'clock', lambda: 5000.0):
+            schedule = history.schedule('A', 'CREATE_COMPLETE')
+        self.assertEqual(schedule.started, 5000.0)
+        self.assertEqual(schedule.first_check(), 5000.0+idel_polling.CFN_POLL_INITIAL_RATIO*100)
+        self.assertEqual(history.schedule('A', 'CREATE_COMPLETE', started='100').started, 100.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# test_idel_sm.py
+import os
+import sys
+import json
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import idel_clients
+import idel_sm
+from idel_sm import IdelSecretsManager
+
+class FakeSecretsManager:
+    """Secrets Manager returning a new version on each call
+    """
+    calls = None
+
+    def __init__(self):
+        self.calls = []
+        return
+
+    #
+    def get_secret_value(self, SecretId, VersionStage):
+        self.calls.append((SecretId, VersionStage))
+        return {'VersionId': str(len(self.calls)), 'SecretString': json.dumps({'Version': len(self.calls)})}
+
+class TestSecretCache(unittest.TestCase):
+    #
+    def setUp(self):
+        self.backend = FakeSecretsManager()
+        idel_clients.set_client_factory(lambda service, region: self.backend)
+        idel_sm.secrets.clear()
+        self.now = 1000.0
+        patcher = mock.patch.object(idel_sm.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    #
+    def tearDown(self):
+        idel_clients.set_client_factory(None)
+        idel_sm.secrets.clear()
+
+    #
+    def test_cached_until_expiry(self):
+        self.assertEqual(IdelSecretsManager().get_secret('sec'), {'Version': 1})
+        # Other handlers (warm invocations) share the cache
+        self.now += idel_sm.SECRET_CACHE_TTL-1
+        self.assertEqual(IdelSecretsManager().get_secret('sec'), {'Version': 1})
+        self.now += 1
+        self.assertEqual(IdelSecretsManager().get_secret('sec'), {'Version': 2})
+        self.assertEqual(len(self.backend.calls), 2)
+
+    #
+    def test_keyed_by_version_stage(self):
+        sm_handler = IdelSecretsManager()
+        sm_handler.get_secret('sec')
+        sm_handler.get_secret('sec', 'AWSPENDING')
+        self.assertEqual(self.backend.calls, [('sec', 'AWSCURRENT'), ('sec', 'AWSPENDING')])
+
+    #
+    def test_invalidate(self):
+        sm_handler = IdelSecretsManager()
+        sm_handler.get_secret('sec')
+        sm_handler.invalidate_secret('sec')
+        self.assertNotIn(('sec', 'AWSCURRENT'), idel_sm.secrets.entries)
+        self.assertEqual(sm_handler.get_secret('sec'), {'Version': 2})
+        # Unknown secrets are ignored
+        sm_handler.invalidate_secret('other')
+
+    #
+    def test_cache_disabled(self):
+        with mock.patch.object(idel_sm, 'SECRET_CACHE_TTL', 0):
+            sm_handler = IdelSecretsManager()
+            sm_handler.get_secret('sec')
+            sm_handler.get_secret('sec')
+        self.assertEqual(len(self.backend.calls), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# test_idel_store.py
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import botocore
+import idel_clients
+from idel_store import IdelPlanStore, PLAN_BLOCKS, PLAN_RESULTS
+from idel_planner import IdelPlanner
+
+class FakeS3:
+    """Objects of S3 buckets in memory. Reads of the blocks can be slowed down.
+    """
+    objects = None
+    reads = None
+    delay = None
+    in_flight = None
+    max_in_flight = None
+    lock = None
+
+    def __init__(self, delay=0):
+        self.objects = {}
+        self.reads = []
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        return
+
+    #
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    #
+    def get_object(self, Bucket, Key, Range=None):
+        if ((Bucket, Key) not in self.objects):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        self.reads.append((Key, Range))
+        if (Range):
+            start, end = [int(value) for value in Range[len('bytes='):].split('-')]
+            data = data[start:end+1]
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(self.delay)
+            with self.lock:
+                self.in_flight -= 1
+        return {'Body': FakeBody(data)}
+
+    #
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+class FakeBody:
+    data = None
+
+    def __init__(self, data):
+        self.data = data
+        return
+
+    #
+    def read(self):
+        return self.data
+
+def changes(count=5):
+    return [
+        {'Object': 'cfn', 'Stack': 'Stack-{}'.format(i), 'Action': 'deploy', 'Params': {'Index': i}, 'TemplateBody': 'x'*100}
+        for i in range(count)
+    ]
+
+class TestPlanStore(unittest.TestCase):
+    #
+    def setUp(self):
+        self.s3 = FakeS3()
+        idel_clients.set_client_factory(lambda service, region: self.s3)
+        self.local_dir = tempfile.mkdtemp()
+
+    #
+    def tearDown(self):
+        idel_clients.set_client_factory(None)
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+    #
+    def stores(self):
+        return [IdelPlanStore(self.local_dir), IdelPlanStore('s3://plans/prefix/')]
+
+    #
+    def test_round_trip(self):
+        for store in self.stores():
+            planner = IdelPlanner(changes())
+            store.save('exec-1', 'provision', planner, changes())
+            header, blocks = store.load('exec-1')
+            self.assertEqual(header['Mode'], 'provision')
+            self.assertEqual(header['Stacks'], planner.stacks)
+            self.assertEqual(len(blocks), 5)
+            # TemplateBody is not stored
+            self.assertEqual(list(blocks), [{key: value for key, value in change.items() if (key!='TemplateBody')} for change in changes()])
+            restored = IdelPlanner(dependencies=header['Dependencies'], stacks=header['Stacks'], targets=header['Targets'])
+            self.assertEqual(restored.dependencies, planner.dependencies)
+
+    #
+    def test_not_found(self):
+        for store in self.stores():
+            self.assertEqual(store.load('missing'), (None, None))
+            self.assertIsNone(store.load_results('missing'))
+
+    #
+    def test_ranged_reads(self):
+        store = IdelPlanStore('s3://plans/prefix')
+        store.save('exec-1', 'provision', IdelPlanner(changes()), changes())
+        _, blocks = store.load('exec-1')
+        self.assertEqual(blocks[3]['Stack'], 'Stack-3')
+        self.assertEqual(blocks[3]['Stack'], 'Stack-3')
+        # One ranged read per block, on first access only
+        ranged = [read for read in self.s3.reads if (read[1])]
+        self.assertEqual([key for key, _ in ranged], ['prefix/exec-1/'+PLAN_BLOCKS])
+        with self.assertRaises(IndexError):
+            blocks[5]
+
+    #
+    def test_concurrent_block_loads(self):
+        self.s3.delay = 0.05
+        store = IdelPlanStore('s3://plans/prefix')
+        store.save('exec-1', 'provision', IdelPlanner(changes(8)), changes(8))
+        _, blocks = store.load('exec-1')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            stacks = list(executor.map(lambda i: blocks[i]['Stack'], range(8)))
+        self.assertEqual(stacks, ['Stack-{}'.format(i) for i in range(8)])
+        self.assertGreater(self.s3.max_in_flight, 1)
+
+    #
+    def test_delete_keeps_results(self):
+        for store in self.stores():
+            store.save('exec-1', 'provision', IdelPlanner(changes()), changes())
+            store.save_results('exec-1', {'0': {'Status': 'done'}})
+            store.delete('exec-1')
+            self.assertEqual(store.load('exec-1'), (None, None))
+            if (store.is_s3()):
+                self.assertEqual(store.load_results('exec-1'), {'0': {'Status': 'done'}})
+                self.assertIn(('plans', 'prefix/exec-1/'+PLAN_RESULTS), self.s3.objects)
+
+if __name__ == '__main__':
+    unittest.main()
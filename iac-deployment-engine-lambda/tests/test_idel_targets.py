@@ -0,0 +1,100 @@
+# test_idel_targets.py
+import os
+import sys
+import datetime
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import idel_cache
+import idel_clients
+import idel_targets
+from idel_targets import get_target_credential
+
+SECRET = {'ACCOUNT_NUMBER': '111111111111', 'REGION': 'eu-west-1', 'ACCESS_KEY_ID': 'AKIA1', 'SECRET_ACCESS_KEY': 'secret', 'ROLE_NAME': 'cfn'}
+
+class FakeSts:
+    """AssumeRole: credentials numbered by call, valid for TARGET_SESSION_DURATION
+    """
+    test = None
+    calls = None
+
+    def __init__(self, test):
+        self.test = test
+        self.calls = []
+        return
+
+    #
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds):
+        self.calls.append(RoleArn)
+        return {'Credentials': {
+            'AccessKeyId': 'ASIA{}'.format(len(self.calls)),
+            'SecretAccessKey': 'secret-{}'.format(len(self.calls)),
+            'SessionToken': 'token-{}'.format(len(self.calls)),
+            'Expiration': datetime.datetime.fromtimestamp(self.test.now+DurationSeconds, datetime.timezone.utc)
+        }}
+
+class TestTargetCredential(unittest.TestCase):
+    #
+    def setUp(self):
+        self.now = 1700000000.0
+        self.sts = FakeSts(self)
+        idel_clients.set_client_factory(lambda service, region: self.sts)
+        idel_cache.target_credentials.clear()
+        for target, name, value in [(idel_targets.time, 'time', lambda: self.now), (idel_targets, 'TARGET_ROLE_NAME', 'idel-target')]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    #
+    def tearDown(self):
+        idel_clients.set_client_factory(None)
+        idel_cache.target_credentials.clear()
+
+    #
+    def test_account_of_the_secret(self):
+        self.assertEqual(get_target_credential(SECRET, {}), SECRET)
+        self.assertEqual(get_target_credential(SECRET, {'Region': 'us-east-1'}), dict(SECRET, REGION='us-east-1'))
+        self.assertEqual(self.sts.calls, [])
+
+    #
+    def test_other_account(self):
+        credential = get_target_credential(SECRET, {'Account': '222222222222', 'Region': 'us-east-1'})
+        self.assertEqual(self.sts.calls, ['arn:aws:iam::222222222222:role/idel-target'])
+        self.assertEqual((credential['ACCOUNT_NUMBER'], credential['REGION']), ('222222222222', 'us-east-1'))
+        self.assertEqual((credential['ACCESS_KEY_ID'], credential['SESSION_TOKEN']), ('ASIA1', 'token-1'))
+        # The role of CloudFormation is kept
+        self.assertEqual(credential['ROLE_NAME'], 'cfn')
+
+    #
+    def test_cached_until_refresh(self):
+        get_target_credential(SECRET, {'Account': '222222222222'})
+        # Same account, other region
+        self.assertEqual(get_target_credential(SECRET, {'Account': '222222222222', 'Region': 'us-east-1'})['ACCESS_KEY_ID'], 'ASIA1')
+        # TARGET_CREDENTIAL_REFRESH seconds left: still used
+        self.now += idel_targets.TARGET_SESSION_DURATION-idel_targets.TARGET_CREDENTIAL_REFRESH
+        self.assertEqual(get_target_credential(SECRET, {'Account': '222222222222'})['ACCESS_KEY_ID'], 'ASIA1')
+        self.now += 1
+        self.assertEqual(get_target_credential(SECRET, {'Account': '222222222222'})['ACCESS_KEY_ID'], 'ASIA2')
+        self.assertEqual(len(self.sts.calls), 2)
+
+    #
+    def test_keyed_by_account_and_secret(self):
+        get_target_credential(SECRET, {'Account': '222222222222'})
+        get_target_credential(SECRET, {'Account': '333333333333'})
+        # Rotated secret
+        get_target_credential(dict(SECRET, ACCESS_KEY_ID='AKIA2'), {'Account': '222222222222'})
+        self.assertEqual(len(self.sts.calls), 3)
+
+    #
+    def test_without_role_name(self):
+        with mock.patch.object(idel_targets, 'TARGET_ROLE_NAME', ''):
+            with self.assertRaises(Exception) as context:
+                get_target_credential(SECRET, {'Account': '222222222222'})
+        self.assertIn('TARGET_ROLE_NAME', str(context.exception))
+
+if __name__ == '__main__':
+    unittest.main()
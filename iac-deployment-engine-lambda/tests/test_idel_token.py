@@ -0,0 +1,121 @@
+# test_idel_token.py
+import os
+import sys
+import json
+import uuid
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+
+import idel_token
+from idel_token import IdelTokenCodec, TOKEN_MAX_SIZE, TOKEN_PREFIX_INLINE, TOKEN_PREFIX_POINTER
+
+class MemoryPlanStore:
+    """Plan store of the tokens that do not fit, in memory
+    """
+    tokens = None
+    s3 = None
+
+    def __init__(self, s3=True):
+        self.tokens = {}
+        self.s3 = s3
+        return
+
+    #
+    def is_s3(self):
+        return self.s3
+
+    #
+    def save_token(self, execution_id, data):
+        self.tokens[execution_id] = data
+        return
+
+    #
+    def load_token(self, execution_id):
+        return self.tokens.get(execution_id)
+
+def continuation(in_flight=2, sequence=3):
+    return {
+        'Completed': '0-4,7',
+        'InFlight': [
+            {
+                'Block': 10+i,
+                'StackName': 'Stack-{}'.format(i),
+                'StackId': 'arn:aws:cloudformation:eu-west-1:111111111111:stack/Stack-{}/{}'.format(i, uuid.uuid4()),
+                'StackDesire': 'UPDATE_COMPLETE',
+                'Occurrence': 2,
+                'Started': 1700000000+i,
+                'NextCheck': 1700000060.5+i
+            }
+            for i in range(in_flight)
+        ],
+        'Status': 'WAITING',
+        'Sequence': sequence
+    }
+
+class TestTokenCodec(unittest.TestCase):
+    #
+    def test_round_trip(self):
+        state = continuation()
+        token = IdelTokenCodec().encode(state)
+        self.assertTrue(token.startswith(TOKEN_PREFIX_INLINE))
+        decoded = IdelTokenCodec().decode(token)
+        # NextCheck is rounded up, never earlier
+        for entry in state['InFlight']:
+            entry['NextCheck'] = int(entry['NextCheck'])+1
+        self.assertEqual(decoded, state)
+
+    #
+    def test_round_trip_without_in_flight(self):
+        state = {'Completed': '', 'InFlight': [], 'Status': 'DONE', 'Sequence': 0}
+        self.assertEqual(IdelTokenCodec().decode(IdelTokenCodec().encode(state)), state)
+
+    #
+    def test_smaller_than_json(self):
+        state = continuation(in_flight=7)
+        self.assertLess(len(IdelTokenCodec().encode(state)), len(json.dumps(state))/3)
+
+    #
+    def test_json_format(self):
+        state = continuation()
+        token = IdelTokenCodec(token_format=idel_token.TOKEN_FORMAT_JSON).encode(state)
+        self.assertEqual(json.loads(token), state)
+        self.assertEqual(IdelTokenCodec().decode(token), state)
+
+    #
+    def test_overflow_to_s3_store(self):
+        store = MemoryPlanStore()
+        state = continuation(in_flight=200)
+        token = IdelTokenCodec(store, 'exec-1').encode(state)
+        self.assertTrue(token.startswith(TOKEN_PREFIX_POINTER))
+        self.assertLessEqual(len(token), TOKEN_MAX_SIZE)
+        decoded = IdelTokenCodec(store, 'exec-1').decode(token)
+        self.assertEqual([entry['StackId'] for entry in decoded['InFlight']], [entry['StackId'] for entry in state['InFlight']])
+
+    #
+    def test_overflow_without_s3_store(self):
+        state = continuation(in_flight=200)
+        for store in [None, MemoryPlanStore(s3=False)]:
+            with self.assertRaises(Exception) as context:
+                IdelTokenCodec(store, 'exec-1').encode(state)
+            self.assertIn('PLAN_STORE', str(context.exception))
+
+    #
+    def test_overwritten_pointer(self):
+        store = MemoryPlanStore()
+        token = IdelTokenCodec(store, 'exec-1').encode(continuation(in_flight=200))
+        IdelTokenCodec(store, 'exec-1').encode(continuation(in_flight=200))
+        with self.assertRaises(Exception):
+            IdelTokenCodec(store, 'exec-1').decode(token)
+        with self.assertRaises(Exception):
+            IdelTokenCodec(MemoryPlanStore(), 'exec-1').decode(token)
+
+    #
+    def test_unknown_format(self):
+        with self.assertRaises(Exception):
+            IdelTokenCodec().decode('v9:xyz')
+
+if __name__ == '__main__':
+    unittest.main()
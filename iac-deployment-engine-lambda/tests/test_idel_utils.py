@@ -0,0 +1,78 @@
+# test_idel_utils.py
+import os
+import sys
+import json
+import logging
+import datetime
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', 'function'), os.path.join(HERE, '..', '..', 'iac-deployment-engine-core')]
+os.environ.setdefault('LOGGING_LEVEL', 'ERROR')
+os.environ.setdefault('CFN_WAITER_CONFIG', '{"Delay": 0, "MaxAttempts": 1}')
+for name, value in [('CHANGES_FILE', '.changes.yaml'), ('SECRET_NAME', 'secret'), ('WAITING_OCCURRENCE', '5')]:
+    os.environ.setdefault(name, value)
+
+import idel_utils
+import idel_main
+
+class TestCompactResult(unittest.TestCase):
+    #
+    def test_without_response_metadata(self):
+        result = {'StoppingInstances': [{'InstanceId': 'i-1'}], 'ResponseMetadata': {'RequestId': 'x', 'HTTPStatusCode': 200}}
+        self.assertEqual(idel_utils.compact_result(result, 1024), {'StoppingInstances': [{'InstanceId': 'i-1'}]})
+
+    #
+    def test_json_ready(self):
+        launched = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+        result = idel_utils.compact_result({'LaunchTime': launched, 'Count': 2}, 1024)
+        self.assertEqual(result, {'LaunchTime': str(launched), 'Count': 2})
+        self.assertEqual(json.loads(json.dumps(result)), result)
+        # Values of a streamed block
+        self.assertEqual(idel_utils.compact_result(['i-1', 'i-2'], 1024), ['i-1', 'i-2'])
+
+    #
+    def test_truncated(self):
+        result = {'Values': ['i-{:05d}'.format(i) for i in range(100)]}
+        size = len(json.dumps(result, separators=(',', ':')))
+        compacted = idel_utils.compact_result(result, 64)
+        self.assertEqual(compacted, {'Truncated': True, 'Size': size, 'Head': json.dumps(result, separators=(',', ':'))[:64]})
+        # Up to the limit
+        self.assertEqual(idel_utils.compact_result(result, size), result)
+
+class TestSaveResults(unittest.TestCase):
+    #
+    def iac(self):
+        iac = idel_main.IdelIaC.__new__(idel_main.IdelIaC)
+        iac.logger = logging.getLogger()
+        iac.cp_user_params = {'Pipeline': {'ExecutionId': 'exec-1'}}
+        return iac
+
+    #
+    def test_only_logged_without_s3_plan_store(self):
+        with mock.patch.object(idel_main.IdelIaC, 'state_store', None):
+            with self.assertLogs(level='WARNING') as logs:
+                self.iac().save_results({'3': {'Count': 1}})
+        self.assertIn('PLAN_STORE', logs.output[0])
+
+    #
+    def test_merged_in_s3_plan_store(self):
+        class Store:
+            results = None
+
+            def __init__(self):
+                self.results = {'1': {'Count': 5}}
+
+            def load_results(self, execution_id):
+                return dict(self.results)
+
+            def save_results(self, execution_id, results):
+                self.results = results
+        store = Store()
+        with mock.patch.object(idel_main.IdelIaC, 'state_store', store):
+            self.iac().save_results({'3': {'Count': 1}})
+        self.assertEqual(store.results, {'1': {'Count': 5}, '3': {'Count': 1}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,20 +2,37 @@ import os
 import sys
 import getopt
 import subprocess
-import yaml
-from yaml import load, dump, Loader, Dumper
+import time
 import datetime
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import botocore
 import boto3
-import urllib3
+
+# Shared engine core (IDEC): change pipeline and planner
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'iac-deployment-engine-core'))
+import idec
+from idec_metrics import metrics, UNIT_SECONDS, UNIT_COUNT
+from idec_throttle import scheduler
 
 NAME = 'IaC Deployment Engine Standalone'
-VERSION = '0.1.4'
+VERSION = '0.2.0'
+
+# Prefix of log records: block being processed by the current thread
+block_context = threading.local()
+
+class BlockLogFilter(logging.Filter):
+    def filter(self, record):
+        prefix = getattr(block_context, 'prefix', '')
+        record.block = '{} '.format(prefix) if (prefix) else ''
+        return True
 
 #
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(name)s:%(block)s%(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(BlockLogFilter())
 logging.info('{} version {}'.format(NAME, VERSION))
 
 # Constants
@@ -32,21 +49,24 @@ CHANGE_MODE_OFF = 'off'
 INVENTORY_FILE = '.inventory.yaml'
 NOTHING = 'nothing'
 LOGGING_LEVEL = 'INFO'
+CFN_WAITER_CONFIG = {'Delay': 5, 'MaxAttempts': 720}
+CFN_CHANGE_SET_WAITER_CONFIG = {'Delay': 2, 'MaxAttempts': 150}
 
 command_help = '''
   ides.py
 -p <value> : absolute or relative path to approved-deploy repository
 -a <value> : aws named profile; ref: https://docs.aws.amazon.com/cli/latest/userguide/cli-configure-profiles.html
 -c <value> : will run `.changes.<value>.yaml` file instead of the default (`.changes.yaml`)
+-j <value> : number of blocks processed concurrently (default: 1)
 -t : dry-run locally
 -h : print this help
 '''
 
 # Library: Get parameters
 def get_params(argv):
-    params = {'repo_path': '.', 'change_profile': '', 'aws_profile': '', 'dry_run': False}
+    params = {'repo_path': '.', 'change_profile': '', 'aws_profile': '', 'dry_run': False, 'jobs': 1}
     try:
-        opts, args = getopt.getopt(argv,"hp:c:a:t")
+        opts, args = getopt.getopt(argv,"hp:c:a:tj:")
         logging.debug('opts: {}'.format(opts))
         logging.debug('args: {}'.format(args))
     except getopt.GetoptError:
@@ -64,6 +84,11 @@ def get_params(argv):
             params['aws_profile'] = arg
         elif opt in ('-t'):
             params['dry_run'] = True
+        elif opt in ('-j'):
+            if (not arg.isdigit()) or (int(arg)<1):
+                logging.info(command_help)
+                sys.exit(2)
+            params['jobs'] = int(arg)
     logging.info('Parameters: {}'.format(str(params)))
     return params
 
@@ -86,53 +111,71 @@ def process_aws(params, aws_command):
         return True
     out = subprocess.Popen(aws_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdout,stderr = out.communicate()
-    logging.info(stdout)
-    logging.error(stderr)
+    # Output is captured per block, so concurrent blocks do not interleave within a line
+    for line in stdout.decode('utf-8', errors='replace').splitlines():
+        logging.info(line)
     log_time('End')
+    if (out.returncode!=0):
+        logging.error('Command exited with code {}.'.format(out.returncode))
+        return False
     return True
 
 def iac_cfn(params, item):
-    wait_command = ()
-    aws_command = list()
-    aws_command.append('aws')
-    aws_command.append('cloudformation')
-    if (item['Action']=='delete'):
-        aws_command.append('delete-stack')
-        aws_command.append('--stack-name')
-        aws_command.append(item['Stack'])
-        wait_command = ['aws', 'cloudformation', 'wait', 'stack-delete-complete', '--stack-name', item['Stack']]
-    elif (item['Action']=='deploy'):
-        aws_command.append('deploy')
-        aws_command.append('--stack-name')
-        aws_command.append(item['Stack'])
-        aws_command.append('--template-file')
-        aws_command.append('{}/{}'.format(params['repo_path'], item['Template']))
-        if ('Params' in item):
-            cfn_params = item['Params']
-            aws_command.append('--parameter-overrides')
-            if (isinstance(cfn_params, dict)):
-                for key in cfn_params:
-                    aws_command.append('{}={}'.format(key, cfn_params[key]))
-            elif (isinstance(cfn_params, list)):
-                for cfn_param in cfn_params:
-                    aws_command.append('{}={}'.format(cfn_param['Name'], cfn_param['Value']))
-            else:
-                raise Exception('Invalid format of parameters.')
-    else:
+    """Deploy (change set, like `aws cloudformation deploy`) or delete a stack through boto3
+
+    Returns:
+        {
+            'StackName': <from item>,
+            'StackId': <Stack Id generated by AWS|None>,
+            'Desire': <desired stack status>,
+            'WaitResult': <True|Waiter exception|None>,
+            'Done': <True|False>
+        }
+    """
+    log_time('Begin')
+    role_arn = target_role_arn(os.environ.get('CFN_ROLE_ARN', ''), item.get('Target'))
+
+    if (item['Action'] not in [STR_DEPLOY, STR_DELETE]):
         logging.error('Action {} is not supported.'.format(item['Action']))
+        log_time('End')
+        return False
 
-    if ('Caps' in item) and (len(item['Caps'])>0):
-        aws_command.append('--capabilities')
-        for capability in item['Caps']:
-            aws_command.append(capability)
+    if (params['dry_run']):
+        if (item['Action']==STR_DEPLOY):
+            logging.info('cloudformation.deploy(StackName={}, Template={}, Parameters={}, Capabilities={})'.format(
+                item['Stack'], item['Template'], item.get('Params'), item.get('Caps', [])))
+        else:
+            logging.info('cloudformation.delete_stack(StackName={})'.format(item['Stack']))
+        logging.info('Exit due to dry-run mode.')
+        log_time('End')
+        return True
 
-    if ('CFN_ROLE_ARN' in os.environ) and (len(os.environ['CFN_ROLE_ARN'])):
-        aws_command.append('--role-arn')
-        aws_command.append(os.environ['CFN_ROLE_ARN'])
+    cfn_client = AWSCloudFormation(params['aws_profile'], role_arn, item.get('Target'))
+    if (item['Action']==STR_DEPLOY):
+        params_value = idec.resolve_output_refs(item.get('Params') or [], lambda stack_name: get_stack_outputs(params['aws_profile'], item.get('Target'), stack_name))
+        parameters = idec.build_cfn_parameters(params_value)
+        if (parameters is None):
+            raise Exception('Invalid format of parameters.')
+        directory = idec.IdecDirectory(params['repo_path'])
+        # The staging bucket is in the account and region of the profile
+        staging = None if (item.get('Target')) else get_template_staging(params['aws_profile'])
+        if (staging):
+            # Blocks sharing a template upload it once. An unchanged template is not uploaded again.
+            template = {'template_url': staging.stage(item['TemplateDigest'], lambda: idec.get_template_body(directory, item))}
+        else:
+            template = {'template_body': idec.get_template_body(directory, item)}
+        result = cfn_client.deploy(
+            stack_name=item['Stack'],
+            **template,
+            parameters=parameters,
+            capabilities=item.get('Caps') or []
+        )
+    else:
+        result = cfn_client.delete_stack(item['Stack'])
+    # Blocks referring to its outputs run after this one
+    forget_stack_outputs(params['aws_profile'], item.get('Target'), item['Stack'])
 
-    result = process_aws(params, aws_command)
-    if (wait_command and result):
-        result = process_aws(params, wait_command)
+    log_time('End')
     return result
 
 # DEPRECATED
@@ -157,14 +200,25 @@ def iac_aws(params, item):
             logging.info('{}.client.{}({})'.format(item['Service'], item['Action'], item['Params']))
         else:
             logging.info('{}.client.{}()'.format(item['Service'], item['Action']))
+        if (item.get('Then')):
+            logging.info('{}.client.{}({}=<{}>)'.format(item['Service'], item['Then']['Action'], item['Then']['Key'], item['Query']))
         logging.info('Exit due to dry-run mode.')
         return True
 
     aws_client = AWSClients()
-    aws_client.setup_boto3_client_with_profile_name(item['Service'], params['aws_profile'])
+    aws_client.setup_boto3_client_with_profile_name(item['Service'], params['aws_profile'], item.get('Target'))
 
     try:
-        result = aws_client.dynamic_call(item['Action'], item['Params'])
+        if (item.get('Paginate')) or (item.get('Query')):
+            # Pages/values are streamed: only the projected values (or the counts of the chain) are kept
+            values = aws_client.dynamic_stream(item['Action'], item['Params'], bool(item.get('Paginate')), item.get('Query'))
+            if (item.get('Then')):
+                result = idec.run_aws_chain(aws_client.dynamic_call, item['Then'], values)
+                logging.info('{}.client.{} on [{}] value(s) in [{}] call(s).'.format(item['Service'], item['Then']['Action'], result['Count'], result['Calls']))
+            else:
+                result = list(values)
+        else:
+            result = aws_client.dynamic_call(item['Action'], item['Params'])
     except Exception as error:
         raise error
 
@@ -183,6 +237,109 @@ run_cases = {
     'kubectl': iac_kubectl
 }
 
+# boto3 sessions and clients reused across blocks, by profile and target (`Target` of blocks)
+# Clients are thread-safe, sessions are not: they are only used under the lock
+sessions = {}
+clients = {}
+clients_lock = threading.Lock()
+# Creates clients instead of boto3 if set: factory(service, profile_name, region) -> client (region: None for the one of the profile).
+# Eg: in-process backend of the benchmark suite
+client_factory = None
+# Template stagings (`CFN_TEMPLATE_STAGING`) by profile
+stagings = {}
+# Outputs of stacks referred to by `${StackName.OutputKey}`, by profile, target and stack name. Dropped when their stack is deployed.
+outputs = {}
+outputs_lock = threading.Lock()
+
+def get_session(profile_name, target=None):
+    """Session of the profile, or of a target (`{'Account', 'Region'}`) reached from the profile
+    """
+    key = (profile_name, idec.target_key(target))
+    with clients_lock:
+        if (key not in sessions):
+            if ((profile_name, None) not in sessions):
+                sessions[(profile_name, None)] = boto3.Session(profile_name=profile_name or None)
+            if (target):
+                sessions[key] = get_target_session(profile_name, sessions[(profile_name, None)], target)
+        return sessions[key]
+
+def get_target_session(profile_name, session, target):
+    """Another account is reached by assuming `TARGET_ROLE_NAME` there, with the credentials of the profile.
+    Assumed credentials last one hour.
+    """
+    region = target.get('Region') or session.region_name
+    if (not target.get('Account')) or (target['Account']==session.client('sts').get_caller_identity()['Account']):
+        return boto3.Session(profile_name=profile_name or None, region_name=region)
+
+    role_name = os.environ.get('TARGET_ROLE_NAME', '')
+    if (not role_name):
+        raise Exception('Target account {} is not the account of the profile, and TARGET_ROLE_NAME is not set.'.format(target['Account']))
+    role_arn = 'arn:aws:iam::{}:role/{}'.format(target['Account'], role_name)
+    logging.info('Assume role {}.'.format(role_arn))
+    credentials = session.client('sts').assume_role(RoleArn=role_arn, RoleSessionName='iac-deployment-engine')['Credentials']
+    return boto3.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=region
+    )
+
+def get_client(service, profile_name, target=None):
+    """Client of the profile/target. Its calls go through the request scheduler (rate limit and retries of throttled calls).
+    """
+    key = (service, profile_name, idec.target_key(target))
+    session = None if (client_factory) else get_session(profile_name, target)
+    with clients_lock:
+        if (key not in clients):
+            if (client_factory):
+                clients[key] = scheduler.attach(client_factory(service, profile_name, (target or {}).get('Region')), key)
+            else:
+                clients[key] = scheduler.attach(session.client(service), key)
+        return clients[key]
+
+def get_stack_outputs(profile_name, target, stack_name):
+    """Outputs of a stack {OutputKey: OutputValue}, described once per run
+    """
+    key = (profile_name, idec.target_key(target), stack_name)
+    with outputs_lock:
+        if (key in outputs):
+            return outputs[key]
+    stack = AWSCloudFormation(profile_name, target=target).get_stack(stack_name)
+    if (stack is None):
+        raise Exception('Stack \'{}\' does not exist, its outputs cannot be referred to.'.format(stack_name))
+    with outputs_lock:
+        outputs[key] = idec.stack_outputs(stack)
+        return outputs[key]
+
+def forget_stack_outputs(profile_name, target, stack_name):
+    with outputs_lock:
+        outputs.pop((profile_name, idec.target_key(target), stack_name), None)
+    return
+
+def target_role_arn(role_arn, target):
+    """`CFN_ROLE_ARN` in the account of a target: the role of the same name there
+    """
+    if (not role_arn) or (not target) or (not target.get('Account')):
+        return role_arn
+    parts = role_arn.split(':')
+    parts[4] = target['Account']
+    return ':'.join(parts)
+
+def get_template_staging(profile_name):
+    """Templates are uploaded to `CFN_TEMPLATE_STAGING` (`s3://<bucket>/<prefix>`) and deployed with TemplateURL
+    Return:
+        - IdecTemplateStaging of the profile
+        - None if `CFN_TEMPLATE_STAGING` is not set
+    """
+    location = os.environ.get('CFN_TEMPLATE_STAGING', '')
+    if (not location):
+        return None
+    s3_client = get_client('s3', profile_name)
+    with clients_lock:
+        if (profile_name not in stagings):
+            stagings[profile_name] = idec.IdecTemplateStaging(s3_client, location, s3_client.meta.region_name)
+        return stagings[profile_name]
+
 class AWSClients:
     session = None
     boto3_client = None
@@ -200,12 +357,12 @@ class AWSClients:
         return
 
     #
-    def setup_boto3_client_with_profile_name(self, service, profile_name):
-        """Set up boto3 client within credentials of target AWS environment
+    def setup_boto3_client_with_profile_name(self, service, profile_name, target=None):
+        """Set up boto3 client within credentials of target AWS environment (`target`: {'Account', 'Region'} reached from the profile)
         """
         logging.debug('Setting up boto3 low-level client for {}.'.format(service))
-        self.session = boto3.Session(profile_name=profile_name)
-        self.boto3_client = self.session.client(service)
+        self.session = None if (client_factory) else get_session(profile_name, target)
+        self.boto3_client = get_client(service, profile_name, target)
         logging.debug('Finish setting up boto3 low-level client for {}.'.format(service))
 
         return
@@ -216,12 +373,12 @@ class AWSClients:
         """
         logging.debug('Setting up boto3 low-level client for {}.'.format(service))
         logging.debug('credential: {}'.format(str(credential)))
-        self.boto3_client = boto3.client(
+        self.boto3_client = scheduler.attach(boto3.client(
             service,
             aws_access_key_id=credential['ACCESS_KEY_ID'],
             aws_secret_access_key=credential['SECRET_ACCESS_KEY'],
             region_name=credential['REGION']
-        )
+        ), (service, credential['REGION'], credential['ACCESS_KEY_ID']))
         logging.debug('Finish setting up boto3 low-level client for {}.'.format(service))
 
         return
@@ -246,86 +403,228 @@ class AWSClients:
 
         return result
 
-class AWSUtils:
-    @staticmethod
-    def validate_changes(data_changes):
-        """
+    #
+    def dynamic_stream(self, action, params, paginate=False, query=None):
+        """Same as dynamic_call(), as a generator of pages or of the values of `query` (see idec.stream_aws_call())
         """
-        # Mode
-        if ('Mode' not in data_changes):
-            raise Exception('Broken changes file: Missing \'Mode\' item.')
-        elif (data_changes['Mode'] not in [CHANGE_MODE_CHANGE, CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
-            raise Exception('Broken changes file: \'Mode: {}\' not supported.'.format(data_changes['Mode']))
-        elif (data_changes['Mode']==CHANGE_MODE_CHANGE):
-            if ('Changes' not in data_changes):
-                raise Exception('Broken changes file: Missing \'Changes\' item.')
-            elif (0==len(data_changes['Changes'])):
-                raise Exception('Broken changes file: \'Changes\' item is empty.')
-        else:
-            pass
+        if (NOTHING==getattr(self.boto3_client, action, NOTHING)):
+            raise Exception('Function \'{}\' not found!'.format(action))
+        if (paginate) and (not self.boto3_client.can_paginate(action)):
+            raise Exception('Function \'{}\' cannot be paginated!'.format(action))
 
-        return True
+        try:
+            yield from idec.stream_aws_call(self.boto3_client, action, params, paginate, query)
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
 
-    @staticmethod
-    def validate_inventory(data_inventory):
-        """
-        """
-        # Inventory
-        if ('Inventory' not in data_inventory):
-            raise Exception('Broken inventory file: Missing \'Inventory\' item.')
-        elif (0==len(data_inventory['Inventory'])):
-            raise Exception('Broken inventory file: \'Inventory\' item is empty.')
+class AWSCloudFormation:
+    boto3_client = None
+    logger = None
+    role_arn = None
 
-        return True
+    def __init__(self, profile_name, role_arn='', target=None):
+        # Setup logging
+        self.logger = logging.getLogger()
+        self.logger.setLevel(LOGGING_LEVEL)
 
-    @staticmethod
-    def skip_object(change_mode, change):
-        """
-        If `Mode` is `change`: we do not care about the `Conditions`
-        Else:
-            If `cfn` objects:
-                - We can omit the `Conditions`, objects will be involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
-                - In case `Conditions` is declared, objects will be involed when `Mode` matches with `Conditions`.
-            If `aws` objects: we must declare `Conditions` and match with `Mode`, or else the engine will skip that Object/Block.
-
-        OR
-
-        If `Mode` is `change`: we do not care about the `Conditions`
-        Else:
-            If we omit the `Conditions`:
-                - Only `cfn` objects are involed when `Mode` is `provision` or `destroy`. (Original design. Backward compatibility.)
-                - Others will be skipped.
-            Else:
-                Objects will be involed when `Mode` matches with `Conditions`.
+        self.boto3_client = get_client('cloudformation', profile_name, target)
+        self.role_arn = role_arn
+
+        # Log DEBUG
+        self.logger.debug('Init class {}'.format(self.__str__()))
+
+        return
 
+    #
+    def get_stack(self, stack_name):
+        """
         Return:
-            - `True` means skipped
-            - `False` means involved
+            - Stack description
+            - None if the stack does not exist
         """
-        if (change_mode!=CHANGE_MODE_CHANGE):
-            if ('Conditions' not in change):
-                if (change['Object']==STR_CFN) and (change_mode in [CHANGE_MODE_PROVISION,CHANGE_MODE_DESTROY]):
-                    return False
-                return True
-            elif (change_mode not in change['Conditions']):
-                return True
-        return False
+        try:
+            with metrics.timer('DescribeStacks', StackName=stack_name):
+                return self.boto3_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        except botocore.exceptions.ClientError as e:
+            if ('does not exist' in e.response['Error']['Message']):
+                return None
+            raise e
 
-    @staticmethod
-    def override_cfn_action(change_mode, original_action):
+    #
+    def deploy(self, stack_name, template_body=None, parameters=[], capabilities=[], template_url=None):
+        """Create and execute a change set, the same as `aws cloudformation deploy`
+        The template is either its body or the URL of the staged template (see `CFN_TEMPLATE_STAGING`).
+        """
+        if (not template_url) and (len(template_body.encode('utf-8'))>idec.CFN_TEMPLATE_BODY_MAX_SIZE):
+            raise Exception('Template of stack "{}" is bigger than {} bytes. Set CFN_TEMPLATE_STAGING to deploy it through S3.'.format(stack_name, idec.CFN_TEMPLATE_BODY_MAX_SIZE))
+
+        stack = self.get_stack(stack_name)
+        # A stack in REVIEW_IN_PROGRESS only has a change set that has never been executed
+        if (stack) and (stack['StackStatus']!='REVIEW_IN_PROGRESS'):
+            change_set_type = 'UPDATE'
+            desire = 'UPDATE_COMPLETE'
+        else:
+            change_set_type = 'CREATE'
+            desire = 'CREATE_COMPLETE'
+
+        params = {}
+        params['StackName'] = stack_name
+        params['ChangeSetName'] = 'ides-{}'.format(datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d%H%M%S%f'))
+        params['ChangeSetType'] = change_set_type
+        if (template_url):
+            params['TemplateURL'] = template_url
+        else:
+            params['TemplateBody'] = template_body
+        params['Parameters'] = parameters
+        params['Capabilities'] = capabilities
+        if (self.role_arn):
+            params['RoleARN'] = self.role_arn
+        self.logger.info('Create change set {} ({}) of stack {}'.format(params['ChangeSetName'], change_set_type, stack_name))
+        with metrics.timer('ChangeSetCreate', StackName=stack_name, ChangeSetType=change_set_type):
+            change_set = self.boto3_client.create_change_set(**params)
+
+        result = {
+            'StackName': stack_name,
+            'StackId': change_set['StackId'],
+            'Desire': desire
+        }
+
+        try:
+            with metrics.timer('ChangeSetWait', StackName=stack_name):
+                self.boto3_client.get_waiter('change_set_create_complete').wait(
+                    ChangeSetName=change_set['Id'],
+                    WaiterConfig=CFN_CHANGE_SET_WAITER_CONFIG
+                )
+        except botocore.exceptions.WaiterError as e:
+            description = self.boto3_client.describe_change_set(ChangeSetName=change_set['Id'])
+            reason = description.get('StatusReason', '')
+            if (idec.is_empty_change_set(description)):
+                self.logger.info('No changes to deploy. Stack {} is up to date.'.format(stack_name))
+                self.boto3_client.delete_change_set(ChangeSetName=change_set['Id'])
+                result['WaitResult'] = True
+                result['Done'] = True
+                return result
+            raise Exception('Error creating change set of CloudFormation stack "{0}": {1}'.format(stack_name, reason), e)
+
+        self.logger.info('Execute change set {} of stack {}'.format(params['ChangeSetName'], stack_name))
+        with metrics.timer('ChangeSetExecute', StackName=stack_name):
+            self.boto3_client.execute_change_set(ChangeSetName=change_set['Id'])
+
+        return self.wait(result, 'stack_create_complete' if (change_set_type=='CREATE') else 'stack_update_complete')
+
+    #
+    def delete_stack(self, stack_name):
         """
         """
-        mappings = {
-            CHANGE_MODE_PROVISION: STR_DEPLOY,
-            CHANGE_MODE_DESTROY: STR_DELETE,
-            CHANGE_MODE_ON: STR_DEPLOY,
-            CHANGE_MODE_OFF: STR_DELETE
+        result = {
+            'StackName': stack_name,
+            'StackId': None,
+            'Desire': 'DELETE_COMPLETE'
         }
 
-        if (change_mode not in mappings):
-            return original_action
+        stack = self.get_stack(stack_name)
+        if (not stack):
+            self.logger.info('Stack {} does not exist.'.format(stack_name))
+            result['WaitResult'] = True
+            result['Done'] = True
+            return result
+
+        result['StackId'] = stack['StackId']
+        params = {'StackName': stack['StackId']}
+        if (self.role_arn):
+            params['RoleARN'] = self.role_arn
+        self.logger.info('Delete stack: {}'.format(stack_name))
+        with metrics.timer('StackDelete', StackName=stack_name):
+            self.boto3_client.delete_stack(**params)
+
+        return self.wait(result, 'stack_delete_complete')
+
+    #
+    def wait(self, result, wait_for):
+        """Wait for the stack then compare its status with the desire
+        """
+        self.logger.info('Wait for stack {} to be {}'.format(result['StackName'], wait_for))
+        try:
+            with metrics.timer('StackWait', StackName=result['StackName'], WaitFor=wait_for):
+                self.boto3_client.get_waiter(wait_for).wait(
+                    StackName=result['StackId'],
+                    WaiterConfig=CFN_WAITER_CONFIG
+                )
+            result['WaitResult'] = True
+            result['Done'] = True
+        except botocore.exceptions.WaiterError as e:
+            result['WaitResult'] = e
+            stack = self.get_stack(result['StackId'])
+            stack_status = stack['StackStatus'] if (stack) else None
+            self.logger.error('Stack {} is {}. Desired: {}'.format(result['StackName'], stack_status, result['Desire']))
+            result['Done'] = (stack_status==result['Desire'])
 
-        return mappings[change_mode]
+        return result
+
+def block_label(order, item):
+    if (item['Object']==STR_CFN) and (item.get('Target')):
+        return '[#{} {} @{}]'.format(order, item['Stack'], idec.target_key(item['Target']))
+    if (item['Object']==STR_CFN):
+        return '[#{} {}]'.format(order, item['Stack'])
+    if (item['Object']==STR_AWS):
+        return '[#{} {}.{}]'.format(order, item['Service'], item['Action'])
+    return '[#{} {}]'.format(order, item['Object'])
+
+# Function: process a block in a worker thread
+def run_block(params, order, item):
+    block_context.prefix = block_label(order, item)
+    started = time.time()
+    done = False
+    try:
+        run_case = run_cases.get(item['Object'])
+        if (not run_case):
+            logging.error('Object {} is not supported.'.format(item['Object']))
+            return False
+        result = run_case(params, item)
+        logging.info('Result: {}'.format(str(result)))
+        if (isinstance(result, dict)):
+            done = result.get('Done', True)
+        else:
+            done = result is not False
+        return done
+    except Exception as error:
+        logging.error('Block failed: {}'.format(error))
+        return False
+    finally:
+        metrics.record('BlockDuration', time.time()-started, UNIT_SECONDS,
+            Block=order, Object=item['Object'], Action=item.get('Action'), StackName=item.get('Stack'), Target=idec.target_key(item.get('Target')), Failed=not done)
+        block_context.prefix = ''
+
+# Function: process blocks by dependencies, up to `jobs` at the same time
+def run_blocks(params, changes, planner):
+    succeeded = set()
+    failed = set()
+    cancelled = set()
+    futures = {}
+    with ThreadPoolExecutor(max_workers=params['jobs']) as executor:
+        while True:
+            for i in planner.ready_blocks(succeeded, set(futures.values()) | failed | cancelled):
+                if (len(futures)>=params['jobs']):
+                    break
+                futures[executor.submit(run_block, params, i, changes[i])] = i
+            if (not futures):
+                break
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = futures.pop(future)
+                if (future.result()):
+                    succeeded.add(i)
+                    continue
+                failed.add(i)
+                # Blocks depending on a failed block are never started
+                dependents = planner.all_dependents(i) - cancelled
+                for j in sorted(dependents):
+                    logging.error('{} Cancelled: depends on failed block {}.'.format(block_label(j, changes[j]), block_label(i, changes[i])))
+                cancelled.update(dependents)
+
+    logging.info('Blocks: [{}] succeeded, [{}] failed, [{}] cancelled.'.format(len(succeeded), len(failed), len(cancelled)))
+    return not (failed or cancelled)
 
 def main():
     """
@@ -333,6 +632,8 @@ def main():
     """
     # Program's parameters
     params = get_params(sys.argv[1:])
+    metrics.set_dimensions(Engine='ides')
+    metrics.set_properties(RepoPath=params['repo_path'], ChangeProfile=params['change_profile'])
 
     # Read deployment script file
     if (not params['change_profile']):
@@ -340,63 +641,30 @@ def main():
     else:
         changes_file = '.changes.'+params['change_profile']+'.yaml'
     logging.info('Processing file: {}'.format(changes_file))
-    with open(params['repo_path']+'/'+changes_file, encoding='utf-8') as file:
-        raw_data_changes = file.read()
-    data_changes = yaml.load(raw_data_changes, Loader=Loader)
-    AWSUtils.validate_changes(data_changes)
-
+    source = idec.IdecDirectory(params['repo_path'])
+    data_changes, changes = idec.load_changes(source, changes_file)
     change_mode = data_changes['Mode']
-    raw_data_inventory = None
-    data_inventory = None
-
-    if (change_mode in [CHANGE_MODE_PROVISION, CHANGE_MODE_DESTROY, CHANGE_MODE_ON, CHANGE_MODE_OFF]):
-        with open(params['repo_path']+'/'+INVENTORY_FILE, encoding='utf-8') as file:
-            raw_data_inventory = file.read()
-        data_inventory = yaml.load(raw_data_inventory, Loader=Loader)
-        AWSUtils.validate_inventory(data_inventory)
 
     # LOGGING
     logging.info('Change mode: {}'.format(change_mode))
     if ('Description' in data_changes):
         logging.info('Change''s overall description: {}'.format(str(data_changes['Description'])))
 
-    if (not raw_data_inventory):
-        changes = data_changes['Changes']
-    else:
-        changes = data_inventory['Inventory']
-        if (change_mode in [CHANGE_MODE_DESTROY,CHANGE_MODE_OFF]):
-            changes.reverse()
-
-    # Decorate changes
-    decorated_changes = list()
-    for i, change in enumerate(changes):
-        logging.debug('i: {}'.format(i))
-
-        # Eliminate inappropriate objects
-        if (AWSUtils.skip_object(change_mode, change)):
-            continue
-
-        # `cfn` blocks: force `Action` property
-        if (change['Object']==STR_CFN):
-            if ('Action' not in change):
-                change['Action'] = ''
-            change['Action'] = AWSUtils.override_cfn_action(change_mode, change['Action'])
-
-        # # `cfn` blocks in modes: provision/change/on
-        # # we need to convert the referred relative path template to string (Body)
-        # if (change['Object']==STR_CFN) and (change['Action']==STR_DEPLOY):
-        #     with open(ARTIFACT_DIR+change['Template'], encoding='utf-8') as file:
-        #         template_body = file.read()
-        #     change['TemplateBody'] = template_body
-
-        decorated_changes.append(change)
+    # Decorate changes. Templates are checked here and loaded when their block runs.
+    decorated_changes = list(idec.decorate_changes(source, change_mode, changes))
     logging.info('Processing [{}] objects.'.format(len(decorated_changes)))
-    # /Decorate changes
 
-    for item in decorated_changes:
-        run_case = run_cases.get(item['Object'])
-        result = run_case(params, item)
-        logging.info('Result: {}'.format(str(result)))
+    planner = idec.IdecPlanner(decorated_changes, reverse=idec.is_reverse_mode(change_mode))
+    started = time.time()
+    success = run_blocks(params, decorated_changes, planner)
+    metrics.record('RunDuration', time.time()-started, UNIT_SECONDS, Blocks=len(decorated_changes), Jobs=params['jobs'], Failed=not success)
+    throttles, waited = scheduler.drain()
+    for service, count in throttles.items():
+        metrics.record('ApiThrottles', count, UNIT_COUNT, Service=service)
+    if (throttles) or (waited):
+        logging.info('API throttles absorbed: {} ({:.1f}s spent waiting for the rate limits).'.format(dict(throttles), waited))
+    if (not success):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()